@@ -0,0 +1,283 @@
+# api.py
+# -*- coding: utf-8 -*-
+"""
+LMS 連携用の HTTP API（Starlette + uvicorn。どちらも Streamlit と一緒に入る）。
+
+Streamlit の画面をたどらずに、アプリの URL と同じパラメータでワークシートを取り出し、採点する。
+セッションを持たないので、uvicorn のワーカーを増やせばそのまま並列に捌ける。
+
+    GET  /v1/presets
+    GET  /v1/worksheet?grade=小3&field=かけ算の筆算&level=2&n=20&seed=42&format=json|csv|pdf
+    GET  /v1/stream?grade=...&n=100000&format=jsonl|csv   （大量出題。作りながら少しずつ送る）
+    POST /v1/grade   {"grade", "field", "level", "n", "seed", "answers": ["...", ...]}
+    GET  /healthz
+
+/v1/stream は、異なる問題の数が分かるプリセット（問題空間・バンク）なら送り始める前に n と比べて 422 を返す。
+数えられないプリセットで途中で作れなくなったときは、そこまでの問題の後に終わりの印として
+JSONL なら {"error": "..."} の行、CSV なら先頭列が "#error" の行を送る（ステータスは 200 のまま）。
+
+出力は (GENERATOR_VERSION, 問題の出どころ, 学年, 分野, 難度, 出題数, シード, 形式) で決まり、
+PDF も作成日時を固定してあるのでバイト単位で同じになる。そこでこの組から強い ETag を作り、
+If-None-Match が一致すれば生成せずに 304 を返す。Cache-Control は public（max-age は DRILL_API_MAX_AGE）。
+
+例:
+    python api.py --port 8080 --workers 4
+"""
+
+import argparse
+import contextlib
+import csv
+import hashlib
+import io
+import itertools
+import json
+import logging
+import os
+import sys
+from importlib import metadata
+from typing import AsyncIterator, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.exceptions import HTTPException
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+from bank import iter_rows, problem_count, source_id
+from engine import (
+    GENERATOR_VERSION,
+    PRESET_REGISTRY,
+    PRESET_TABLE,
+    ProblemSpaceExhausted,
+    compare_answers,
+    iter_csv_chunks,
+    iter_jsonl_chunks,
+    warm_font_cache,
+)
+from result_cache import cached_csv, cached_json, cached_pdf, cached_set
+
+logger = logging.getLogger(__name__)
+
+FORMATS = {
+    "json": ("application/json; charset=utf-8", cached_json),
+    "csv": ("text/csv; charset=utf-8", cached_csv),
+    "pdf": ("application/pdf", cached_pdf),
+}
+
+MAX_N = int(os.environ.get("DRILL_API_MAX_N", "1000"))
+MAX_STREAM_N = int(os.environ.get("DRILL_API_MAX_STREAM_N", "1000000"))
+MAX_AGE = int(os.environ.get("DRILL_API_MAX_AGE", "86400"))
+
+Params = Tuple[str, str, int, int, int]   # (学年, 分野, 難度, 出題数, シード)
+
+# ------------------------------------------------------------------------------
+# パラメータ
+# ------------------------------------------------------------------------------
+def _int_param(source: Dict, name: str, default: int, lo: int, hi: int) -> int:
+    raw = source.get(name, default)
+    try:
+        v = int(raw)
+    except (TypeError, ValueError):
+        raise HTTPException(400, f"{name} must be an integer: {raw!r}")
+    if not lo <= v <= hi:
+        raise HTTPException(400, f"{name} must be between {lo} and {hi}: {v}")
+    return v
+
+def parse_params(source: Dict, max_n: int = MAX_N) -> Params:
+    """クエリ（または JSON 本文）から (学年, 分野, 難度, 出題数, シード) を読む。既定値はアプリと同じ。"""
+    grade = str(source.get("grade", "小3"))
+    field = str(source.get("field", "整数のたし算・ひき算"))
+    if grade not in PRESET_TABLE:
+        raise HTTPException(400, f"unknown grade: {grade}")
+    if field not in PRESET_TABLE[grade]:
+        raise HTTPException(400, f"unknown field for {grade}: {field}")
+    return (grade, field, _int_param(source, "level", 1, 1, 5), _int_param(source, "n", 10, 1, max_n),
+            _int_param(source, "seed", 0, 0, 2 ** 63 - 1))
+
+# ------------------------------------------------------------------------------
+# ETag
+# ------------------------------------------------------------------------------
+def _renderer_id(fmt: str) -> str:
+    # PDF のバイト列はフォントの有無と fpdf2 の版でも変わる
+    if fmt != "pdf":
+        return ""
+    font = warm_font_cache()
+    try:
+        fpdf_version = metadata.version("fpdf2")
+    except metadata.PackageNotFoundError:
+        fpdf_version = "?"
+    return f"{os.path.basename(font) if font else 'nofont'}/{fpdf_version}"
+
+def etag_for(params: Params, fmt: str) -> str:
+    grade, field, level, n, seed = params
+    key = "\0".join(map(str, (GENERATOR_VERSION, source_id(grade, field, level), grade, field, level, n, seed,
+                              fmt, _renderer_id(fmt))))
+    return '"' + hashlib.sha256(key.encode("utf-8")).hexdigest()[:32] + '"'
+
+def _matches(if_none_match: Optional[str], etag: str) -> bool:
+    # If-None-Match は弱い比較（W/ を外して比べる）
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(t.strip().removeprefix("W/") == etag for t in if_none_match.split(","))
+
+def _cache_headers(etag: str) -> Dict[str, str]:
+    return {"ETag": etag, "Cache-Control": f"public, max-age={MAX_AGE}"}
+
+# ------------------------------------------------------------------------------
+# エンドポイント
+# ------------------------------------------------------------------------------
+async def presets(request: Request) -> Response:
+    items = [{"grade": p.grade, "field": p.field, "level": p.level, "label": p.label,
+              "size": p.space.size if p.space is not None else None}
+             for p in PRESET_REGISTRY.values()]
+    return JSONResponse({"generator_version": GENERATOR_VERSION, "presets": items})
+
+async def worksheet(request: Request) -> Response:
+    params = parse_params(request.query_params)
+    fmt = request.query_params.get("format", "json")
+    if fmt not in FORMATS:
+        raise HTTPException(400, f"format must be one of {', '.join(FORMATS)}: {fmt}")
+    media_type, render = FORMATS[fmt]
+
+    etag = await run_in_threadpool(etag_for, params, fmt)
+    headers = _cache_headers(etag)
+    if _matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    try:
+        body = await run_in_threadpool(render, *params)
+    except ProblemSpaceExhausted as e:
+        raise HTTPException(422, str(e))
+    if fmt != "json":
+        grade, field, level, n, seed = params
+        headers["Content-Disposition"] = f'attachment; filename="drill-L{level}-n{n}-s{seed}.{fmt}"'
+    return Response(body, media_type=media_type, headers=headers)
+
+def _jsonl_error(message: str) -> bytes:
+    return (json.dumps({"error": message}, ensure_ascii=False) + "\n").encode("utf-8")
+
+def _csv_error(message: str) -> bytes:
+    buf = io.StringIO()
+    csv.writer(buf, lineterminator="\n").writerow(["#error", message])
+    return buf.getvalue().encode("utf-8")
+
+# 形式 -> (Content-Type, 本文のチャンク, 途中で止まったときの終わりの印)
+STREAM_FORMATS: Dict[str, Tuple[str, Callable[[Iterable[Dict]], Iterator[bytes]], Callable[[str], bytes]]] = {
+    "jsonl": ("application/x-ndjson; charset=utf-8", iter_jsonl_chunks, _jsonl_error),
+    "csv": ("text/csv; charset=utf-8", iter_csv_chunks, _csv_error),
+}
+
+def _stream_body(rows: Iterator[Dict], chunks: Callable[[Iterable[Dict]], Iterator[bytes]],
+                 error_record: Callable[[str], bytes]) -> Iterator[bytes]:
+    # 送り始めた後はステータスを変えられないので、止まったらそこまでの問題を送ってから終わりの印を付ける
+    failure: List[str] = []
+
+    def until_error() -> Iterator[Dict]:
+        try:
+            yield from rows
+        except ProblemSpaceExhausted as e:
+            failure.append(str(e))
+        except Exception as e:
+            logger.exception("stream generation failed")
+            failure.append(f"generation failed: {e}")
+
+    yield from chunks(until_error())
+    if failure:
+        yield error_record(failure[0])
+
+async def stream(request: Request) -> Response:
+    params = parse_params(request.query_params, MAX_STREAM_N)
+    fmt = request.query_params.get("format", "jsonl")
+    if fmt not in STREAM_FORMATS:
+        raise HTTPException(400, f"format must be one of {', '.join(STREAM_FORMATS)}: {fmt}")
+    media_type, chunks, error_record = STREAM_FORMATS[fmt]
+    grade, field, level, n, seed = params
+    size = await run_in_threadpool(problem_count, grade, field, level)
+    if size is not None and n > size:
+        raise HTTPException(422, f"{grade}/{field}/level {level} has only {size} distinct problems, {n} requested")
+
+    etag = await run_in_threadpool(etag_for, params, fmt)
+    headers = _cache_headers(etag)
+    if _matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    # 最初の 1 問だけ先に作る。1 問も作れない条件はここで 422 にできる
+    rows = iter_rows(grade, field, level, seed, n=n)
+    try:
+        first = await run_in_threadpool(next, rows)
+    except ProblemSpaceExhausted as e:
+        raise HTTPException(422, str(e))
+    # 同期のイテレータは Starlette がスレッドプールで回す
+    return StreamingResponse(_stream_body(itertools.chain([first], rows), chunks, error_record),
+                             media_type=media_type, headers=headers)
+
+def _grade(params: Params, answers: List[str]) -> Dict:
+    pset = cached_set(*params)
+    results = []
+    for i, (value, expected) in enumerate(zip(pset.values, pset.answers)):
+        user = answers[i] if i < len(answers) else ""
+        results.append({"index": i + 1, "correct": compare_answers(value, user), "answer": user,
+                        "expected": expected})
+    return {"score": sum(x["correct"] for x in results), "total": len(pset), "results": results}
+
+async def grade(request: Request) -> Response:
+    try:
+        body = await request.json()
+    except ValueError:
+        raise HTTPException(400, "request body must be JSON")
+    if not isinstance(body, dict):
+        raise HTTPException(400, "request body must be a JSON object")
+    params = parse_params(body)
+    answers = body.get("answers", [])
+    if not isinstance(answers, list) or len(answers) > params[3]:
+        raise HTTPException(400, "answers must be a list of at most n strings")
+    try:
+        result = await run_in_threadpool(_grade, params, ["" if a is None else str(a) for a in answers])
+    except ProblemSpaceExhausted as e:
+        raise HTTPException(422, str(e))
+    return JSONResponse(result)
+
+async def healthz(request: Request) -> Response:
+    return JSONResponse({"ok": True, "generator_version": GENERATOR_VERSION})
+
+@contextlib.asynccontextmanager
+async def _lifespan(app: Starlette) -> AsyncIterator[None]:
+    # 各ワーカーの起動時にフォントを解析しておく（最初の PDF の要求を遅くしない）
+    await run_in_threadpool(warm_font_cache)
+    yield
+
+async def _http_error(request: Request, exc: HTTPException) -> Response:
+    return JSONResponse({"error": exc.detail}, status_code=exc.status_code)
+
+app = Starlette(
+    routes=[
+        Route("/v1/presets", presets),
+        Route("/v1/worksheet", worksheet),
+        Route("/v1/stream", stream),
+        Route("/v1/grade", grade, methods=["POST"]),
+        Route("/healthz", healthz),
+    ],
+    exception_handlers={HTTPException: _http_error},
+    lifespan=_lifespan,
+)
+
+# ------------------------------------------------------------------------------
+# 起動
+# ------------------------------------------------------------------------------
+def build_parser() -> argparse.ArgumentParser:
+    ap = argparse.ArgumentParser(description="算数ドリルの HTTP API")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8080)
+    ap.add_argument("--workers", type=int, default=1, help="uvicorn のワーカープロセス数")
+    return ap
+
+def main(argv: Optional[List[str]] = None) -> int:
+    import uvicorn
+
+    args = build_parser().parse_args(argv)
+    uvicorn.run("api:app", host=args.host, port=args.port, workers=args.workers)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,690 +1,34 @@
 # app.py
 # -*- coding: utf-8 -*-
 
-import os
-import math
-import random
-import fractions
-import re
-from typing import List, Dict, Tuple, Union, Optional
-
-import pandas as pd
-import streamlit as st
-from fpdf import FPDF
-from fpdf.enums import XPos, YPos
+# Streamlit は操作のたびにこのスクリプト全体を実行し直す。プロセスで一度だけでよい準備
+# （プリセット表・フォントの探索と解析・正規表現のコンパイル）は import するモジュール側で行い、
+# ここには置かない。pandas・fpdf・pyarrow など重いモジュールは使う分岐の中で import する
+# （起動と再実行の時間の目安は bench.py の STARTUP_BUDGET_MS）。
 
-# ------------------------------------------------------------------------------
-# ページ設定
-# ------------------------------------------------------------------------------
-st.set_page_config(page_title="算数ドリルジェネレータ", page_icon="🧮", layout="wide")
+import time
+from typing import Optional
 
-# ------------------------------------------------------------------------------
-# 出題プリセット表
-# ------------------------------------------------------------------------------
-PRESET_TABLE: Dict[str, Dict[str, List[str]]] = {
-    "小3": {
-        "整数のたし算・ひき算": [
-            "2桁・2項の和差算", "2桁・3項の和差算", "3桁・3項の和差算", "4桁・4項の和差算", "5桁・5項の和差算"
-        ],
-        "かけ算の筆算": [
-            "2桁×1桁", "3桁×1桁", "2桁×2桁", "3桁×2桁", "3桁×3桁"
-        ],
-        "わり算（あまりあり）": [
-            "2〜50", "10〜200", "50〜1000", "200〜5000", "1000〜20000"
-        ],
-    },
-    "小4": {
-        "大きな数と筆算": [
-            "4桁・2項の和差算", "5桁・2項の和差算", "6桁・2項の和差算", "3桁・2項の積", "4桁・2項の積"
-        ],
-        "小数の四則": [
-            "小数第1位の2項の和差算", "小数第2位の2項の和差算", "小数第1位の2項の積商算", "小数第2位の2項の積商算", "小数第1位の3項の和差積商混合算"
-        ],
-        "約数・倍数（計算）": [
-            "30〜100くらいの小さい整数の公約数",   # L1: GCD
-            "50〜200の整数の公約数",               # L2: GCD
-            "素因数分解を意識した数（2桁〜3桁）",   # L3: GCD
-            "3つの数の公倍数",                     # L4: LCM
-            "3つの数の公約数"                      # L5: GCD
-        ],
-        "分数のたし算・ひき算": [
-            "分母1桁・2項の和差算", "分母2桁・2項の和差算", "分母1桁・3項の和差算", "分母2桁・3項の和差算", "文章題"
-        ],
-    },
-    "小5": {
-        "分数の四則混合": ["frac_terms 2〜3", "同上", "3", "3", "3"],
-        "小数×分数・分数×分数": ["frac_mixed", "同上", "同上", "同上", "同上"],
-        "割合の基本計算": ["of/up/down", "同上", "reverse", "chain", "chain"],
-        "比の基本計算": ["簡単比", "同上", "同上", "難易度高", "難易度高"],
-    },
-    "小6": {
-        "分数・小数の複合計算": ["frac+decimal", "同上", "同上", "同上", "同上"],
-        "逆算（□を求める）": ["基本", "同上", "同上", "同上", "同上"],
-        "最大公約数・最小公倍数": ["簡単", "同上", "同上", "高難度", "高難度"],  # L1-3: GCD, L4-5: LCM
-        "比例・反比例の基本計算": ["基本", "同上", "同上", "難易度高", "難易度高"],
-    },
-}
+import streamlit as st
 
-# ------------------------------------------------------------------------------
-# ユーティリティ
-# ------------------------------------------------------------------------------
-def rand_int_with_digits(d: int) -> int:
-    lo = 10 ** (d - 1)
-    hi = 10 ** d - 1
-    return random.randint(lo, hi)
-
-def rand_nonzero(a: int, b: int) -> int:
-    while True:
-        x = random.randint(a, b)
-        if x != 0:
-            return x
-
-def simplify_fraction(fr: fractions.Fraction) -> fractions.Fraction:
-    return fractions.Fraction(fr.numerator, fr.denominator)
-
-def format_fraction(fr: fractions.Fraction) -> str:
-    if fr.denominator == 1:
-        return str(fr.numerator)
-    return f"{fr.numerator}/{fr.denominator}"
-
-def lcm(a: int, b: int) -> int:
-    return abs(a * b) // math.gcd(a, b)
-
-def lcmm(*args: int) -> int:
-    v = 1
-    for x in args:
-        v = lcm(v, x)
-    return v
+from engine import (
+    PRESET_TABLE,
+    find_japanese_font,
+    compare_answers,
+    ProblemSpaceExhausted,
+)
+from metrics import maybe_write_metrics_file, observe, summary, timed
+from profiling import PROFILE_MODES, admin_token_ok, profile_request
+from problemset import ProblemSet
+from result_cache import cache_stats, cached_bundle, cached_set, peek_bundle, cached_csv, submit_pdf, warm_font_cache_async
 
-# ------------------------------------------------------------------------------
-# PDF: 日本語フォント対応 + フォールバック
-# ------------------------------------------------------------------------------
-def find_japanese_font() -> Union[str, None]:
-    here = os.path.dirname(os.path.abspath(__file__))
-    candidates = [
-        os.path.join(here, "assets", "NotoSansJP-Regular.ttf"),
-        os.path.join(here, "assets", "NotoSansJP-Regular.otf"),
-        "assets/NotoSansJP-Regular.ttf",
-        "assets/NotoSansJP-Regular.otf",
-        "/usr/share/fonts/truetype/noto/NotoSansJP-Regular.ttf",
-        "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
-        "/usr/share/fonts/truetype/noto/NotoSansCJK-Regular.ttc",
-    ]
-    for p in candidates:
-        if os.path.isfile(p):
-            return p
-    return None
-
-def ascii_safe(text: str) -> str:
-    return text.encode("latin-1", "replace").decode("latin-1")
-
-def to_bytes(x) -> bytes:
-    if isinstance(x, (bytes, bytearray)):
-        return bytes(x)
-    return x.encode("latin-1", "ignore")
-
-# ------------------------------------------------------------------------------
-# PDF生成：1ページ目=問題、2ページ目=模範解答
-# ------------------------------------------------------------------------------
-def build_pdf(title: str, header_meta: Dict[str, str], problems: List[Dict]) -> bytes:
-    pdf = FPDF(orientation="P", unit="mm", format="A4")
-    pdf.set_auto_page_break(auto=True, margin=15)
-
-    font_path = find_japanese_font()
-    use_unicode = False
-    if font_path:
-        try:
-            pdf.add_font("JP", "", font_path, uni=True)
-            pdf.set_font("JP", size=16)
-            use_unicode = True
-        except Exception:
-            pdf.set_font("Helvetica", size=16)
-    else:
-        pdf.set_font("Helvetica", size=16)
-
-    write = (lambda s: s) if use_unicode else ascii_safe
-
-    # 1ページ目：問題
-    pdf.add_page()
-    pdf.cell(0, 10, text=write(title), new_x=XPos.LMARGIN, new_y=YPos.NEXT)
-    pdf.set_font_size(11)
-    for k, v in header_meta.items():
-        pdf.cell(0, 7, text=write(f"{k}: {v}"), new_x=XPos.LMARGIN, new_y=YPos.NEXT)
-    pdf.ln(2)
-
-    pdf.set_font_size(12)
-    for i, p in enumerate(problems, 1):
-        q = p["question"]
-        meta = p.get("meta", "")
-        pdf.multi_cell(0, 7, text=write(f"Q{i}. {q}"))
-        if meta:
-            pdf.set_text_color(100, 100, 100)
-            pdf.cell(0, 5, text=write(f"（プリセット: {meta}）"), new_x=XPos.LMARGIN, new_y=YPos.NEXT)
-            pdf.set_text_color(0, 0, 0)
-        pdf.ln(1)
-
-    # 2ページ目：解答
-    pdf.add_page()
-    pdf.set_font_size(16)
-    pdf.cell(0, 10, text=write("模範解答"), new_x=XPos.LMARGIN, new_y=YPos.NEXT)
-    pdf.set_font_size(12)
-    for i, p in enumerate(problems, 1):
-        a = p["answer"]
-        pdf.cell(0, 6, text=write(f"Q{i}. {a}"), new_x=XPos.LMARGIN, new_y=YPos.NEXT)
-
-    return to_bytes(pdf.output(dest="S"))
+# アプリ内演習で 1 ページに並べる問題数
+EXERCISE_PAGE_SIZE = 20
 
 # ------------------------------------------------------------------------------
-# バリデーション（負数の除外、LCM=1除外、GCD=1除外）
-# ------------------------------------------------------------------------------
-def answer_is_negative(ans: str) -> bool:
-    s = str(ans).strip()
-
-    if "あまり" in s:
-        try:
-            q_part = s.split("あまり")[0].strip()
-            q_val = int(q_part)
-            return q_val < 0
-        except Exception:
-            return s.startswith("-")
-
-    if ":" in s:
-        return False
-
-    if re.fullmatch(r"-?\d+/\d+", s):
-        try:
-            fr = fractions.Fraction(s)
-            return fr < 0
-        except Exception:
-            return s.startswith("-")
-
-    try:
-        v = float(s)
-        return v < -1e-12
-    except Exception:
-        return False
-
-def is_lcm_context(grade: str, field: str, level: int) -> bool:
-    if grade == "小4" and field == "約数・倍数（計算）" and level == 4:
-        return True
-    if grade == "小6" and field == "最大公約数・最小公倍数" and level >= 4:
-        return True
-    return False
-
-def is_gcd_context(grade: str, field: str, level: int) -> bool:
-    if grade == "小4" and field == "約数・倍数（計算）" and level in (1, 2, 3, 5):
-        return True
-    if grade == "小6" and field == "最大公約数・最小公倍数" and level <= 3:
-        return True
-    return False
-
-def lcm_answer_is_one(ans: str) -> bool:
-    try:
-        return int(str(ans).strip()) == 1
-    except Exception:
-        return False
-
-def gcd_answer_is_one(ans: str) -> bool:
-    try:
-        return int(str(ans).strip()) == 1
-    except Exception:
-        return False
-
-def generate_safe(gen_callable, *, grade: str, field: str, level: int, max_retry: int = 100) -> Tuple[str, str]:
-    last = ("", "")
-    for _ in range(max_retry):
-        q, a = gen_callable()
-        last = (q, a)
-        if answer_is_negative(a):
-            continue
-        if is_lcm_context(grade, field, level) and lcm_answer_is_one(a):
-            continue
-        if is_gcd_context(grade, field, level) and gcd_answer_is_one(a):
-            continue
-        return q, a
-    return last
-
-# ------------------------------------------------------------------------------
-# 出題ジェネレータ群
-# ------------------------------------------------------------------------------
-def gen_sum_diff(digits: int, terms: int) -> Tuple[str, str]:
-    nums = [rand_int_with_digits(digits) for _ in range(terms)]
-    ops = [random.choice(["+", "-"]) for _ in range(terms - 1)]
-    expr = str(nums[0])
-    val = nums[0]
-    for i, op in enumerate(ops, start=1):
-        n = nums[i]
-        if op == "+":
-            val += n
-        else:
-            val -= n
-        expr += f" {op} {n}"
-    return f"{expr} =", str(val)
-
-def gen_mul(a_digits: int, b_digits: int) -> Tuple[str, str]:
-    a = rand_int_with_digits(a_digits)
-    b = rand_int_with_digits(b_digits)
-    return f"{a} × {b} =", str(a * b)
-
-def gen_div_with_remainder(div_lo: int, div_hi: int) -> Tuple[str, str]:
-    a = random.randint(div_lo, div_hi)
-    b = rand_nonzero(2, max(2, min(9, a)))
-    q, r = divmod(a, b)
-    if r == 0:
-        r = random.randint(1, b - 1)
-        a = q * b + r
-    return f"{a} ÷ {b} =", f"{q} あまり {r}"
-
-def gen_large_sumdiff(digits: int) -> Tuple[str, str]:
-    a = rand_int_with_digits(digits)
-    b = rand_int_with_digits(digits)
-    op = random.choice(["+", "-"])
-    val = a + b if op == "+" else a - b
-    return f"{a} {op} {b} =", str(val)
-
-def gen_decimal_addsub(places: int) -> Tuple[str, str]:
-    def r():
-        return round(random.uniform(1, 100), places)
-    a, b = r(), r()
-    op = random.choice(["+", "-"])
-    val = round(a + b, places + 1) if op == "+" else round(a - b, places + 1)
-    return f"{a:.{places}f} {op} {b:.{places}f} =", f"{val}"
-
-def gen_decimal_muldiv(places: int) -> Tuple[str, str]:
-    def r():
-        return round(random.uniform(0.5, 50), places)
-    a, b = r(), r()
-    op = random.choice(["×", "÷"])
-    if op == "×":
-        val = a * b
-    else:
-        b = b if b != 0 else r()
-        val = a / b
-    return f"{a:.{places}f} {op} {b:.{places}f} =", f"{round(val, places+2)}"
-
-def gen_gcd_range(lo: int, hi: int, count: int = 2) -> Tuple[str, str]:
-    nums = [random.randint(lo, hi) for _ in range(count)]
-    g = 0
-    for n in nums:
-        g = math.gcd(g, n)
-    return f"次の数の最大公約数を求めよ: {', '.join(map(str, nums))}", str(g)
-
-def gen_lcm_range(lo: int, hi: int, count: int = 2) -> Tuple[str, str]:
-    nums = [random.randint(lo, hi) for _ in range(count)]
-    v = lcmm(*nums)
-    return f"次の数の最小公倍数を求めよ: {', '.join(map(str, nums))}", str(v)
-
-def gen_fraction_addsub(den_digits: int, terms: int) -> Tuple[str, str]:
-    frs = []
-    for _ in range(terms):
-        den = rand_int_with_digits(den_digits)
-        num = random.randint(1, den - 1)
-        frs.append(fractions.Fraction(num, den))
-    ops = [random.choice(["+", "-"]) for _ in range(terms - 1)]
-    v = frs[0]
-    expr = format_fraction(frs[0])
-    for i, op in enumerate(ops, 1):
-        if op == "+":
-            v += frs[i]
-            expr += f" + {format_fraction(frs[i])}"
-        else:
-            v -= frs[i]
-            expr += f" - {format_fraction(frs[i])}"
-    return f"{expr} =", format_fraction(simplify_fraction(v))
-
-def gen_fraction_mixed() -> Tuple[str, str]:
-    if random.choice([True, False]):
-        a = round(random.uniform(0.1, 9.9), 1)
-        den = random.randint(2, 12)
-        num = random.randint(1, den - 1)
-        val = a * (num / den)
-        return f"{a} × {num}/{den} =", f"{round(val, 3)}"
-    else:
-        den1 = random.randint(2, 12); num1 = random.randint(1, den1 - 1)
-        den2 = random.randint(2, 12); num2 = random.randint(1, den2 - 1)
-        fr1 = fractions.Fraction(num1, den1)
-        fr2 = fractions.Fraction(num2, den2)
-        v = simplify_fraction(fr1 * fr2)
-        return f"{format_fraction(fr1)} × {format_fraction(fr2)} =", format_fraction(v)
-
-def gen_ratio_basic(hard: bool=False) -> Tuple[str, str]:
-    a = random.randint(2, 30)
-    b = random.randint(2, 30)
-    g = math.gcd(a, b)
-    if hard:
-        return f"{a}:{b} を最も簡単な比に直せ。", f"{a//g}:{b//g}"
-    else:
-        k = random.randint(2, 9)
-        return f"{a}:{b} を {k}倍した比を求めよ。", f"{a*k}:{b*k}"
-
-def gen_percent_basic(mode: str) -> Tuple[str, str]:
-    if mode in ("of", "up", "down"):
-        base = random.randint(50, 500)
-        p = random.choice([5, 10, 12, 20, 25, 30, 40, 50])
-        if mode == "of":
-            return f"{base} の {p}% は？", str(base * p / 100)
-        elif mode == "up":
-            return f"{base} を {p}% 増やすと？", str(round(base * (1 + p/100), 2))
-        else:
-            return f"{base} を {p}% 減らすと？", str(round(base * (1 - p/100), 2))
-    elif mode == "reverse":
-        p = random.choice([120, 150, 80, 75, 200])
-        y = random.randint(100, 600)
-        x = y * 100 / p
-        return f"ある数の {p}% が {y}。元の数はいくつ？", f"{round(x, 2)}"
-    else:  # chain
-        base = random.randint(100, 800)
-        p1 = random.choice([10, 20, 25]); p2 = random.choice([10, 20, 25])
-        val = base * (1 + p1/100) * (1 - p2/100)
-        return f"{base} を {p1}%増やし、その後 {p2}%減らすと？", f"{round(val, 2)}"
-
-def gen_frac_mixed_ops(terms: int) -> Tuple[str, str]:
-    frs = []
-    for _ in range(terms):
-        den = random.randint(2, 12)
-        num = random.randint(1, den - 1)
-        frs.append(fractions.Fraction(num, den))
-    ops_all = ["+", "-", "×", "÷"]
-    ops = [random.choice(ops_all) for _ in range(terms - 1)]
-    v = frs[0]
-    expr = format_fraction(frs[0])
-    for i, op in enumerate(ops, 1):
-        if op == "+":
-            v = v + frs[i]
-            expr += f" + {format_fraction(frs[i])}"
-        elif op == "-":
-            v = v - frs[i]
-            expr += f" - {format_fraction(frs[i])}"
-        elif op == "×":
-            v = v * frs[i]
-            expr += f" × {format_fraction(frs[i])}"
-        else:
-            v = v / frs[i]
-            expr += f" ÷ {format_fraction(frs[i])}"
-    return f"{expr} =", format_fraction(simplify_fraction(v))
-
-def gen_frac_decimal_combo() -> Tuple[str, str]:
-    if random.choice([True, False]):
-        a = round(random.uniform(0.1, 9.9), 1)
-        den = random.randint(2, 12)
-        num = random.randint(1, den - 1)
-        op = random.choice(["+", "-", "×", "÷"])
-        val = eval(f"{a} { {'+':'+','-':'-','×':'*','÷':'/'}[op] } {num/den}")
-        return f"{a} {op} {num}/{den} =", f"{round(val, 3)}"
-    else:
-        den = random.randint(2, 12)
-        num = random.randint(1, den - 1)
-        a = round(random.uniform(0.1, 9.9), 2)
-        op = random.choice(["+", "-"])
-        val = eval(f"{num/den} { {'+':'+','-':'-'}[op] } {a}")
-        return f"{num}/{den} {op} {a} =", f"{round(val, 3)}"
-
-def gen_inverse_basic() -> Tuple[str, str]:
-    a = random.randint(2, 20)
-    b = random.randint(2, 20)
-    op = random.choice(["+", "-", "×", "÷"])
-    if op == "+":
-        x = b - a
-    elif op == "-":
-        x = b + a
-    elif op == "×":
-        x = b / a
-    else:
-        x = b * a
-    return f"□ {op} {a} = {b} の □ を求めよ。", f"{x}"
-
-def gen_prop_basic(hard: bool=False) -> Tuple[str, str]:
-    mode = random.choice(["比例", "反比例"])
-    if mode == "比例":
-        k = random.randint(1, 9)
-        x = random.randint(2, 20)
-        y = k * x
-        if hard:
-            return f"y = kx。x={x} のとき y={y}。k を求めよ。", f"{k}"
-        else:
-            return f"y = {k}x。x={x} のとき y は？", f"{y}"
-    else:
-        k = random.randint(10, 200)
-        x = random.randint(2, 20)
-        y = k / x
-        if hard:
-            return f"xy = k。x={x} のとき y={round(y,2)}。k を求めよ。", f"{round(k,2)}"
-        else:
-            return f"xy = {k}。x={x} のとき y は？", f"{round(y,2)}"
-
-# ------------------------------------------------------------------------------
-# カリキュラム → 実際のジェネレータにマッピング（安全版）
-# ------------------------------------------------------------------------------
-def generate_by_preset(grade: str, field: str, level: int, n: int) -> List[Dict]:
-    rows = []
-
-    def add(q, a, preset):
-        rows.append({"問題": q, "答え": a, "プリセット": preset})
-
-    preset = PRESET_TABLE[grade][field][level - 1]
-    for _ in range(n):
-        if grade == "小3" and field == "整数のたし算・ひき算":
-            digits = [2, 2, 3, 4, 5][level - 1]
-            terms = [2, 3, 3, 4, 5][level - 1]
-            q, a = generate_safe(lambda: gen_sum_diff(digits, terms), grade=grade, field=field, level=level)
-            add(q, a, preset)
-
-        elif grade == "小3" and field == "かけ算の筆算":
-            pairs = [(2,1),(3,1),(2,2),(3,2),(3,3)]
-            a_d, b_d = pairs[level - 1]
-            q, a = generate_safe(lambda: gen_mul(a_d, b_d), grade=grade, field=field, level=level)
-            add(q, a, preset)
-
-        elif grade == "小3" and field == "わり算（あまりあり）":
-            rngs = [(2,50),(10,200),(50,1000),(200,5000),(1000,20000)]
-            lo, hi = rngs[level - 1]
-            q, a = generate_safe(lambda: gen_div_with_remainder(lo, hi), grade=grade, field=field, level=level)
-            add(q, a, preset)
-
-        elif grade == "小4" and field == "大きな数と筆算":
-            if level in (1,2,3):
-                digits = [4,5,6][level - 1]
-                q, a = generate_safe(lambda: gen_large_sumdiff(digits), grade=grade, field=field, level=level)
-            else:
-                pairs = [(3,3),(4,4)]
-                q, a = generate_safe(lambda: gen_mul(*pairs[level - 4]), grade=grade, field=field, level=level)
-            add(q, a, preset)
-
-        elif grade == "小4" and field == "小数の四則":
-            if level == 1:
-                q, a = generate_safe(lambda: gen_decimal_addsub(1), grade=grade, field=field, level=level)
-            elif level == 2:
-                q, a = generate_safe(lambda: gen_decimal_addsub(2), grade=grade, field=field, level=level)
-            elif level == 3:
-                q, a = generate_safe(lambda: gen_decimal_muldiv(1), grade=grade, field=field, level=level)
-            elif level == 4:
-                q, a = generate_safe(lambda: gen_decimal_muldiv(2), grade=grade, field=field, level=level)
-            else:
-                def gen_mix():
-                    q1, a1 = gen_decimal_addsub(1)
-                    q2, a2 = gen_decimal_muldiv(1)
-                    q = q1.replace("=", "") + " と " + q2
-                    a = f"{a1} / {a2}"
-                    return q, a
-                q, a = generate_safe(gen_mix, grade=grade, field=field, level=level)
-            add(q, a, preset)
-
-        elif grade == "小4" and field == "約数・倍数（計算）":
-            if level == 1:
-                q, a = generate_safe(lambda: gen_gcd_range(30, 100, 2), grade=grade, field=field, level=level)
-            elif level == 2:
-                q, a = generate_safe(lambda: gen_gcd_range(50, 200, 2), grade=grade, field=field, level=level)
-            elif level == 3:
-                q, a = generate_safe(lambda: gen_gcd_range(10, 999, 2), grade=grade, field=field, level=level)
-            elif level == 4:
-                q, a = generate_safe(lambda: gen_lcm_range(10, 50, 3), grade=grade, field=field, level=level)
-            else:
-                q, a = generate_safe(lambda: gen_gcd_range(10, 200, 3), grade=grade, field=field, level=level)
-            add(q, a, preset)
-
-        elif grade == "小4" and field == "分数のたし算・ひき算":
-            if level == 1:
-                q, a = generate_safe(lambda: gen_fraction_addsub(1, 2), grade=grade, field=field, level=level)
-            elif level == 2:
-                q, a = generate_safe(lambda: gen_fraction_addsub(2, 2), grade=grade, field=field, level=level)
-            elif level == 3:
-                q, a = generate_safe(lambda: gen_fraction_addsub(1, 3), grade=grade, field=field, level=level)
-            elif level == 4:
-                q, a = generate_safe(lambda: gen_fraction_addsub(2, 3), grade=grade, field=field, level=level)
-            else:
-                def gen_story():
-                    q0, a0 = gen_fraction_addsub(1, 2)
-                    q = f"りんごの重さは {q0.replace(' =','')} とします。合計の重さは？"
-                    a = a0
-                    return q, a
-                q, a = generate_safe(gen_story, grade=grade, field=field, level=level)
-            add(q, a, preset)
-
-        elif grade == "小5" and field == "分数の四則混合":
-            terms = 2 if level == 1 else 3
-            q, a = generate_safe(lambda: gen_frac_mixed_ops(terms), grade=grade, field=field, level=level)
-            add(q, a, preset)
-
-        elif grade == "小5" and field == "小数×分数・分数×分数":
-            q, a = generate_safe(gen_fraction_mixed, grade=grade, field=field, level=level)
-            add(q, a, preset)
-
-        elif grade == "小5" and field == "割合の基本計算":
-            mode_map = {1: "of/up/down", 2: "of/up/down", 3: "reverse", 4: "chain", 5: "chain"}
-            m = mode_map[level]
-            if m == "of/up/down":
-                q, a = generate_safe(lambda: gen_percent_basic(random.choice(["of", "up", "down"])),
-                                     grade=grade, field=field, level=level)
-            else:
-                q, a = generate_safe(lambda: gen_percent_basic(m), grade=grade, field=field, level=level)
-            add(q, a, preset)
-
-        elif grade == "小5" and field == "比の基本計算":
-            hard = level >= 4
-            q, a = generate_safe(lambda: gen_ratio_basic(hard=hard), grade=grade, field=field, level=level)
-            add(q, a, preset)
-
-        elif grade == "小6" and field == "分数・小数の複合計算":
-            q, a = generate_safe(gen_frac_decimal_combo, grade=grade, field=field, level=level)
-            add(q, a, preset)
-
-        elif grade == "小6" and field == "逆算（□を求める）":
-            q, a = generate_safe(gen_inverse_basic, grade=grade, field=field, level=level)
-            add(q, a, preset)
-
-        elif grade == "小6" and field == "最大公約数・最小公倍数":
-            if level <= 3:
-                q, a = generate_safe(lambda: gen_gcd_range(10, 200, random.choice([2,3])),
-                                     grade=grade, field=field, level=level)
-            else:
-                q, a = generate_safe(lambda: gen_lcm_range(10, 60, random.choice([2,3])),
-                                     grade=grade, field=field, level=level)
-            add(q, a, preset)
-
-        elif grade == "小6" and field == "比例・反比例の基本計算":
-            hard = level >= 4
-            q, a = generate_safe(lambda: gen_prop_basic(hard=hard), grade=grade, field=field, level=level)
-            add(q, a, preset)
-
-    return rows
-
-# ------------------------------------------------------------------------------
-# 採点用：答えの正規化と比較
+# ページ設定
 # ------------------------------------------------------------------------------
-_DIV_EXPR_RE = re.compile(r"^\s*([-+]?\d+(?:\.\d+)?)\s*/\s*([-+]?\d+(?:\.\d+)?)\s*$")
-_FRAC_RE = re.compile(r"^\s*([-+]?\d+)\s*/\s*(\d+)\s*$")
-_RATIO_RE = re.compile(r"^\s*([-+]?\d+)\s*:\s*([-+]?\d+)\s*$")
-_REMAINDER_RE = re.compile(r"^\s*([-+]?\d+)\s*あまり\s*([-+]?\d+)\s*$")
-
-def _parse_number_like(s: str) -> Optional[float]:
-    try:
-        return float(s)
-    except Exception:
-        return None
-
-def _parse_fraction(s: str) -> Optional[fractions.Fraction]:
-    m = _FRAC_RE.match(s)
-    if not m:
-        return None
-    num = int(m.group(1)); den = int(m.group(2))
-    if den == 0:
-        return None
-    return fractions.Fraction(num, den)
-
-def _parse_ratio(s: str) -> Optional[Tuple[int, int]]:
-    m = _RATIO_RE.match(s)
-    if not m:
-        return None
-    a = int(m.group(1)); b = int(m.group(2))
-    if b == 0:
-        return None
-    g = math.gcd(a, b)
-    a //= g; b //= g
-    # 比は正に限定しているため負はここでは扱わない
-    return (a, b)
-
-def _parse_remainder(s: str) -> Optional[Tuple[int, int]]:
-    m = _REMAINDER_RE.match(s)
-    if not m:
-        return None
-    q = int(m.group(1)); r = int(m.group(2))
-    return (q, r)
-
-def compare_answers(expected: str, user: str, tol: float = 1e-6) -> bool:
-    es = str(expected).strip()
-    us = str(user).strip()
-    if us == "":
-        return False
-
-    # 余りつき
-    e_rem = _parse_remainder(es)
-    if e_rem is not None:
-        u_rem = _parse_remainder(us)
-        return (u_rem is not None) and (e_rem == u_rem)
-
-    # 比 a:b （ユーザは同値比OK）
-    e_ratio = _parse_ratio(es)
-    if e_ratio is not None:
-        u_ratio = _parse_ratio(us)
-        return (u_ratio is not None) and (e_ratio == u_ratio)
-
-    # 真分数（既約でなくてもOK）
-    e_frac = _parse_fraction(es)
-    if e_frac is not None:
-        u_frac = _parse_fraction(us)
-        if u_frac is not None:
-            return e_frac == u_frac
-        # 小数で答えてもOK
-        u_num = _parse_number_like(us)
-        if u_num is not None:
-            return abs(float(e_frac) - u_num) <= tol
-        return False
-
-    # 「x / y」式（小数の四則レベル5）→ 数値比較も許容
-    m = _DIV_EXPR_RE.match(es)
-    if m:
-        ex = float(m.group(1)) / float(m.group(2))
-        # ユーザーが式で入れてきたら評価、数値でもOK
-        mu = _DIV_EXPR_RE.match(us)
-        if mu:
-            ux = float(mu.group(1)) / float(mu.group(2))
-            return abs(ex - ux) <= tol
-        u_num = _parse_number_like(us)
-        return (u_num is not None) and (abs(ex - u_num) <= tol)
-
-    # ふつうの数値（整数・小数）
-    e_num = _parse_number_like(es)
-    if e_num is not None:
-        u_num = _parse_number_like(us)
-        if u_num is None:
-            # ユーザが a/b で入れた場合も許容
-            u_frac = _parse_fraction(us)
-            if u_frac is not None:
-                u_num = float(u_frac)
-        return (u_num is not None) and (abs(e_num - u_num) <= tol)
-
-    # それ以外は完全一致で比較（ほぼ到達しない）
-    return es == us
+st.set_page_config(page_title="算数ドリルジェネレータ", page_icon="🧮", layout="wide")
 
 # ------------------------------------------------------------------------------
 # UI
@@ -726,97 +70,267 @@ with st.sidebar:
     seed = st.number_input("乱数シード（再現用）", min_value=0, max_value=10_000_000, value=default_seed, step=1)
     go = st.button("🧪 生成する", type="primary")
 
+    # クラス一括：1 人ずつシードをずらした同じプリセットのプリントをまとめて作る
+    with st.expander("👥 クラス一括作成"):
+        roster_text = st.text_area("名簿（1 行 1 名。空なら人数分を番号で作る）", key="bundle_roster")
+        bundle_count = st.number_input("人数", min_value=1, max_value=200, value=40, step=1, key="bundle_count")
+        bundle_fmt = st.radio("出力形式", ["PDF（全員分を 1 ファイル）", "ZIP（1 人 1 ファイル）"], key="bundle_fmt")
+        st.caption("出席番号 k の人のシードは「乱数シード + k - 1」である。")
+        bundle_go = st.button("📚 名簿分を作成する")
+
+# フォントの探索はプロセスで一度だけ。解析（fpdf の import を含む）は PDF 用のスレッドで始めておき、
+# 最初の表示を待たせない（以降の PDF 生成はキャッシュを使う）
 detected_font = find_japanese_font()
+warm_font_cache_async()
 if detected_font:
     st.caption(f"📄 検出フォント: {detected_font}")
 else:
     st.warning("PDFで日本語を表示するには、日本語フォント（例: assets/NotoSansJP-Regular.ttf）を配置すべきである。現状は '?' 置換のフォールバックである。")
 
-# クエリ反映
-try:
-    st.query_params.update({
-        "grade": grade,
-        "field": field,
-        "level": str(level),
-        "n": str(n),
-        "seed": str(seed),
-    })
-except Exception:
-    pass
+# クエリ反映（変わったときだけ書く。同じ値でも書くとブラウザへの更新が毎回送られる）
+wanted_qp = {"grade": grade, "field": field, "level": str(level), "n": str(n), "seed": str(seed)}
+if any(qp_str(k, "") != v for k, v in wanted_qp.items()):
+    try:
+        st.query_params.update(wanted_qp)
+    except Exception:
+        pass
 
 # 生成処理
+# 各段階の所要時間は metrics に記録する（キャッシュから返った場合も含めた、利用者が待つ時間）
+labels = {"grade": grade, "field": field, "level": level, "n": n}
 if go:
-    random.seed(seed)
-    rows = generate_by_preset(grade, field, level, n)
-    df = pd.DataFrame(rows, columns=["問題", "答え", "プリセット"])
-
-    # セッションに保持（採点に使用）
-    st.session_state["problems_df"] = df
+    # 同じ条件の問題集・CSV・PDF はプロセス全体のキャッシュから返す
+    try:
+        with timed("rows", **labels):
+            pset = cached_set(grade, field, level, n, seed)
+    except ProblemSpaceExhausted as e:
+        st.error(f"この難度では異なる問題をこれ以上作れない。出題数を減らすべきである。（{e}）")
+        st.stop()
+    # 表は問題集の列をそのまま指す Arrow の表で渡す（DataFrame に写さない）
+    with timed("dataframe", **labels):
+        table = pset.to_arrow(values=False)
+
+    # セッションには出題条件だけを持つ（問題集はこの条件からいつでも作り直せる）
     st.session_state["meta"] = {
         "grade": grade, "field": field, "level": level, "n": n, "seed": seed
     }
 
     st.subheader("出題結果")
-    st.dataframe(df, use_container_width=True)
+    with timed("table", **labels):
+        st.dataframe(table, use_container_width=True)
 
     # CSV
-    csv = df.to_csv(index=False).encode("utf-8-sig")
-    st.download_button("📥 CSVをダウンロード", data=csv, file_name="problems.csv", mime="text/csv")
-
-    # PDF
-    header_meta = {
-        "学年": grade,
-        "分野": field,
-        "難度": f"レベル{level}（{PRESET_TABLE[grade][field][level-1]}）",
-        "出題数": str(n),
-        "乱数シード": str(seed),
-    }
-    pdf_bytes = build_pdf(
-        title="算数ドリル",
-        header_meta=header_meta,
-        problems=[{"question": r["問題"], "answer": r["答え"], "meta": r["プリセット"]} for _, r in df.iterrows()],
-    )
-    st.download_button("📄 PDFをダウンロード", data=pdf_bytes, file_name="drill.pdf", mime="application/pdf")
+    with timed("csv", **labels):
+        csv = cached_csv(grade, field, level, n, seed)
+        st.download_button("📥 CSVをダウンロード", data=csv, file_name="problems.csv", mime="text/csv")
+
+    # PDF はバックグラウンドで作り始め、ボタンはできあがるまで無効にしておく
+    # （演習欄などを先に描画し、スクリプトの最後で完成を待って差し替える）
+    pdf_job = submit_pdf(grade, field, level, n, seed)
+    pdf_slot = st.empty()
+    if not pdf_job.done():
+        pdf_slot.button("📄 PDFを準備中…", disabled=True, key="pdf_pending")
 
 # --------------------------- アプリ内演習（採点付き） ---------------------------
+# 入力欄はフォームにまとめ、打鍵ごとの再実行をなくす（送信ボタンを押したときだけ再実行）。
+# 問題数が多いときはページに分け、表示中のページの入力欄だけを作る。
+# 入力は送信のたびに session_state["answers"]（問題番号 -> 解答）へ写しておく
+# （表示していないページの入力欄の状態は Streamlit が消すため）。
+# 問題集はセッションに持たず、出題条件 session_state["meta"] からプロセス全体のキャッシュ
+# （result_cache.SET_CACHE。件数と大きさに上限がある）を引いて毎回取り出す。
+# セッションごとのメモリは出題数によらず、条件と解答の分だけになる。
+#
+# 採点は 1 問ずつの結果を session_state["graded"]（問題番号 -> (判定した解答, 正誤)）に残し、
+# 前回の採点から解答が変わった問題だけを判定し直す（判定そのものも compare_answers がプロセス全体で覚えている）。
+# 判定はボタンと入力欄のコールバックで行うので、結果はその再実行の描画にすぐ出る。
 st.markdown("## 📝 アプリ内演習")
-problems_df: Optional[pd.DataFrame] = st.session_state.get("problems_df")
 
-if problems_df is None or problems_df.empty:
+def session_problem_set() -> Optional[ProblemSet]:
+    meta = st.session_state.get("meta")
+    if not meta:
+        return None
+    try:
+        return cached_set(meta["grade"], meta["field"], meta["level"], meta["n"], meta["seed"])
+    except (KeyError, ProblemSpaceExhausted):
+        # 古い形式の条件や、その後に作れなくなった条件（バンクの差し替えなど）は捨てる
+        st.session_state.pop("meta", None)
+        return None
+
+def save_answers(lo: int, hi: int) -> None:
+    # 表示中のページの入力欄の値を answers に写す
+    answers = st.session_state.setdefault("answers", {})
+    for i in range(lo, hi):
+        if f"ans_{i}" in st.session_state:
+            answers[i] = st.session_state[f"ans_{i}"]
+
+def grade_items(pset: ProblemSet, indices: range, ex_labels: dict) -> None:
+    """indices のうち、前回の採点から解答が変わった問題だけを判定し直して graded に残す。"""
+    answers = st.session_state.get("answers", {})
+    graded = st.session_state.setdefault("graded", {})
+    values = pset.values
+    with timed("grade", **ex_labels):
+        for i in indices:
+            user = answers.get(i, "")
+            prev = graded.get(i)
+            if prev is None or prev[0] != user:
+                graded[i] = (user, compare_answers(values[i], user))
+
+def on_submit(action: str, pset: ProblemSet, lo: int, hi: int, ex_labels: dict) -> None:
+    # どのボタンで送信しても、表示中のページの解答を保存する
+    save_answers(lo, hi)
+    if action in ("prev", "next"):
+        st.session_state["ex_page"] = st.session_state.get("ex_page", 0) + (1 if action == "next" else -1)
+    else:
+        grade_items(pset, range(len(pset)), ex_labels)
+        st.session_state["show_score"] = True
+
+def on_answer(i: int, pset: ProblemSet, ex_labels: dict) -> None:
+    # その場で判定するとき：入力欄を確定するたびに、その 1 問だけを判定する
+    save_answers(i, i + 1)
+    grade_items(pset, range(i, i + 1), ex_labels)
+
+if go:
+    # 新しい問題集になったら、前の解答・採点結果・ページ位置・入力欄の状態（ans_*）は捨てる
+    # （残すと、出題数を減らしたときに使われない入力欄の値がセッションに残り、
+    # 同じ番号の入力欄には前の問題集の解答が出てしまう）
+    st.session_state["answers"] = {}
+    st.session_state["graded"] = {}
+    st.session_state["ex_page"] = 0
+    st.session_state.pop("show_score", None)
+    for key in [k for k in st.session_state if isinstance(k, str) and k.startswith("ans_")]:
+        del st.session_state[key]
+
+pset = session_problem_set()
+
+if pset is None or len(pset) == 0:
     st.info("左のサイドバーで条件を選んで「生成する」を押すと、ここに演習が表示される。")
 else:
-    # 入力欄の描画
-    user_inputs = {}
+    # 演習と採点は、いまのサイドバーの値ではなく出題したときの条件で記録する
+    meta = st.session_state.get("meta", {})
+    ex_labels = {k: meta[k] for k in ("grade", "field", "level", "n") if k in meta}
+    t_exercise = time.perf_counter()
+    answers = st.session_state.setdefault("answers", {})
+    graded = st.session_state.setdefault("graded", {})
+    total = len(pset)
+    pages = (total + EXERCISE_PAGE_SIZE - 1) // EXERCISE_PAGE_SIZE
+    page = min(max(st.session_state.get("ex_page", 0), 0), pages - 1)
+    lo, hi = page * EXERCISE_PAGE_SIZE, min(total, (page + 1) * EXERCISE_PAGE_SIZE)
+
     show_answers = st.checkbox("模範解答を表示する（採点結果と併せて）", value=False)
+    instant = st.checkbox("1 問ずつその場で判定する（入力欄で Enter を押すたびに判定する）", value=False,
+                          key="instant_grading")
     st.caption("※ 分数は `a/b`、余りつきは `q あまり r`、比は `a:b` で入力する。小数の丸め誤差は自動で吸収する。")
 
-    for i, row in problems_df.reset_index(drop=True).iterrows():
-        st.markdown(f"**Q{i+1}. {row['問題']}**")
-        user_inputs[i] = st.text_input("あなたの解答", key=f"ans_{i}", label_visibility="collapsed")
-        if show_answers:
-            st.caption(f"模範解答: {row['答え']}")
-        st.divider()
-
-    if st.button("✅ 全問採点"):
-        results = []
-        correct_count = 0
-        for i, row in problems_df.reset_index(drop=True).iterrows():
-            ok = compare_answers(str(row["答え"]), user_inputs.get(i, ""))
-            results.append("◯" if ok else "✕")
-            if ok:
-                correct_count += 1
-
-        score_col1, score_col2 = st.columns([1, 3])
-        with score_col1:
-            st.metric(label="正答数", value=f"{correct_count} / {len(problems_df)}")
-        with score_col2:
-            st.progress(correct_count / max(1, len(problems_df)))
-
-        # 詳細結果
-        out = problems_df.copy()
-        out.insert(0, "採点", results)
-        out.insert(2, "あなたの解答", [user_inputs.get(i, "") for i in range(len(problems_df))])
-        st.dataframe(out, use_container_width=True)
-    
-    # go=False でまだ生成していない場合
-    pass
+    # その場で判定するときはフォームを使わない（入力欄のコールバックはフォームの中では使えない）
+    if instant:
+        box = st.container()
+        submit = lambda col, label, action, **kw: col.button(
+            label, on_click=on_submit, args=(action, pset, lo, hi, ex_labels), **kw)
+    else:
+        box = st.form("exercise_form")
+        submit = lambda col, label, action, **kw: col.form_submit_button(
+            label, on_click=on_submit, args=(action, pset, lo, hi, ex_labels), **kw)
+
+    questions = pset.questions
+    expected_strs = pset.answers
+    with box:
+        if pages > 1:
+            st.caption(f"ページ {page + 1} / {pages}（Q{lo + 1}〜Q{hi}）")
+        for i in range(lo, hi):
+            st.markdown(f"**Q{i+1}. {questions[i]}**")
+            callback = {"on_change": on_answer, "args": (i, pset, ex_labels)} if instant else {}
+            st.text_input("あなたの解答", value=answers.get(i, ""), key=f"ans_{i}", label_visibility="collapsed",
+                          **callback)
+            # 判定したときから解答が変わっていなければ、その問題の正誤を出す
+            result = graded.get(i)
+            if result is not None and result[0] == answers.get(i, ""):
+                st.caption("◯ 正解" if result[1] else "✕ 不正解")
+            if show_answers:
+                st.caption(f"模範解答: {expected_strs[i]}")
+            st.divider()
+        cols = st.columns(3)
+        submit(cols[0], "◀ 前のページ", "prev", disabled=page == 0)
+        submit(cols[1], "次のページ ▶", "next", disabled=page >= pages - 1)
+        submit(cols[2], "✅ 全問採点", "grade", type="primary")
+    observe("exercise", time.perf_counter() - t_exercise, **ex_labels)
+
+    # 全問採点を押した直後は、graded に残した 1 問ずつの結果から得点と一覧を作る（判定し直さない）
+    if st.session_state.pop("show_score", False):
+        user_inputs = [graded[i][0] for i in range(total)]
+        results = ["◯" if graded[i][1] else "✕" for i in range(total)]
+        correct_count = results.count("◯")
+
+        with timed("grade_table", **ex_labels):
+            score_col1, score_col2 = st.columns([1, 3])
+            with score_col1:
+                st.metric(label="正答数", value=f"{correct_count} / {total}")
+            with score_col2:
+                st.progress(correct_count / max(1, total))
+
+            # 詳細結果
+            import pyarrow as pa
+
+            out = pset.to_arrow(values=False)
+            out = out.add_column(0, "採点", pa.array(results)).add_column(2, "あなたの解答", pa.array(user_inputs))
+            st.dataframe(out, use_container_width=True)
+
+# クラス一括作成（プロセスプールで全員分を描画する）。作るのはボタンを押した回だけ
+# セッションには条件（形式・名簿・プリセット）だけを持ち、PDF / ZIP はプロセス全体のキャッシュから取り出す
+if bundle_go:
+    from bundle import make_roster, read_roster
+
+    names = read_roster(roster_text)
+    roster = make_roster(seed, names=names) if names else make_roster(seed, count=bundle_count)
+    spec = {"fmt": "zip" if bundle_fmt.startswith("ZIP") else "pdf", "roster": tuple(roster),
+            "grade": grade, "field": field, "level": level, "n": n}
+    st.session_state.pop("bundle", None)
+    try:
+        with st.spinner(f"{len(roster)} 人分を作成中…"), timed("bundle", **labels):
+            cached_bundle(spec["fmt"], spec["roster"], grade, field, level, n)
+        st.session_state["bundle"] = spec
+    except ProblemSpaceExhausted as e:
+        st.error(f"この難度では異なる問題をこれ以上作れない。出題数を減らすべきである。（{e}）")
+
+if "bundle" in st.session_state:
+    spec = st.session_state["bundle"]
+    fmt = spec["fmt"]
+    # ほかの操作での再実行では作り直さない。キャッシュから捨てられていたら条件も捨てる
+    data = peek_bundle(fmt, spec["roster"], spec["grade"], spec["field"], spec["level"], spec["n"])
+    with st.sidebar:
+        if data is None:
+            st.session_state.pop("bundle", None)
+            st.info("クラス一括の保存期間が過ぎた。もう一度「📚 名簿分を作成する」を押すべきである。")
+        else:
+            st.download_button("📦 クラス一括をダウンロード", data=data, file_name=f"class.{fmt}",
+                               mime="application/zip" if fmt == "zip" else "application/pdf")
+
+# PDF ができたらダウンロードボタンを有効にする（ページの他の部分はもう表示済み）
+if go:
+    with timed("pdf_wait", **labels):
+        pdf = pdf_job.result()
+    pdf_slot.download_button("📄 PDFをダウンロード", data=pdf, file_name="drill.pdf", mime="application/pdf")
+
+# プロファイル（管理者用。URL の profile= が DRILL_ADMIN_TOKEN と一致したときだけ）
+# 同じ条件の生成・CSV・PDF をキャッシュを通さずにもう一度実行して測る。profile_mode=collapsed でサンプリング
+if go and admin_token_ok(qp_str("profile", "")):
+    mode = qp_str("profile_mode", "pstats")
+    if mode not in PROFILE_MODES:
+        mode = "pstats"
+    with st.spinner("プロファイル中…"):
+        prof = profile_request(grade, field, level, n, seed, mode=mode)
+    with st.expander(f"⏱ プロファイル（{mode}、{prof.runs} 回、{prof.seconds * 1000:.0f} ms）"):
+        st.code(prof.summary)
+        st.download_button("⏱ プロファイルをダウンロード", data=prof.data, file_name=prof.file_name, mime=prof.mime)
+
+# 診断（URL に ?diag=1 を付けたときだけ）：段階ごとの処理時間の分位点とキャッシュの状態
+if qp_str("diag", "") == "1":
+    with st.sidebar.expander("🩺 診断（段階別の処理時間）", expanded=True):
+        stage_rows = summary()
+        if stage_rows:
+            st.dataframe(stage_rows, use_container_width=True, hide_index=True)
+        else:
+            st.caption("まだ記録がない。")
+        st.json(cache_stats(), expanded=False)
+
+# DRILL_METRICS_FILE が設定されていれば Prometheus 形式で書き出す（一定間隔ごと）
+maybe_write_metrics_file()
@@ -0,0 +1,394 @@
+# bank.py
+# -*- coding: utf-8 -*-
+"""
+プリセットごとの問題バンク（事前生成した問題を列ごとに詰めたファイル）。
+
+よく使われるプリセットは、異なる問題を大量にオフラインで一度だけ作り
+（GENERATOR_VERSION ごと）、ファイルに保存しておく。配信時は生成せず、
+シードで決まる番号の並び（engine.sample_order）でバンクから問題を取り出す。
+ファイルは mmap で読み取り専用に開くので、複数のサーバプロセスが
+同じページ（OS のページキャッシュ）を共有し、プロセスごとに複製を持たない。
+
+ファイル形式（数値はリトルエンディアン）:
+    b"DRLBANK1" | ヘッダ長 (uint32) | ヘッダ JSON（8 バイト境界まで空白で埋める）
+    | 列ごとに: オフセット (uint64 × (件数+1)) と UTF-8 の連結文字列（8 バイト境界まで 0 で埋める）
+    | 答えの値の型の番号 (uint8 × 件数、engine.ANSWER_KINDS の添字。8 バイト境界まで 0 で埋める)
+列は "問題" と "答え"。答えの値は表示文字列と型の番号から decode_answer で戻す
+（表示だけでは 2 問セットの「26 / 6」と分数の区別がつかないため）。
+
+配信モードは環境変数 DRILL_BANK_DIR にバンクのディレクトリを指定すると有効になる。
+バンクのないプリセット・版の合わないバンクは、これまでどおり generate_by_preset で作る。
+
+例:
+    python bank.py build --all --size 20000 --dir banks
+    python bank.py build --grade 小3 --field かけ算の筆算 --level 1 --dir banks
+    python bank.py verify --dir banks --full
+    python bank.py list --dir banks
+"""
+
+import argparse
+import functools
+import itertools
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from engine import (
+    ANSWER_KINDS,
+    GENERATOR_VERSION,
+    PRESET_REGISTRY,
+    AnswerPair,
+    ProblemSpaceExhausted,
+    answer_is_negative,
+    answer_kind,
+    decode_answer,
+    generate_by_preset,
+    generate_distinct,
+    generate_results,
+    iter_by_preset,
+    iter_sample_order,
+    resolve_preset,
+    sample_order,
+)
+from problemset import ProblemSet, TextColumn
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"DRLBANK1"
+FORMAT = 2
+COLUMNS = ("問題", "答え")
+DEFAULT_SIZE = 20000
+BANK_SEED = 0
+
+# ------------------------------------------------------------------------------
+# 書き込み
+# ------------------------------------------------------------------------------
+def bank_filename(grade: str, field: str, level: int) -> str:
+    return f"v{GENERATOR_VERSION}/{grade}-{field}-{level}.bank"
+
+def _pad8(n: int) -> int:
+    return -n % 8
+
+def write_bank(path: str, grade: str, field: str, level: int, rows: List[Dict], *, seed: int = BANK_SEED) -> None:
+    columns = {}
+    body = bytearray()
+    for col in COLUMNS:
+        encoded = [r[col].encode("utf-8") for r in rows]
+        offsets = np.zeros(len(encoded) + 1, dtype="<u8")
+        offsets[1:] = np.cumsum([len(b) for b in encoded])
+        blob = b"".join(encoded)
+        columns[col] = {"offsets": len(body), "data": len(body) + offsets.nbytes, "data_len": len(blob)}
+        body += offsets.tobytes() + blob + b"\0" * _pad8(len(blob))
+    kinds = np.array([answer_kind(r["値"]) for r in rows], dtype=np.uint8)
+    kinds_at = len(body)
+    body += kinds.tobytes() + b"\0" * _pad8(kinds.nbytes)
+
+    plan = resolve_preset(grade, field, level)
+    header = {
+        "format": FORMAT,
+        "generator_version": GENERATOR_VERSION,
+        "grade": grade, "field": field, "level": level, "label": plan.label,
+        "count": len(rows),
+        "seed": seed,
+        "columns": columns,
+        "kinds": kinds_at,
+        "sha256": hashlib.sha256(body).hexdigest(),
+    }
+    raw = json.dumps(header, ensure_ascii=False).encode("utf-8")
+    prefix_len = len(MAGIC) + 4 + len(raw)
+    raw += b" " * _pad8(prefix_len)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(MAGIC + struct.pack("<I", len(raw)) + raw + bytes(body))
+    # 配信中のプロセスが読みかけのファイルを見ないよう、書き終えてから置き換える
+    os.replace(tmp, path)
+
+def build_bank(grade: str, field: str, level: int, bank_dir: str, size: int = DEFAULT_SIZE,
+               seed: int = BANK_SEED) -> Tuple[str, int]:
+    """異なる問題を最大 size 問作ってバンクに書き、(パス, 件数) を返す。"""
+    rows = generate_distinct(grade, field, level, size, seed)
+    path = os.path.join(bank_dir, bank_filename(grade, field, level))
+    write_bank(path, grade, field, level, rows, seed=seed)
+    return path, len(rows)
+
+# ------------------------------------------------------------------------------
+# 読み込み
+# ------------------------------------------------------------------------------
+class ProblemBank:
+    """バンクファイルを mmap で開いたもの（オフセット列は同じ領域を指す NumPy 配列）。"""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"not a problem bank: {path}")
+        (header_len,) = struct.unpack("<I", self._mm[len(MAGIC):len(MAGIC) + 4])
+        base = len(MAGIC) + 4
+        self.meta = json.loads(self._mm[base:base + header_len].decode("utf-8"))
+        if self.meta.get("format") != FORMAT:
+            raise ValueError(f"unsupported bank format {self.meta.get('format')} (expected {FORMAT}): {path}")
+        self._body = base + header_len
+        self.count: int = self.meta["count"]
+        self._columns = {}
+        for col, spec in self.meta["columns"].items():
+            offsets = np.frombuffer(self._mm, dtype="<u8", count=self.count + 1, offset=self._body + spec["offsets"])
+            self._columns[col] = (offsets, self._body + spec["data"])
+        self._kinds = np.frombuffer(self._mm, dtype=np.uint8, count=self.count, offset=self._body + self.meta["kinds"])
+
+    @property
+    def key(self) -> Tuple[str, str, int]:
+        return self.meta["grade"], self.meta["field"], self.meta["level"]
+
+    def texts(self, col: str, indices: List[int]) -> List[str]:
+        offsets, data = self._columns[col]
+        idx = np.asarray(indices, dtype=np.int64)
+        mm = self._mm
+        return [mm[data + s:data + e].decode("utf-8")
+                for s, e in zip(offsets[idx].tolist(), offsets[idx + 1].tolist())]
+
+    def text(self, col: str, i: int) -> str:
+        return self.texts(col, [i])[0]
+
+    def rows(self, indices: List[int]) -> List[Dict]:
+        label = self.meta["label"]
+        kinds = self._kinds[np.asarray(indices, dtype=np.int64)].tolist()
+        return [{"問題": q, "答え": a, "プリセット": label, "値": decode_answer(a, k)}
+                for q, a, k in zip(self.texts("問題", indices), self.texts("答え", indices), kinds)]
+
+    def row(self, i: int) -> Dict:
+        return self.rows([i])[0]
+
+    def column(self, col: str, indices: List[int]) -> TextColumn:
+        """indices の順に並べた列を、文字列に戻さずに UTF-8 のまま切り出す。"""
+        offsets, data = self._columns[col]
+        idx = np.asarray(indices, dtype=np.int64)
+        starts, ends = offsets[idx].astype(np.int64), offsets[idx + 1].astype(np.int64)
+        out = np.zeros(len(idx) + 1, dtype=np.int64)
+        np.cumsum(ends - starts, out=out[1:])
+        mm = self._mm
+        return TextColumn(out, b"".join([mm[data + s:data + e] for s, e in zip(starts.tolist(), ends.tolist())]))
+
+    def sample(self, n: int, seed: int, start: int = 0) -> List[Dict]:
+        """シードで決まる並びの start 番目から n 問（重複なし。問題 k は n によらない）。"""
+        if start + n > self.count:
+            grade, field, level = self.key
+            raise ProblemSpaceExhausted(
+                f"{grade}/{field}/level {level}: bank has only {self.count} problems, {start + n} requested")
+        return self.rows(sample_order(self.count, seed, start + n)[start:])
+
+    def sample_set(self, n: int, seed: int, start: int = 0) -> ProblemSet:
+        """sample と同じ問題の ProblemSet（答えの値は採点で使うときに読む）。"""
+        if start + n > self.count:
+            self.sample(n, seed, start)   # 件数不足の例外を同じ文面で出す
+        indices = sample_order(self.count, seed, start + n)[start:]
+        grade, field, level = self.key
+        return ProblemSet(grade, field, level, seed, self.meta["label"], self.column("問題", indices),
+                          self.column("答え", indices), start=start,
+                          kinds=self._kinds[np.asarray(indices, dtype=np.int64)])
+
+    def iter_sample(self, seed: int, start: int = 0, n: Optional[int] = None,
+                    chunk_size: int = 1000) -> Iterator[Dict]:
+        """sample と同じ並びを 1 問ずつ返す（n=None ならバンクの最後まで）。"""
+        stop = self.count if n is None else start + n
+        if stop > self.count:
+            self.sample(stop - start, seed, start)   # 件数不足の例外を同じ文面で出す
+        order = itertools.islice(iter_sample_order(self.count, seed), start, stop)
+        while True:
+            indices = list(itertools.islice(order, chunk_size))
+            if not indices:
+                return
+            yield from self.rows(indices)
+
+    def body_sha256(self) -> str:
+        return hashlib.sha256(memoryview(self._mm)[self._body:]).hexdigest()
+
+# ------------------------------------------------------------------------------
+# 配信
+# ------------------------------------------------------------------------------
+BANK_DIR = os.environ.get("DRILL_BANK_DIR") or None
+
+@functools.lru_cache(maxsize=None)
+def open_bank(grade: str, field: str, level: int, bank_dir: Optional[str] = None) -> Optional[ProblemBank]:
+    """配信に使えるバンクを開く（プロセスで一度だけ）。なければ None。"""
+    bank_dir = bank_dir or BANK_DIR
+    if not bank_dir:
+        return None
+    path = os.path.join(bank_dir, bank_filename(grade, field, level))
+    if not os.path.exists(path):
+        return None
+    try:
+        bank = ProblemBank(path)
+    except (OSError, ValueError) as e:
+        logger.warning("problem bank %s is unreadable: %s", path, e)
+        return None
+    if bank.meta.get("generator_version") != GENERATOR_VERSION or bank.key != (grade, field, level):
+        logger.warning("problem bank %s does not match generator version %d", path, GENERATOR_VERSION)
+        return None
+    return bank
+
+def source_id(grade: str, field: str, level: int) -> str:
+    """問題の出どころ（キャッシュのキー用）。バンクならその中身のハッシュ、なければ "gen"。"""
+    bank = open_bank(grade, field, level)
+    return bank.meta["sha256"][:16] if bank is not None else "gen"
+
+def problem_count(grade: str, field: str, level: int) -> Optional[int]:
+    """1 つのシードで出せる異なる問題の数（バンクならその件数）。数えられなければ None。"""
+    bank = open_bank(grade, field, level)
+    if bank is not None:
+        return bank.count
+    space = resolve_preset(grade, field, level).space
+    return space.size if space is not None else None
+
+def generate_rows(grade: str, field: str, level: int, n: int, seed: int = 0, start: int = 0) -> List[Dict]:
+    """バンクがあればバンクから、なければ generate_by_preset で start 番目から n 問を返す。"""
+    bank = open_bank(grade, field, level)
+    if bank is not None:
+        return bank.sample(n, seed, start)
+    return generate_by_preset(grade, field, level, n, seed, start)
+
+def generate_set(grade: str, field: str, level: int, n: int, seed: int = 0, start: int = 0) -> ProblemSet:
+    """generate_rows と同じ問題を ProblemSet で返す（行の辞書を作らない）。"""
+    bank = open_bank(grade, field, level)
+    if bank is not None:
+        return bank.sample_set(n, seed, start)
+    return ProblemSet.from_results(grade, field, level, seed, resolve_preset(grade, field, level).label,
+                                   generate_results(grade, field, level, n, seed, start), start)
+
+def iter_rows(grade: str, field: str, level: int, seed: int = 0, start: int = 0,
+              n: Optional[int] = None) -> Iterator[Dict]:
+    """generate_rows と同じ問題列を 1 問ずつ返す（大量出題のストリーミング出力用）。"""
+    bank = open_bank(grade, field, level)
+    if bank is not None:
+        return bank.iter_sample(seed, start, n)
+    return iter_by_preset(grade, field, level, seed, start, n)
+
+# ------------------------------------------------------------------------------
+# 検証
+# ------------------------------------------------------------------------------
+def verify_bank(path: str, *, full: bool = False) -> List[str]:
+    """バンクの不整合を文字列のリストで返す（空なら問題なし）。full なら作り直して全件照合する。"""
+    try:
+        bank = ProblemBank(path)
+    except (OSError, ValueError, KeyError) as e:
+        return [f"unreadable: {e}"]
+    errors = []
+    meta = bank.meta
+    if meta.get("generator_version") != GENERATOR_VERSION:
+        errors.append(f"generator_version {meta.get('generator_version')} != {GENERATOR_VERSION}")
+    if bank.body_sha256() != meta["sha256"]:
+        errors.append("checksum mismatch")
+        return errors
+    grade, field, level = bank.key
+    if (grade, field, level) not in PRESET_REGISTRY:
+        return errors + [f"unknown preset {grade}/{field}/{level}"]
+    for col in COLUMNS:
+        offsets, _ = bank._columns[col]
+        if offsets[0] != 0 or np.any(np.diff(offsets.astype(np.int64)) < 0) \
+                or int(offsets[-1]) != meta["columns"][col]["data_len"]:
+            errors.append(f"column {col}: bad offsets")
+    if np.any(bank._kinds >= len(ANSWER_KINDS)):
+        errors.append("bad answer kinds")
+    if errors:
+        return errors
+
+    seen = set()
+    rows = bank.rows(range(bank.count))
+    for i, row in enumerate(rows):
+        if row["問題"] in seen:
+            errors.append(f"#{i}: duplicate question {row['問題']!r}")
+        seen.add(row["問題"])
+        if row["値"] is None:
+            errors.append(f"#{i}: unparsable answer {row['答え']!r}")
+        elif answer_is_negative(row["値"]):
+            errors.append(f"#{i}: negative answer {row['答え']!r}")
+    if full:
+        expected = generate_distinct(grade, field, level, bank.count, meta["seed"])
+        if len(expected) != bank.count:
+            errors.append(f"regenerated {len(expected)} problems, bank has {bank.count}")
+        for i, (r, row) in enumerate(zip(expected, rows)):
+            if (r["問題"], r["答え"]) != (row["問題"], row["答え"]):
+                errors.append(f"#{i}: differs from regenerated problem")
+                break
+            if not _same_value(r["値"], row["値"]):
+                errors.append(f"#{i}: answer value {row['値']!r} differs from regenerated {r['値']!r}")
+    return errors
+
+def _same_value(a, b) -> bool:
+    # 型まで同じか（2 問セットは各問の型も）。Fraction(26, 6) と AnswerPair(26, 6) などを区別する
+    if type(a) is not type(b):
+        return False
+    if type(a) is AnswerPair:
+        return all(map(_same_value, a, b))
+    return a == b
+
+# ------------------------------------------------------------------------------
+# CLI
+# ------------------------------------------------------------------------------
+def _select(args: argparse.Namespace, ap: argparse.ArgumentParser) -> List[Tuple[str, str, int]]:
+    if args.all:
+        return list(PRESET_REGISTRY)
+    if not (args.grade and args.field):
+        ap.error("--grade and --field (or --all) are required")
+    levels = [args.level] if args.level else range(1, 6)
+    keys = [(args.grade, args.field, lv) for lv in levels]
+    for k in keys:
+        if k not in PRESET_REGISTRY:
+            ap.error(f"unknown preset: {k}")
+    return keys
+
+def _bank_paths(bank_dir: str) -> List[str]:
+    root = os.path.join(bank_dir, f"v{GENERATOR_VERSION}")
+    if not os.path.isdir(root):
+        return []
+    return sorted(os.path.join(root, f) for f in os.listdir(root) if f.endswith(".bank"))
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="問題バンクの作成・検証")
+    sub = ap.add_subparsers(dest="command", required=True)
+    b = sub.add_parser("build", help="バンクを作る")
+    b.add_argument("--grade")
+    b.add_argument("--field")
+    b.add_argument("--level", type=int, help="省略時は難度 1〜5 すべて")
+    b.add_argument("--all", action="store_true", help="全プリセット")
+    b.add_argument("--size", type=int, default=DEFAULT_SIZE, help="1 バンクあたりの最大問題数")
+    b.add_argument("--seed", type=int, default=BANK_SEED)
+    b.add_argument("--dir", default="banks")
+    v = sub.add_parser("verify", help="バンクを検証する")
+    v.add_argument("--dir", default="banks")
+    v.add_argument("--full", action="store_true", help="作り直して全件照合する")
+    ls = sub.add_parser("list", help="バンクの一覧")
+    ls.add_argument("--dir", default="banks")
+    args = ap.parse_args(argv)
+
+    if args.command == "build":
+        for grade, field, level in _select(args, ap):
+            path, count = build_bank(grade, field, level, args.dir, args.size, args.seed)
+            note = "" if count == args.size else f" (space exhausted at {count})"
+            print(f"{path}\t{count}{note}", file=sys.stderr)
+        return 0
+    paths = _bank_paths(args.dir)
+    if args.command == "list":
+        for path in paths:
+            bank = ProblemBank(path)
+            print(f"{path}\t{bank.meta['label']}\t{bank.count}\t{bank.meta['sha256'][:16]}")
+        return 0
+    failed = 0
+    for path in paths:
+        errors = verify_bank(path, full=args.full)
+        print(f"{path}\t{'ok' if not errors else 'NG'}", file=sys.stderr)
+        for e in errors[:20]:
+            print(f"  {e}", file=sys.stderr)
+        failed += bool(errors)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
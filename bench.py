@@ -0,0 +1,356 @@
+# bench.py
+# -*- coding: utf-8 -*-
+"""
+性能の計測。全プリセットの生成・PDF 描画・CSV 出力・採点を決まったシードで回し、結果を JSON に書く。
+--startup を付けると、アプリ（app.py）の起動と再実行の時間も Streamlit の AppTest で測り、
+STARTUP_BUDGET_MS と比べる（--check-budget なら超えた項目があれば終了コード 1）。
+
+コミットごとの JSON を --compare で突き合わせれば、遅くなった項目を見つけられる
+（しきい値を超えて遅くなった項目があれば終了コード 1）。
+数値は計測したマシンの混み具合で 1〜2 割は揺れるので、比べるのは同じマシンで取った結果どうしにすべきである。
+
+例:
+    python bench.py -o bench.json
+    python bench.py --quick -o new.json --compare bench.json --threshold 0.2
+    python bench.py --quick --startup --check-budget -o new.json
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import time
+from decimal import Decimal
+from fractions import Fraction
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import engine
+from engine import (
+    GENERATOR_VERSION,
+    PRESET_REGISTRY,
+    Ratio,
+    Remainder,
+    build_worksheet_pdf,
+    compare_answers,
+    generate_by_preset,
+    get_generation_stats,
+    reset_generation_stats,
+    rows_to_csv_bytes,
+    warm_font_cache,
+)
+
+SEED = 20240401
+
+# アプリの起動・再実行の時間の上限（ミリ秒。1 CPU の開発機で測った値の 2〜3 倍）
+# cold_start: 新しいプロセスでの最初の実行（app.py が import するモジュールの読み込みを含む。Streamlit 自体は除く）
+# rerun: 操作のない再実行、rerun_generated: 「生成する」の後の再実行（表・演習欄を描き直す）
+STARTUP_BUDGET_MS = {"cold_start": 1000.0, "rerun": 100.0, "rerun_generated": 150.0}
+
+# 採点用の解答の混ぜ方（合計 1）: 模範解答どおり / 同値な別表記 / 誤答 / 空欄・でたらめ
+ANSWER_MIX = {"exact": 0.6, "equivalent": 0.15, "wrong": 0.2, "junk": 0.05}
+
+# ------------------------------------------------------------------------------
+# 計測の道具
+# ------------------------------------------------------------------------------
+def _best_of(fn: Callable[[], object], repeat: int, min_time: float = 0.05) -> Tuple[float, object]:
+    # 1 回あたりの秒数の repeat 回中の最小値と、最後の戻り値。
+    # 短い処理は 1 回の計測が min_time 秒以上になるまで繰り返して平均する（timeit と同じ考え方）
+    best, out = float("inf"), None
+    for _ in range(repeat):
+        calls, t0 = 0, time.perf_counter()
+        while True:
+            out = fn()
+            calls += 1
+            elapsed = time.perf_counter() - t0
+            if elapsed >= min_time:
+                break
+        best = min(best, elapsed / calls)
+    return best, out
+
+def _count_pages(data: bytes) -> int:
+    return len(re.findall(rb"/Type\s*/Page\b", data))
+
+@contextlib.contextmanager
+def _font(enabled: bool) -> Iterator[bool]:
+    # enabled=False の間は日本語フォントがない環境と同じ（Helvetica と '?' 置換）で描画する
+    if enabled:
+        yield warm_font_cache() is not None
+        return
+    saved = dict(engine._FONT_CACHE)
+    engine._FONT_CACHE["jp"] = None
+    try:
+        yield False
+    finally:
+        engine._FONT_CACHE.clear()
+        engine._FONT_CACHE.update(saved)
+
+def _git_commit() -> Optional[str]:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return out.stdout.strip() or None
+
+def _versions() -> Dict[str, Optional[str]]:
+    from importlib import metadata
+
+    out: Dict[str, Optional[str]] = {"python": platform.python_version()}
+    for dist in ("numpy", "fpdf2", "pandas", "streamlit"):
+        try:
+            out[dist] = metadata.version(dist)
+        except metadata.PackageNotFoundError:
+            out[dist] = None
+    return out
+
+# ------------------------------------------------------------------------------
+# 各項目
+# ------------------------------------------------------------------------------
+def bench_presets(n: int, repeat: int) -> List[Dict]:
+    """全 (学年, 分野, 難度) を generate_by_preset で n 問ずつ生成する。"""
+    out = []
+    for (grade, field, level), plan in PRESET_REGISTRY.items():
+        reset_generation_stats()
+        generate_by_preset(grade, field, level, n, SEED)
+        st = get_generation_stats().get((grade, field, level), {"calls": 0, "retries": 0, "fallbacks": 0})
+        secs, _ = _best_of(lambda: generate_by_preset(grade, field, level, n, SEED), repeat)
+        out.append({
+            "grade": grade, "field": field, "level": level, "kind": plan.kind,
+            "problems_per_sec": round(n / secs, 1),
+            "retries_per_problem": round(st["retries"] / max(1, st["calls"]), 4),
+            "fallbacks": st["fallbacks"],
+        })
+    return out
+
+def bench_pdf(n: int, repeat: int) -> Dict[str, Dict]:
+    """全プリセットの 1 枚目を n 問で描画する（日本語フォントあり・なし）。"""
+    sheets = [(k, generate_by_preset(*k, n, SEED)) for k in PRESET_REGISTRY]
+    out = {}
+    for name, enabled in (("font", True), ("fallback", False)):
+        with _font(enabled) as has_font:
+            if enabled and not has_font:
+                out[name] = {"skipped": "japanese font not found"}
+                continue
+            build_worksheet_pdf(sheets[0][1], *sheets[0][0], n, SEED)   # フォント解析などの初回コストを除く
+            secs, docs = _best_of(lambda: [build_worksheet_pdf(rows, *k, n, SEED) for k, rows in sheets], repeat)
+        pages = sum(_count_pages(d) for d in docs)
+        out[name] = {
+            "documents": len(docs),
+            "pages": pages,
+            "ms_per_page": round(secs * 1000 / max(1, pages), 3),
+            "ms_per_document": round(secs * 1000 / len(docs), 3),
+            "bytes_per_document": sum(len(d) for d in docs) // len(docs),
+        }
+    return out
+
+def bench_csv(n: int, repeat: int) -> Dict:
+    rows = [r for k in PRESET_REGISTRY for r in generate_by_preset(*k, n, SEED)]
+    secs, data = _best_of(lambda: rows_to_csv_bytes(rows), repeat)
+    return {"rows": len(rows), "rows_per_sec": round(len(rows) / secs, 1), "bytes": len(data)}
+
+def _equivalent(display: str, value) -> str:
+    # 模範解答と同じ値の別の書き方
+    if isinstance(value, Fraction):
+        return f"{value.numerator * 2}/{value.denominator * 2}"
+    if isinstance(value, Decimal):
+        return f"{display}0" if "." in display else f"{display}.0"
+    if isinstance(value, Remainder):
+        return f"{value.quotient}あまり{value.remainder}"
+    if isinstance(value, Ratio):
+        return display.replace(":", " : ")
+    return f" {display} "
+
+def answer_mix(rows: List[Dict], seed: int = SEED) -> List[Tuple[object, str]]:
+    """(答えの値, 解答) の組を ANSWER_MIX の割合で作る。"""
+    rng = random.Random(seed)
+    kinds, weights = list(ANSWER_MIX), list(ANSWER_MIX.values())
+    out = []
+    for r in rows:
+        kind = rng.choices(kinds, weights)[0]
+        display, value = r["答え"], r["値"]
+        if kind == "exact":
+            user = display
+        elif kind == "equivalent":
+            user = _equivalent(display, value)
+        elif kind == "wrong":
+            user = re.sub(r"\d(?!.*\d)", lambda m: str((int(m.group()) + 1) % 10), display)
+        else:
+            user = rng.choice(["", "わからない", "?", "1/0"])
+        out.append((value, user))
+    return out
+
+def bench_grading(n: int, repeat: int) -> Dict:
+    rows = [r for k in PRESET_REGISTRY for r in generate_by_preset(*k, n, SEED)]
+    pairs = answer_mix(rows)
+
+    def cold() -> List[bool]:
+        # 判定キャッシュ（engine._compare_cached）を空にして、毎回判定する速さを測る
+        engine._compare_cached.cache_clear()
+        return [compare_answers(v, u) for v, u in pairs]
+
+    secs, results = _best_of(cold, repeat)
+    warm, _ = _best_of(lambda: [compare_answers(v, u) for v, u in pairs], repeat)
+    return {
+        "answers": len(pairs),
+        "answers_per_sec": round(len(pairs) / secs, 1),
+        "cached_answers_per_sec": round(len(pairs) / warm, 1),
+        "correct_ratio": round(sum(results) / len(results), 4),
+        "mix": ANSWER_MIX,
+    }
+
+# 別プロセスで app.py を AppTest で動かし、各段階のミリ秒を JSON で標準出力に書く
+_STARTUP_SCRIPT = r"""
+import json, statistics, sys, time
+from streamlit.testing.v1 import AppTest
+
+app_path, repeat = sys.argv[1], int(sys.argv[2])
+at = AppTest.from_file(app_path, default_timeout=120)
+t0 = time.perf_counter()
+at.run()
+cold = time.perf_counter() - t0
+import result_cache
+result_cache.warm_font_cache_async().result()   # 裏で進むフォントの解析を再実行の計測に混ぜない
+
+def rerun_ms():
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        at.run()
+        times.append(time.perf_counter() - t)
+    return statistics.median(times) * 1000
+
+idle = rerun_ms()
+at.sidebar.button[0].click().run()
+generated = rerun_ms()
+print(json.dumps({"cold_start": cold * 1000, "rerun": idle, "rerun_generated": generated,
+                  "errors": [str(e.value) for e in at.exception]}))
+"""
+
+def bench_startup(repeat: int) -> Dict:
+    """app.py の最初の実行と再実行の時間（ミリ秒）。Streamlit がなければ skipped。"""
+    from importlib.util import find_spec
+
+    if find_spec("streamlit") is None:
+        return {"skipped": "streamlit is not installed"}
+    here = os.path.dirname(os.path.abspath(__file__))
+    colds, doc = [], {}
+    for _ in range(repeat):
+        # 最初の実行はプロセスごとに 1 回しか測れないので、プロセスを作り直して最速を採る
+        out = subprocess.run([sys.executable, "-c", _STARTUP_SCRIPT, os.path.join(here, "app.py"), str(max(5, repeat))],
+                             capture_output=True, text=True, cwd=here, timeout=600)
+        if out.returncode != 0:
+            return {"skipped": f"app failed: {out.stderr.strip().splitlines()[-1:]}"}
+        doc = json.loads(out.stdout.strip().splitlines()[-1])
+        if doc["errors"]:
+            return {"skipped": f"app raised: {doc['errors'][0]}"}
+        colds.append(doc["cold_start"])
+    result = {"cold_start_ms": round(min(colds), 1), "rerun_ms": round(doc["rerun"], 1),
+              "rerun_generated_ms": round(doc["rerun_generated"], 1)}
+    result["budget_ms"] = STARTUP_BUDGET_MS
+    return result
+
+def over_budget(doc: Dict) -> List[str]:
+    """startup の各項目のうち STARTUP_BUDGET_MS を超えたもの。"""
+    startup = doc.get("startup", {})
+    return [f"{name}: {startup[f'{name}_ms']:.1f} ms > {limit:.0f} ms"
+            for name, limit in STARTUP_BUDGET_MS.items() if startup.get(f"{name}_ms", 0) > limit]
+
+def run(n: int, pdf_n: int, repeat: int, startup: bool = False) -> Dict:
+    doc = {
+        "meta": {
+            "commit": _git_commit(),
+            "generator_version": GENERATOR_VERSION,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "versions": _versions(),
+            "params": {"n": n, "pdf_n": pdf_n, "repeat": repeat, "seed": SEED},
+        },
+        "presets": bench_presets(n, repeat),
+        "pdf": bench_pdf(pdf_n, repeat),
+        "csv": bench_csv(n, repeat),
+        "grading": bench_grading(n, repeat),
+    }
+    if startup:
+        doc["startup"] = bench_startup(repeat)
+    return doc
+
+# ------------------------------------------------------------------------------
+# 比較
+# ------------------------------------------------------------------------------
+def _throughputs(doc: Dict) -> Dict[str, float]:
+    # 比較する指標（大きいほど速い）。PDF は ms/page の逆数にそろえる
+    out = {f"generate {p['grade']}/{p['field']}/L{p['level']}": p["problems_per_sec"] for p in doc["presets"]}
+    for name, r in doc["pdf"].items():
+        if "ms_per_page" in r:
+            out[f"pdf {name}"] = 1000.0 / r["ms_per_page"]
+    out["csv"] = doc["csv"]["rows_per_sec"]
+    out["grading"] = doc["grading"]["answers_per_sec"]
+    for name in STARTUP_BUDGET_MS:
+        if f"{name}_ms" in doc.get("startup", {}):
+            out[f"startup {name}"] = 1000.0 / doc["startup"][f"{name}_ms"]
+    return out
+
+def compare(old: Dict, new: Dict, threshold: float) -> List[str]:
+    """new が old より threshold（割合）を超えて遅くなった項目を返す。"""
+    before, after = _throughputs(old), _throughputs(new)
+    out = []
+    for key, v in after.items():
+        if key in before and v < before[key] * (1 - threshold):
+            out.append(f"{key}: {before[key]:.1f} -> {v:.1f} ({v / before[key] - 1:+.0%})")
+    return out
+
+# ------------------------------------------------------------------------------
+# CLI
+# ------------------------------------------------------------------------------
+def build_parser() -> argparse.ArgumentParser:
+    ap = argparse.ArgumentParser(description="生成・PDF・CSV・採点の性能を計測して JSON に書く")
+    ap.add_argument("-o", "--output", default="-", help="結果の JSON（'-' で標準出力）")
+    ap.add_argument("--n", type=int, default=200, help="プリセットごとの出題数")
+    ap.add_argument("--pdf-n", type=int, default=20, help="PDF 1 枚あたりの出題数")
+    ap.add_argument("--repeat", type=int, default=3, help="各計測の繰り返し回数（最速を採る）")
+    ap.add_argument("--quick", action="store_true", help="--n 50 --repeat 2 で手早く回す")
+    ap.add_argument("--compare", help="比べる前回の JSON")
+    ap.add_argument("--threshold", type=float, default=0.2, help="遅くなったとみなす割合（既定 0.2 = 20%%）")
+    ap.add_argument("--startup", action="store_true", help="アプリの起動・再実行の時間も測る（Streamlit が必要）")
+    ap.add_argument("--check-budget", action="store_true",
+                    help="起動・再実行の時間が STARTUP_BUDGET_MS を超えたら終了コード 1（--startup を含む）")
+    return ap
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = build_parser()
+    args = ap.parse_args(argv)
+    if args.quick:
+        args.n, args.repeat = 50, 2
+    if args.n < 1 or args.pdf_n < 1 or args.repeat < 1:
+        ap.error("n, pdf-n and repeat must be >= 1")
+
+    doc = run(args.n, args.pdf_n, args.repeat, startup=args.startup or args.check_budget)
+    text = json.dumps(doc, ensure_ascii=False, indent=2) + "\n"
+    if args.output == "-":
+        sys.stdout.write(text)
+    else:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+
+    failed = False
+    if args.check_budget:
+        for line in over_budget(doc):
+            print(f"over budget: {line}", file=sys.stderr)
+            failed = True
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            old = json.load(f)
+        slower = compare(old, doc, args.threshold)
+        for line in slower:
+            print(f"slower: {line}", file=sys.stderr)
+        failed = failed or bool(slower)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,220 @@
+# bundle.py
+# -*- coding: utf-8 -*-
+"""
+クラス名簿分のワークシートを一括で作る（カンニング防止に 1 人ずつ別の問題にする）。
+
+名簿（または人数と基準シード）から出席番号順にシードを決め、
+問題の生成（問題バンクがあればバンクから）と PDF 描画をプロセスプールで並列に回し、
+全員分を 1 つの PDF（各自の問題＋解答）か ZIP（1 人 1 ファイル＋名簿 CSV）にまとめる。
+
+シードは「基準シード + 出席番号 - 1」である。アプリのシード欄にこの値を入れれば
+同じプリントを 1 枚だけ作り直せる。
+
+例:
+    python bundle.py --grade 小3 --field かけ算の筆算 --level 2 --n 20 --roster names.txt --format zip -o class.zip
+    python bundle.py --grade 小5 --field 分数の四則混合 --count 40 --base-seed 1000 --format pdf -o class.pdf
+"""
+
+import argparse
+import csv
+import importlib.util
+import io
+import multiprocessing
+import re
+import sys
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from bank import generate_rows
+from engine import (
+    PRESET_TABLE,
+    ProblemSpaceExhausted,
+    build_header_meta,
+    build_pdf,
+    build_pdf_bundle,
+    rows_to_pdf_problems,
+    warm_font_cache,
+)
+
+FORMATS = ("pdf", "zip")
+
+# 1 プロセスがまとめて描画する人数の上限（結合 PDF のとき。フォントは塊ごとに 1 回埋め込まれる）
+PDF_CHUNK = 16
+
+class Student(NamedTuple):
+    number: int   # 出席番号（1 始まり）
+    name: str
+    seed: int
+
+Sheet = Tuple[str, Dict[str, str], List[Dict]]
+
+# ------------------------------------------------------------------------------
+# 名簿
+# ------------------------------------------------------------------------------
+def read_roster(text: str) -> List[str]:
+    """1 行 1 名の名簿を読む。CSV の場合は先頭列を名前とみなす。空行と # で始まる行は飛ばす。"""
+    names = []
+    for row in csv.reader(io.StringIO(text.lstrip("\ufeff"))):
+        if not row or not row[0].strip() or row[0].lstrip().startswith("#"):
+            continue
+        names.append(row[0].strip())
+    return names
+
+def make_roster(base_seed: int, names: Optional[Sequence[str]] = None, count: Optional[int] = None) -> List[Student]:
+    """名簿があればその順に、なければ count 人分（名前は「n番」）の Student を作る。"""
+    if names:
+        labels = list(names)
+    elif count:
+        labels = [f"{i}番" for i in range(1, count + 1)]
+    else:
+        raise ValueError("names か count のどちらかが必要である")
+    return [Student(i, name, base_seed + i - 1) for i, name in enumerate(labels, 1)]
+
+# ------------------------------------------------------------------------------
+# 1 人分のワークシート
+# ------------------------------------------------------------------------------
+def student_sheet(student: Student, grade: str, field: str, level: int, n: int) -> Sheet:
+    rows = generate_rows(grade, field, level, n, student.seed)
+    meta = {"氏名": f"{student.number}. {student.name}", **build_header_meta(grade, field, level, n, student.seed)}
+    return "算数ドリル", meta, rows_to_pdf_problems(rows)
+
+def _render_student(student: Student, grade: str, field: str, level: int, n: int) -> bytes:
+    return build_pdf(*student_sheet(student, grade, field, level, n))
+
+def _render_chunk(students: List[Student], grade: str, field: str, level: int, n: int) -> bytes:
+    return build_pdf_bundle([student_sheet(s, grade, field, level, n) for s in students])
+
+def _chunks(seq: List[Student], size: int) -> List[List[Student]]:
+    return [seq[i:i + size] for i in range(0, len(seq), size)]
+
+def _mp_context():
+    # アプリ（スレッドの多い Streamlit のサーバ）から呼ばれるので fork しない。fork すると、
+    # 別スレッドが持っていたロック（フォントのキャッシュや logging）を握ったままの子ができて止まりうる
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+def _pool(workers: Optional[int]) -> ProcessPoolExecutor:
+    # 各プロセスで最初にフォントを解析しておく（以降の描画はキャッシュを使う）
+    return ProcessPoolExecutor(max_workers=workers, mp_context=_mp_context(), initializer=warm_font_cache)
+
+def _map(ex: ProcessPoolExecutor, fn, items: list, *args, chunksize: int = 1) -> list:
+    # fn(item, *args) を items の順に並列実行する
+    return list(ex.map(fn, items, *[[a] * len(items) for a in args], chunksize=chunksize))
+
+def render_student_pdfs(roster: List[Student], grade: str, field: str, level: int, n: int, *,
+                        workers: Optional[int] = None) -> List[bytes]:
+    """1 人 1 つの PDF を名簿順に返す。workers=1 ならこのプロセスで描画する。"""
+    if workers == 1 or len(roster) == 1:
+        return [_render_student(s, grade, field, level, n) for s in roster]
+    with _pool(workers) as ex:
+        return _map(ex, _render_student, roster, grade, field, level, n, chunksize=max(1, len(roster) // 32))
+
+# ------------------------------------------------------------------------------
+# まとめ
+# ------------------------------------------------------------------------------
+def _merge_pdfs(parts: List[bytes]) -> bytes:
+    from pypdf import PdfWriter
+
+    writer = PdfWriter()
+    for part in parts:
+        writer.append(io.BytesIO(part))
+    buf = io.BytesIO()
+    writer.write(buf)
+    return buf.getvalue()
+
+def build_bundle_pdf(roster: List[Student], grade: str, field: str, level: int, n: int, *,
+                     workers: Optional[int] = None) -> bytes:
+    """全員分（各自の問題ページ＋解答ページ）を名簿順に並べた 1 つの PDF を作る。
+
+    名簿を PDF_CHUNK 人ずつの塊に分けて並列に描画し、pypdf で結合する。
+    pypdf が入っていなければ、問題の生成だけを並列にして 1 プロセスで描画する。
+    """
+    chunks = _chunks(roster, PDF_CHUNK)
+    if workers == 1 or len(chunks) == 1:
+        return _render_chunk(roster, grade, field, level, n)
+    with _pool(workers) as ex:
+        if importlib.util.find_spec("pypdf") is not None:
+            return _merge_pdfs(_map(ex, _render_chunk, chunks, grade, field, level, n))
+        sheets = _map(ex, student_sheet, roster, grade, field, level, n)
+    return build_pdf_bundle(sheets)
+
+def _safe_filename(name: str) -> str:
+    return re.sub(r'[\\/:*?"<>|\s]+', "_", name).strip("_") or "noname"
+
+def roster_to_csv_bytes(roster: List[Student]) -> bytes:
+    buf = io.StringIO()
+    w = csv.writer(buf, lineterminator="\n")
+    w.writerow(["出席番号", "氏名", "乱数シード"])
+    for s in roster:
+        w.writerow([s.number, s.name, s.seed])
+    return buf.getvalue().encode("utf-8-sig")
+
+def build_bundle_zip(roster: List[Student], grade: str, field: str, level: int, n: int, *,
+                     workers: Optional[int] = None) -> bytes:
+    """1 人 1 つの PDF と、出席番号・氏名・シードの対応表（roster.csv）を入れた ZIP を作る。"""
+    pdfs = render_student_pdfs(roster, grade, field, level, n, workers=workers)
+    width = len(str(len(roster)))
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("roster.csv", roster_to_csv_bytes(roster))
+        for s, data in zip(roster, pdfs):
+            zf.writestr(f"{s.number:0{width}d}_{_safe_filename(s.name)}.pdf", data)
+    return buf.getvalue()
+
+def build_bundle(fmt: str, roster: List[Student], grade: str, field: str, level: int, n: int, *,
+                 workers: Optional[int] = None) -> bytes:
+    if fmt == "zip":
+        return build_bundle_zip(roster, grade, field, level, n, workers=workers)
+    return build_bundle_pdf(roster, grade, field, level, n, workers=workers)
+
+# ------------------------------------------------------------------------------
+# CLI
+# ------------------------------------------------------------------------------
+def build_parser() -> argparse.ArgumentParser:
+    ap = argparse.ArgumentParser(description="クラス名簿分のワークシートを一括作成する")
+    ap.add_argument("--grade", default="小3", help="学年（例: 小3）")
+    ap.add_argument("--field", default="整数のたし算・ひき算", help="分野（PRESET_TABLE のキー）")
+    ap.add_argument("--level", type=int, default=1, help="難度 1〜5")
+    ap.add_argument("--n", type=int, default=10, help="1 人あたりの出題数")
+    ap.add_argument("--base-seed", type=int, default=0, help="出席番号 1 番のシード（以降 +1 ずつ）")
+    src = ap.add_mutually_exclusive_group(required=True)
+    src.add_argument("--roster", help="名簿ファイル（1 行 1 名、または先頭列が氏名の CSV）")
+    src.add_argument("--count", type=int, help="名簿なしで作る人数")
+    ap.add_argument("--format", choices=FORMATS, default="pdf", help="pdf: 全員分を 1 ファイル、zip: 1 人 1 ファイル")
+    ap.add_argument("-o", "--output", required=True, help="出力先ファイル")
+    ap.add_argument("--workers", type=int, default=None, help="描画に使うプロセス数（既定: CPU 数）")
+    return ap
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = build_parser()
+    args = ap.parse_args(argv)
+    if args.grade not in PRESET_TABLE or args.field not in PRESET_TABLE[args.grade]:
+        ap.error(f"unknown preset: {args.grade} / {args.field}")
+    if not 1 <= args.level <= 5:
+        ap.error("level must be between 1 and 5")
+    if args.n < 1:
+        ap.error("n must be >= 1")
+
+    if args.roster:
+        with open(args.roster, encoding="utf-8") as f:
+            names = read_roster(f.read())
+        if not names:
+            ap.error(f"roster is empty: {args.roster}")
+        roster = make_roster(args.base_seed, names=names)
+    else:
+        if args.count < 1:
+            ap.error("count must be >= 1")
+        roster = make_roster(args.base_seed, count=args.count)
+
+    try:
+        data = build_bundle(args.format, roster, args.grade, args.field, args.level, args.n, workers=args.workers)
+    except ProblemSpaceExhausted as e:
+        ap.error(str(e))
+    with open(args.output, "wb") as f:
+        f.write(data)
+    print(f"{len(roster)} sheets -> {args.output}", file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,94 @@
+# check_grading.py
+# -*- coding: utf-8 -*-
+"""
+一括採点（grading.grade_values）の配列比較が compare_answers と同じ正誤を出すかを確かめる。
+
+全プリセットの模範解答に対して、正解の表記ゆれ（約分前の分数・小数・同値比・空白）と、
+配列では読めない・読み違えやすい解答（全角数字・桁の多すぎる整数・分母 0・指数表記・
+nan/inf・別の型の書き方）を作り、1 行ずつの compare_answers と突き合わせる。
+parse_answer・compare_answers や grading の配列の読み取りを変えたら回すこと。
+
+例:
+    python check_grading.py
+    python check_grading.py --n 40 --seeds 3
+"""
+
+import argparse
+import fractions
+import random
+import sys
+from typing import List, Optional, Tuple
+
+import pandas as pd
+
+from engine import PRESET_REGISTRY, AnswerPair, AnswerValue, Ratio, Remainder, compare_answers, generate_by_preset
+from grading import grade_values
+
+# どの答えにも混ぜる解答（型の違う書き方・壊れた書き方）
+COMMON_ANSWERS = [
+    "", " ", "0", "-0", "+1", "1/0", "0/0", "-1/2", "1/-2", ".5", "5.", "1e3", "1E-2", "nan", "inf", "-inf",
+    "１２", "３/４", "1:0", "0:1", "2 : 4", "3 あまり 1", "3あまり0", "1.5 / 2", "1 / 2.5", "abc", "1,000",
+    "12345678901234567890", "1/12345678901", "999999999/1", "1000000000:1",
+]
+
+def _number_variants(v, rng: random.Random) -> List[str]:
+    f = fractions.Fraction(v)
+    k = rng.randint(2, 9)
+    out = [str(v), f" {v} ", f"{f.numerator * k}/{f.denominator * k}", repr(float(f)),
+           f"{float(f) + 1e-7:.9f}", f"{float(f) + 1e-3:.6f}", f"{f.numerator}/{f.denominator}",
+           str(-f), f"{f.numerator + 1}/{f.denominator}"]
+    if f.denominator == 1:
+        out.append(str(f.numerator).translate(str.maketrans("0123456789", "０１２３４５６７８９")))
+        out.append(f"{f.numerator}.0")
+    return out
+
+def _variants(v: AnswerValue, shown: str, rng: random.Random) -> List[str]:
+    t = type(v)
+    if t is Remainder:
+        q, r = v
+        return [shown, f"{q}あまり{r}", f"{q} あまり {r + 1}", f"{q + 1} あまり {r}", str(q), f"{q}:{r}", f"{q}/{r}"]
+    if t is Ratio:
+        a, b = v
+        k = rng.randint(2, 9)
+        return [shown, f"{a * k}:{b * k}", f"{a} : {b}", f"{b}:{a}", f"{a}:{b + 1}", f"{a}/{b}", f"-{a}:-{b}"]
+    if t is AnswerPair:
+        x, y = v
+        return [shown, f"{x}/{y}", f"{float(x)} / {float(y)}", f"{y} / {x}", f"{x} / {float(y) + 1e-7:.9f}",
+                str(x), f"{fractions.Fraction(x) / fractions.Fraction(y)}", repr(float(x) / float(y))]
+    return [shown, *_number_variants(v, rng)]
+
+def build_cases(n: int, seeds: int, seed: int = 0) -> Tuple[List[AnswerValue], List[str]]:
+    """全プリセットの n 問 × seeds 通りの模範解答と、それぞれに対する解答の組を作る。"""
+    rng = random.Random(seed)
+    values, answers = [], []
+    for grade, field, level in PRESET_REGISTRY:
+        for s in range(seeds):
+            for row in generate_by_preset(grade, field, level, n, s):
+                v = row["値"]
+                cands = _variants(v, row["答え"], rng) + rng.sample(COMMON_ANSWERS, 4)
+                values += [v] * len(cands)
+                answers += cands
+    return values, answers
+
+def check(values: List[AnswerValue], answers: List[str], tol: float = 1e-6) -> List[Tuple[AnswerValue, str, bool]]:
+    """grade_values と compare_answers の正誤が食い違った (値, 解答, 配列の正誤) のリスト。"""
+    batch = grade_values(values, pd.Series(answers, dtype=object), tol)
+    return [(v, u, bool(b)) for v, u, b in zip(values, answers, batch.tolist())
+            if b != compare_answers(v, u.strip(), tol)]
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="一括採点と compare_answers の正誤の一致を確かめる")
+    ap.add_argument("--n", type=int, default=20, help="プリセット・シードごとの問題数")
+    ap.add_argument("--seeds", type=int, default=2, help="プリセットごとのシードの数")
+    ap.add_argument("--tol", type=float, default=1e-6)
+    args = ap.parse_args(argv)
+
+    values, answers = build_cases(args.n, args.seeds)
+    mismatches = check(values, answers, args.tol)
+    print(f"{len(values)} rows, {len(mismatches)} mismatches", file=sys.stderr)
+    for v, u, b in mismatches[:20]:
+        print(f"  {v!r} vs {u!r}: grade_values={b}", file=sys.stderr)
+    return 1 if mismatches else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,167 @@
+# cli.py
+# -*- coding: utf-8 -*-
+"""
+算数ドリルのコマンドライン版。Streamlit を起動せずに問題を生成する。
+
+例:
+    python cli.py --grade 小3 --field 整数のたし算・ひき算 --level 2 --n 20 --seed 42 --format csv -o drill.csv
+    python cli.py --grade 小6 --field 逆算（□を求める） --format pdf -o drill.pdf
+    python cli.py --grade 小4 --field 小数の四則 --n 1000000 --stream --format jsonl -o drill.jsonl
+    python cli.py --grade 小5 --field 分数の四則混合 --n 5000 --format parquet -o drill.parquet
+    python cli.py --list-presets
+"""
+
+import argparse
+import io
+import os
+import sys
+import zipfile
+from typing import Iterator, List, Optional
+
+from bank import iter_rows
+from engine import (
+    PRESET_TABLE,
+    PRESET_REGISTRY,
+    ProblemSpaceExhausted,
+    build_worksheet_pdf,
+    generate_parallel,
+    get_generation_stats,
+    rows_to_csv_bytes,
+    rows_to_json_bytes,
+    rows_to_jsonl_bytes,
+    iter_csv_chunks,
+    iter_jsonl_chunks,
+    iter_pdf_volumes,
+    PDF_VOLUME,
+)
+from problemset import ProblemSet
+
+FORMATS = ("csv", "json", "jsonl", "pdf", "parquet")
+
+def build_parser() -> argparse.ArgumentParser:
+    ap = argparse.ArgumentParser(description="算数ドリルジェネレータ（CLI）")
+    ap.add_argument("--grade", default="小3", help="学年（例: 小3）")
+    ap.add_argument("--field", default="整数のたし算・ひき算", help="分野（PRESET_TABLE のキー）")
+    ap.add_argument("--level", type=int, default=1, help="難度 1〜5")
+    ap.add_argument("--n", type=int, default=10, help="出題数")
+    ap.add_argument("--seed", type=int, default=0, help="乱数シード（再現用）")
+    ap.add_argument("--format", choices=FORMATS, default="csv", help="出力形式")
+    ap.add_argument("-o", "--output", default="-", help="出力先ファイル（'-' で標準出力）")
+    ap.add_argument("--workers", type=int, default=None,
+                    help="大きな n を分割生成するプロセス数（既定: CPU 数、1 で分割なし）")
+    ap.add_argument("--stream", action="store_true",
+                    help="問題を 1 問ずつ作りながら少しずつ書き出す（大量出題用。メモリは出題数によらない）。"
+                         "csv/jsonl はそのまま、pdf は PDF_VOLUME 問ごとの冊を ZIP にまとめる。json・parquet は使えない")
+    ap.add_argument("--stats", action="store_true",
+                    help="プリセットごとの再試行回数・フォールバック回数を標準エラーに出す")
+    ap.add_argument("--list-presets", action="store_true", help="学年・分野・難度の一覧を表示して終了する")
+    return ap
+
+def validate_args(ap: argparse.ArgumentParser, args: argparse.Namespace) -> None:
+    if args.grade not in PRESET_TABLE:
+        ap.error(f"unknown grade: {args.grade} (choices: {', '.join(PRESET_TABLE)})")
+    if args.field not in PRESET_TABLE[args.grade]:
+        ap.error(f"unknown field for {args.grade}: {args.field} (choices: {', '.join(PRESET_TABLE[args.grade])})")
+    if not 1 <= args.level <= 5:
+        ap.error("level must be between 1 and 5")
+    if args.n < 1:
+        ap.error("n must be >= 1")
+    if args.stream and args.format in ("json", "parquet"):
+        ap.error(f"--stream does not support {args.format} (use jsonl or csv)")
+
+def render(fmt: str, rows: List[dict], args: argparse.Namespace) -> bytes:
+    if fmt == "csv":
+        return rows_to_csv_bytes(rows)
+    if fmt == "json":
+        return rows_to_json_bytes(rows, args.grade, args.field, args.level, args.n, args.seed)
+    if fmt == "jsonl":
+        return rows_to_jsonl_bytes(rows)
+    if fmt == "parquet":
+        # 問題・答え・プリセット（辞書型）と型つきの答えの値 "値" の列（ProblemSet.to_arrow）
+        buf = io.BytesIO()
+        ProblemSet.from_rows(args.grade, args.field, args.level, args.seed, rows).to_parquet(buf)
+        return buf.getvalue()
+    return build_worksheet_pdf(rows, args.grade, args.field, args.level, args.n, args.seed)
+
+def stream_chunks(args: argparse.Namespace) -> Iterator[bytes]:
+    """--stream の出力をバイト列の塊で返す。"""
+    rows = iter_rows(args.grade, args.field, args.level, args.seed, n=args.n)
+    if args.format == "csv":
+        yield from iter_csv_chunks(rows)
+    elif args.format == "jsonl":
+        yield from iter_jsonl_chunks(rows)
+    else:
+        # ZIP は書き出し先が seek できなくても作れる（1 冊ずつ書いて捨てる）
+        buf = _ChunkBuffer()
+        width = len(str(-(-args.n // PDF_VOLUME)))
+        with zipfile.ZipFile(buf, "w", compression=zipfile.ZIP_STORED) as zf:
+            for k, data in enumerate(iter_pdf_volumes(rows, args.grade, args.field, args.level, args.n, args.seed), 1):
+                zf.writestr(f"drill-{k:0{width}d}.pdf", data)
+                yield buf.take()
+        yield buf.take()
+
+class _ChunkBuffer(io.RawIOBase):
+    # ZipFile の書き込み先。書かれた分を take() で取り出して手放す（seek はできない）
+    def __init__(self):
+        self._parts: List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self._parts.append(bytes(b))
+        return len(b)
+
+    def take(self) -> bytes:
+        out, self._parts = b"".join(self._parts), []
+        return out
+
+def list_presets() -> None:
+    # 学年・分野・難度・表示名・ジェネレータ・異なる問題の数（数えられないものは "-"）
+    for plan in PRESET_REGISTRY.values():
+        size = plan.space.size if plan.space is not None else "-"
+        print(f"{plan.grade}\t{plan.field}\t{plan.level}\t{plan.label}\t{plan.kind}\t{size}")
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = build_parser()
+    args = ap.parse_args(argv)
+    if args.list_presets:
+        list_presets()
+        return 0
+    validate_args(ap, args)
+
+    if args.stream:
+        out = sys.stdout.buffer if args.output == "-" else open(args.output, "wb")
+        try:
+            for chunk in stream_chunks(args):
+                out.write(chunk)
+        except ProblemSpaceExhausted as e:
+            if out is not sys.stdout.buffer:
+                out.close()
+                os.remove(args.output)   # 途中までのファイルは残さない
+            ap.error(str(e))
+        if out is not sys.stdout.buffer:
+            out.close()
+        return 0
+
+    try:
+        rows = generate_parallel(args.grade, args.field, args.level, args.n, args.seed, workers=args.workers)
+    except ProblemSpaceExhausted as e:
+        ap.error(str(e))
+    data = render(args.format, rows, args)
+    if args.stats:
+        # 分割生成した場合、集計されるのはこのプロセスで生成した分だけ
+        for (g, f, l), st in get_generation_stats().items():
+            print(f"{g}\t{f}\t{l}\tcalls={st['calls']}\tretries={st['retries']}\tfallbacks={st['fallbacks']}",
+                  file=sys.stderr)
+
+    if args.output == "-":
+        sys.stdout.buffer.write(data)
+        sys.stdout.buffer.flush()
+    else:
+        with open(args.output, "wb") as f:
+            f.write(data)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
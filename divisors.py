@@ -0,0 +1,164 @@
+# divisors.py
+# -*- coding: utf-8 -*-
+"""
+最大公約数・最小公倍数の問題を「答えを先に決めて」作るための約数索引。
+
+SIEVE_LIMIT までの最小素因数表をエラトステネスのふるいで一度だけ作り、
+素因数分解・約数の列挙を表引きで行う。これを使って
+
+- 最大公約数: 範囲内に倍数が十分ある g を選び、商どうしが互いに素な倍数を並べる
+  （答えはちょうど g になる）
+- 最小公倍数: 範囲内の数の組を最小公倍数 L ごとに分けた索引を作り、L を選んでから組を選ぶ
+  （答えの上限 max_lcm はプリセットごとに決める。None なら範囲内のどの組でもよい）
+
+の形で、捨て直しなしに問題を作る。難しさは共通の素因数の個数（重複を数える。12 = 2·2·3 なら 3）で絞れる。
+"""
+
+import functools
+import itertools
+import math
+import random
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# ふるいの上限（プリセットで使う数の範囲）
+SIEVE_LIMIT = 999
+
+# 最小公倍数の索引に入れる組の数の上限（索引はプロセスに持ち続けるので大きくしすぎない）
+MAX_LCM_COMBOS = 2_000_000
+
+# 商を選び直す回数の上限。使い切ったら隣り合う 2 数（必ず互いに素）を含めて組む
+_MAX_COPRIME_DRAWS = 32
+
+FactorRange = Optional[Tuple[int, Optional[int]]]   # 共通の素因数の個数の (下限, 上限)。None は無制限
+
+def _build_spf(limit: int) -> List[int]:
+    spf = list(range(limit + 1))
+    for p in range(2, math.isqrt(limit) + 1):
+        if spf[p] == p:
+            for m in range(p * p, limit + 1, p):
+                if spf[m] == m:
+                    spf[m] = p
+    return spf
+
+_SPF = _build_spf(SIEVE_LIMIT)
+
+# ------------------------------------------------------------------------------
+# 表引き
+# ------------------------------------------------------------------------------
+def factorize(n: int) -> List[Tuple[int, int]]:
+    """n (2 <= n <= SIEVE_LIMIT) の素因数分解を [(素数, 指数), ...] で返す。"""
+    out: List[Tuple[int, int]] = []
+    while n > 1:
+        p, e = _SPF[n], 0
+        while n % p == 0:
+            n //= p
+            e += 1
+        out.append((p, e))
+    return out
+
+def big_omega(n: int) -> int:
+    """重複を数えた素因数の個数（1 なら 0）。"""
+    return sum(e for _, e in factorize(n))
+
+@functools.lru_cache(maxsize=None)
+def divisors(n: int) -> Tuple[int, ...]:
+    """n の約数を小さい順に返す。"""
+    ds = [1]
+    for p, e in factorize(n):
+        ds = [d * p ** k for d in ds for k in range(e + 1)]
+    return tuple(sorted(ds))
+
+def _in_range(omega: int, factors: FactorRange) -> bool:
+    if factors is None:
+        return True
+    lo, hi = factors
+    return omega >= lo and (hi is None or omega <= hi)
+
+def _weights(values: Sequence[int], weight: str) -> List[float]:
+    # natural: 無作為な組と同じく g の確率を 1/g^2 に比例させる、flat: どの答えも同じ確率
+    if weight == "natural":
+        return [1.0 / (v * v) for v in values]
+    if weight == "flat":
+        return [1.0] * len(values)
+    raise ValueError(f"unknown weight: {weight}")
+
+def _cumulative(ws: Sequence[float]) -> List[float]:
+    return list(itertools.accumulate(ws))
+
+# ------------------------------------------------------------------------------
+# 最大公約数
+# ------------------------------------------------------------------------------
+@functools.lru_cache(maxsize=None)
+def gcd_index(lo: int, hi: int, count: int, factors: FactorRange = None,
+              weight: str = "natural") -> Tuple[Tuple[int, ...], Tuple[float, ...]]:
+    """[lo, hi] の数 count 個の最大公約数として出せる g (>=2) と、その累積重み。
+
+    g の倍数が範囲内に count 個以上あり、かつ 2 個以上あれば（隣り合う商は互いに素なので）
+    最大公約数がちょうど g の組が作れる。
+    """
+    if not 1 <= lo <= hi <= SIEVE_LIMIT:
+        raise ValueError(f"range must be within 1..{SIEVE_LIMIT}: {lo}..{hi}")
+    cands = [g for g in range(2, hi + 1)
+             if hi // g - (lo - 1) // g >= max(count, 2) and _in_range(big_omega(g), factors)]
+    if not cands:
+        raise ValueError(f"no gcd target for {lo}..{hi} x{count} with factors={factors}")
+    return tuple(cands), tuple(_cumulative(_weights(cands, weight)))
+
+def _coprime_quotients(rng: random.Random, k_lo: int, k_hi: int, count: int) -> List[int]:
+    # [k_lo, k_hi] から最大公約数が 1 になる count 個を選ぶ
+    pool = range(k_lo, k_hi + 1)
+    for _ in range(_MAX_COPRIME_DRAWS):
+        ks = rng.sample(pool, count)
+        if math.gcd(*ks) == 1:
+            return ks
+    k = rng.randint(k_lo, k_hi - 1)
+    rest = [x for x in pool if x not in (k, k + 1)]
+    ks = [k, k + 1] + rng.sample(rest, count - 2)
+    rng.shuffle(ks)
+    return ks
+
+def sample_gcd(rng: random.Random, lo: int, hi: int, count: int, *, factors: FactorRange = None,
+               weight: str = "natural") -> Tuple[List[int], int]:
+    """最大公約数がちょうど g (>=2) になる [lo, hi] の相異なる count 個の数と g を返す。"""
+    cands, cum = gcd_index(lo, hi, count, factors, weight)
+    g = rng.choices(cands, cum_weights=cum)[0]
+    ks = _coprime_quotients(rng, -(-lo // g), hi // g, count)
+    return [k * g for k in ks], g
+
+# ------------------------------------------------------------------------------
+# 最小公倍数
+# ------------------------------------------------------------------------------
+@functools.lru_cache(maxsize=None)
+def lcm_index(lo: int, hi: int, count: int, factors: FactorRange = None, max_lcm: Optional[int] = None,
+              weight: str = "problems") -> Tuple[Tuple[int, ...], Tuple[float, ...], Dict[int, Tuple[Tuple[int, ...], ...]]]:
+    """[lo, hi] の相異なる count 個の組を、最小公倍数が max_lcm 以下（None なら上限なし）のものだけ集めた索引。
+
+    (答え L の一覧, L の累積重み, L -> 最小公倍数がちょうど L の組) を返す。
+    factors は組の最大公約数の素因数の個数で絞る（(0, 0) なら互いに素な組だけ）。
+    weight が problems ならどの組も同じ確率、flat ならどの答えも同じ確率にする。
+    """
+    if not 1 <= lo <= hi <= SIEVE_LIMIT:
+        raise ValueError(f"range must be within 1..{SIEVE_LIMIT}: {lo}..{hi}")
+    if weight not in ("problems", "flat"):
+        raise ValueError(f"unknown weight: {weight}")
+    if math.comb(hi - lo + 1, count) > MAX_LCM_COMBOS:
+        raise ValueError(f"too many tuples for an lcm index: {lo}..{hi} x{count}")
+    sets: Dict[int, List[Tuple[int, ...]]] = {}
+    for c in itertools.combinations(range(lo, hi + 1), count):
+        L = math.lcm(*c)
+        if L >= 2 and (max_lcm is None or L <= max_lcm) and _in_range(big_omega(math.gcd(*c)), factors):
+            sets.setdefault(L, []).append(c)
+    if not sets:
+        raise ValueError(f"no lcm target for {lo}..{hi} x{count} with factors={factors} (max_lcm={max_lcm})")
+    targets = tuple(sorted(sets))
+    ws = [float(len(sets[L])) if weight == "problems" else 1.0 for L in targets]
+    return targets, tuple(_cumulative(ws)), {L: tuple(sets[L]) for L in targets}
+
+def sample_lcm(rng: random.Random, lo: int, hi: int, count: int, *, factors: FactorRange = None,
+               max_lcm: Optional[int] = None, weight: str = "problems") -> Tuple[List[int], int]:
+    """最小公倍数がちょうど L (max_lcm があればそれ以下) になる [lo, hi] の相異なる count 個の数と L を返す。"""
+    targets, cum, sets = lcm_index(lo, hi, count, factors, max_lcm, weight)
+    L = rng.choices(targets, cum_weights=cum)[0]
+    nums = list(rng.choice(sets[L]))
+    rng.shuffle(nums)
+    return nums, L
@@ -0,0 +1,1292 @@
+# engine.py
+# -*- coding: utf-8 -*-
+"""
+算数ドリルの生成・採点・PDF出力エンジン。
+
+Streamlit に依存しないため、バッチ処理・ワーカー・テストから直接 import できる。
+UI は app.py、コマンドラインは cli.py を参照。
+"""
+
+import os
+import array
+import math
+import bisect
+import random
+import fractions
+import functools
+import hashlib
+import itertools
+import re
+import copy
+import csv
+import io
+import json
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from decimal import Decimal, InvalidOperation
+from typing import Callable, List, Dict, Iterable, Iterator, Sequence, Tuple, Union, Optional, NamedTuple
+
+from divisors import FactorRange, sample_gcd, sample_lcm
+from exprtree import BinOp, Num, evaluate, integer, rand_decimal, rand_proper_fraction, render, to_answer
+
+logger = logging.getLogger(__name__)
+
+# ------------------------------------------------------------------------------
+# 出題プリセット表
+# ------------------------------------------------------------------------------
+PRESET_TABLE: Dict[str, Dict[str, List[str]]] = {
+    "小3": {
+        "整数のたし算・ひき算": [
+            "2桁・2項の和差算", "2桁・3項の和差算", "3桁・3項の和差算", "4桁・4項の和差算", "5桁・5項の和差算"
+        ],
+        "かけ算の筆算": [
+            "2桁×1桁", "3桁×1桁", "2桁×2桁", "3桁×2桁", "3桁×3桁"
+        ],
+        "わり算（あまりあり）": [
+            "2〜50", "10〜200", "50〜1000", "200〜5000", "1000〜20000"
+        ],
+    },
+    "小4": {
+        "大きな数と筆算": [
+            "4桁・2項の和差算", "5桁・2項の和差算", "6桁・2項の和差算", "3桁・2項の積", "4桁・2項の積"
+        ],
+        "小数の四則": [
+            "小数第1位の2項の和差算", "小数第2位の2項の和差算", "小数第1位の2項の積商算", "小数第2位の2項の積商算", "小数第1位の3項の和差積商混合算"
+        ],
+        "約数・倍数（計算）": [
+            "30〜100くらいの小さい整数の公約数",   # L1: GCD
+            "50〜200の整数の公約数",               # L2: GCD
+            "素因数分解を意識した数（2桁〜3桁）",   # L3: GCD
+            "3つの数の公倍数",                     # L4: LCM
+            "3つの数の公約数"                      # L5: GCD
+        ],
+        "分数のたし算・ひき算": [
+            "分母1桁・2項の和差算", "分母2桁・2項の和差算", "分母1桁・3項の和差算", "分母2桁・3項の和差算", "文章題"
+        ],
+    },
+    "小5": {
+        "分数の四則混合": ["frac_terms 2〜3", "同上", "3", "3", "3"],
+        "小数×分数・分数×分数": ["frac_mixed", "同上", "同上", "同上", "同上"],
+        "割合の基本計算": ["of/up/down", "同上", "reverse", "chain", "chain"],
+        "比の基本計算": ["簡単比", "同上", "同上", "難易度高", "難易度高"],
+    },
+    "小6": {
+        "分数・小数の複合計算": ["frac+decimal", "同上", "同上", "同上", "同上"],
+        "逆算（□を求める）": ["基本", "同上", "同上", "同上", "同上"],
+        "最大公約数・最小公倍数": ["簡単", "同上", "同上", "高難度", "高難度"],  # L1-3: GCD, L4-5: LCM
+        "比例・反比例の基本計算": ["基本", "同上", "同上", "難易度高", "難易度高"],
+    },
+}
+
+# ------------------------------------------------------------------------------
+# ユーティリティ
+# ------------------------------------------------------------------------------
+def problem_rng(seed: int, index: int) -> random.Random:
+    # 問題ごとの独立した乱数系列。プロセス全体の random は使わないので、
+    # 同時に走るセッションやスレッド同士で系列が混ざらない
+    return random.Random((seed << 32) + index)
+
+def rand_int_with_digits(rng: random.Random, d: int) -> int:
+    lo = 10 ** (d - 1)
+    hi = 10 ** d - 1
+    return rng.randint(lo, hi)
+
+def rand_nonzero(rng: random.Random, a: int, b: int) -> int:
+    while True:
+        x = rng.randint(a, b)
+        if x != 0:
+            return x
+
+def simplify_fraction(fr: fractions.Fraction) -> fractions.Fraction:
+    return fractions.Fraction(fr.numerator, fr.denominator)
+
+def format_fraction(fr: fractions.Fraction) -> str:
+    if fr.denominator == 1:
+        return str(fr.numerator)
+    return f"{fr.numerator}/{fr.denominator}"
+
+def lcm(a: int, b: int) -> int:
+    return abs(a * b) // math.gcd(a, b)
+
+def lcmm(*args: int) -> int:
+    v = 1
+    for x in args:
+        v = lcm(v, x)
+    return v
+
+# ------------------------------------------------------------------------------
+# 答えの型（表示文字列とは別に、検証・採点で使う構造化された値）
+# ------------------------------------------------------------------------------
+class Remainder(NamedTuple):
+    quotient: int
+    remainder: int
+
+class Ratio(NamedTuple):
+    left: int
+    right: int
+
+class AnswerPair(NamedTuple):
+    # 小数の四則レベル5（2問セット）の答え
+    first: "AnswerValue"
+    second: "AnswerValue"
+
+AnswerValue = Union[int, fractions.Fraction, Decimal, Remainder, Ratio, AnswerPair]
+
+# ジェネレータの戻り値: (問題, 答えの表示, 答えの値)
+GenResult = Tuple[str, str, AnswerValue]
+
+# ------------------------------------------------------------------------------
+# PDF: 日本語フォント対応 + フォールバック
+# ------------------------------------------------------------------------------
+@functools.lru_cache(maxsize=None)
+def find_japanese_font() -> Union[str, None]:
+    # 候補のパスを調べるのはプロセスで一度だけ（Streamlit の再実行ごとに stat しない）
+    here = os.path.dirname(os.path.abspath(__file__))
+    candidates = [
+        os.path.join(here, "assets", "NotoSansJP-Regular.ttf"),
+        os.path.join(here, "assets", "NotoSansJP-Regular.otf"),
+        "assets/NotoSansJP-Regular.ttf",
+        "assets/NotoSansJP-Regular.otf",
+        "/usr/share/fonts/truetype/noto/NotoSansJP-Regular.ttf",
+        "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
+        "/usr/share/fonts/truetype/noto/NotoSansCJK-Regular.ttc",
+    ]
+    for p in candidates:
+        if os.path.isfile(p):
+            return p
+    return None
+
+# プロセス内で共有する日本語フォント: (パス, ファイルの中身, 解析済みのひな型)
+# ひな型は文字幅・cmap など全グリフ分の解析結果を持ち、文書ごとにはサブセットだけを作り直す
+_FONT_CACHE: Dict[str, Optional[tuple]] = {}
+_FONT_LOCK = threading.Lock()
+
+def _load_font_entry() -> Optional[tuple]:
+    from fpdf import FPDF
+
+    font_path = find_japanese_font()
+    if not font_path:
+        return None
+    with open(font_path, "rb") as f:
+        data = f.read()
+    loader = FPDF()
+    loader.add_font("JP", "", font_path)
+    template = loader.fonts["jp"]
+    # cmap の全サブテーブル・post（グリフ名）・グリフ順をここで解析しておく
+    # （_share_decoded_tables で文書ごとに使い回す）
+    for table in template.ttfont["cmap"].tables:
+        table.ensureDecompiled()
+    if "post" in template.ttfont:
+        template.ttfont["post"]
+    template.ttfont.getGlyphOrder()
+    return font_path, data, template
+
+def _share_decoded_tables(template, ttfont) -> None:
+    # 開き直した TTFont に、ひな型の解析済みの cmap（数万項目の辞書）・post・グリフ順を渡す。
+    # サブセット化はこれらの表の属性（cmap の表の一覧と各サブテーブルの辞書、post の形式と名前の一覧）を
+    # 新しいものに置き換えるだけで、元の辞書やリストは書き換えないので、浅いコピーで足りる
+    src = template["cmap"]
+    cmap = copy.copy(src)
+    cmap.tables = [copy.copy(t) for t in src.tables]
+    ttfont.tables["cmap"] = cmap
+    if "post" in template:
+        ttfont.tables["post"] = copy.copy(template["post"])
+    ttfont.setGlyphOrder(list(template.getGlyphOrder()))
+
+def _font_entry() -> Optional[tuple]:
+    with _FONT_LOCK:
+        if "jp" not in _FONT_CACHE:
+            try:
+                _FONT_CACHE["jp"] = _load_font_entry()
+            except Exception:
+                logger.warning("日本語フォントの読み込みに失敗した", exc_info=True)
+                _FONT_CACHE["jp"] = None
+        return _FONT_CACHE["jp"]
+
+def warm_font_cache() -> Optional[str]:
+    """フォントの探索と解析を先に済ませる（サーバ起動時用）。見つかったフォントのパスを返す。"""
+    entry = _font_entry()
+    return entry[0] if entry else None
+
+def _attach_cached_font(pdf) -> bool:
+    # キャッシュ済みのひな型を複製して pdf に "JP" として登録する。
+    # サブセット化は TTFont を書き換えるので、TTFont だけはメモリ上のバイト列から開き直す（lazy なので安い）。
+    # 解析に時間のかかる cmap とグリフ順はひな型のものを渡す
+    entry = _font_entry()
+    if entry is None:
+        return False
+    font_path, data, template = entry
+    try:
+        from fontTools import ttLib
+
+        font = copy.copy(template)
+        font.i = len(pdf.fonts) + 1
+        font.ttfont = ttLib.TTFont(io.BytesIO(data), recalcTimestamp=False,
+                                   fontNumber=template.collection_font_number, lazy=True)
+        _share_decoded_tables(template.ttfont, font.ttfont)
+        font.missing_glyphs = []
+        font.biggest_size_pt = 0
+        font.subset = type(template.subset)(font)
+        pdf.fonts["jp"] = font
+    except Exception:
+        # fpdf2 の内部構造が違う版では、毎回 add_font する従来の方法に戻す
+        pdf.fonts.pop("jp", None)
+        pdf.add_font("JP", "", font_path)
+    return True
+
+def ascii_safe(text: str) -> str:
+    return text.encode("latin-1", "replace").decode("latin-1")
+
+def to_bytes(x) -> bytes:
+    if isinstance(x, (bytes, bytearray)):
+        return bytes(x)
+    return x.encode("latin-1", "ignore")
+
+# ------------------------------------------------------------------------------
+# PDF生成：1ページ目=問題、2ページ目=模範解答
+# ------------------------------------------------------------------------------
+# PDF に書く作成日時。毎回同じにして、同じ問題からは同じバイト列の PDF ができるようにする
+# （/ID も作成日時と中身から決まる）。reproducible builds の SOURCE_DATE_EPOCH があればそれを使う
+PDF_CREATION_DATE = datetime.fromtimestamp(int(os.environ.get("SOURCE_DATE_EPOCH", "946684800")), tz=timezone.utc)
+
+def _new_pdf():
+    """日本語フォントを付けた空の A4 文書と、文字列の変換関数を返す。"""
+    # fpdf の import は重いので、PDF を作るときだけ読み込む
+    from fpdf import FPDF
+
+    pdf = FPDF(orientation="P", unit="mm", format="A4")
+    pdf.set_creation_date(PDF_CREATION_DATE)
+    pdf.set_auto_page_break(auto=True, margin=15)
+
+    use_unicode = False
+    try:
+        if _attach_cached_font(pdf):
+            pdf.set_font("JP", size=16)
+            use_unicode = True
+        else:
+            pdf.set_font("Helvetica", size=16)
+    except Exception:
+        pdf.set_font("Helvetica", size=16)
+
+    write = (lambda s: s) if use_unicode else ascii_safe
+    return pdf, write
+
+def _render_worksheet(pdf, write: Callable[[str], str], title: str, header_meta: Dict[str, str],
+                      questions: Sequence[str], answers: Sequence[str], labels: Iterable[str], first: int = 1) -> None:
+    """問題ページと解答ページを pdf の末尾に追加する。問番号は first から振る。"""
+    from fpdf.enums import XPos, YPos
+
+    # 1ページ目：問題
+    pdf.add_page()
+    pdf.set_font_size(16)
+    pdf.cell(0, 10, text=write(title), new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+    pdf.set_font_size(11)
+    for k, v in header_meta.items():
+        pdf.cell(0, 7, text=write(f"{k}: {v}"), new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+    pdf.ln(2)
+
+    pdf.set_font_size(12)
+    for i, (q, meta) in enumerate(zip(questions, labels), first):
+        pdf.multi_cell(0, 7, text=write(f"Q{i}. {q}"))
+        if meta:
+            pdf.set_text_color(100, 100, 100)
+            pdf.cell(0, 5, text=write(f"（プリセット: {meta}）"), new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+            pdf.set_text_color(0, 0, 0)
+        pdf.ln(1)
+
+    # 2ページ目：解答
+    pdf.add_page()
+    pdf.set_font_size(16)
+    pdf.cell(0, 10, text=write("模範解答"), new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+    pdf.set_font_size(12)
+    for i, a in enumerate(answers, first):
+        pdf.cell(0, 6, text=write(f"Q{i}. {a}"), new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+
+def _problem_columns(problems: List[Dict]) -> Tuple[List[str], List[str], List[str]]:
+    return ([p["question"] for p in problems], [p["answer"] for p in problems],
+            [p.get("meta", "") for p in problems])
+
+def build_pdf(title: str, header_meta: Dict[str, str], problems: List[Dict], first: int = 1) -> bytes:
+    return build_pdf_columns(title, header_meta, *_problem_columns(problems), first=first)
+
+def build_pdf_columns(title: str, header_meta: Dict[str, str], questions: Sequence[str], answers: Sequence[str],
+                      labels: Iterable[str], first: int = 1) -> bytes:
+    """build_pdf と同じ PDF を、問題・答え・プリセット表示の列から作る（ProblemSet 用）。"""
+    pdf, write = _new_pdf()
+    _render_worksheet(pdf, write, title, header_meta, questions, answers, labels, first)
+    return to_bytes(pdf.output(dest="S"))
+
+def build_pdf_bundle(sheets: List[Tuple[str, Dict[str, str], List[Dict]]]) -> bytes:
+    """(title, header_meta, problems) の並びを 1 つの PDF にまとめる。フォントは 1 回だけ埋め込まれる。"""
+    pdf, write = _new_pdf()
+    for title, header_meta, problems in sheets:
+        _render_worksheet(pdf, write, title, header_meta, *_problem_columns(problems))
+    return to_bytes(pdf.output(dest="S"))
+
+# ------------------------------------------------------------------------------
+# バリデーション（負数の除外、LCM=1除外、GCD=1除外）
+# ------------------------------------------------------------------------------
+def answer_is_negative(ans: Union[str, AnswerValue]) -> bool:
+    v = parse_answer(ans) if isinstance(ans, str) else ans
+    if v is None:
+        return False
+    t = type(v)
+    if t is Remainder:
+        return v.quotient < 0
+    if t is Ratio:
+        return False
+    if t is AnswerPair:
+        return answer_is_negative(v.first) or answer_is_negative(v.second)
+    return v < 0
+
+def is_lcm_context(grade: str, field: str, level: int) -> bool:
+    if grade == "小4" and field == "約数・倍数（計算）" and level == 4:
+        return True
+    if grade == "小6" and field == "最大公約数・最小公倍数" and level >= 4:
+        return True
+    return False
+
+def is_gcd_context(grade: str, field: str, level: int) -> bool:
+    if grade == "小4" and field == "約数・倍数（計算）" and level in (1, 2, 3, 5):
+        return True
+    if grade == "小6" and field == "最大公約数・最小公倍数" and level <= 3:
+        return True
+    return False
+
+def _answer_is_one(ans: Union[str, AnswerValue]) -> bool:
+    v = parse_answer(ans) if isinstance(ans, str) else ans
+    return type(v) is int and v == 1
+
+def lcm_answer_is_one(ans: Union[str, AnswerValue]) -> bool:
+    return _answer_is_one(ans)
+
+def gcd_answer_is_one(ans: Union[str, AnswerValue]) -> bool:
+    return _answer_is_one(ans)
+
+# プリセットごとの再試行統計: (学年, 分野, 難度) -> {"calls", "retries", "fallbacks"}
+# calls=生成した問題数、retries=バリデーションで捨てた回数、fallbacks=max_retry を使い切った回数
+_GEN_STATS: Dict[Tuple[str, str, int], Dict[str, int]] = {}
+_GEN_STATS_LOCK = threading.Lock()
+
+def _record_generation(key: Tuple[str, str, int], retries: int, fallback: bool) -> None:
+    with _GEN_STATS_LOCK:
+        st = _GEN_STATS.setdefault(key, {"calls": 0, "retries": 0, "fallbacks": 0})
+        st["calls"] += 1
+        st["retries"] += retries
+        st["fallbacks"] += int(fallback)
+
+def get_generation_stats() -> Dict[Tuple[str, str, int], Dict[str, int]]:
+    """このプロセスで集計した再試行統計のコピーを返す。"""
+    with _GEN_STATS_LOCK:
+        return {k: dict(v) for k, v in _GEN_STATS.items()}
+
+def reset_generation_stats() -> None:
+    with _GEN_STATS_LOCK:
+        _GEN_STATS.clear()
+
+def _generate_checked(gen_callable, rng: random.Random, key: Tuple[str, str, int],
+                      lcm_check: bool, gcd_check: bool, max_retry: int) -> GenResult:
+    # 検証は構造化された値で行う（答えの文字列は読み直さない）
+    last: GenResult = ("", "", 0)
+    for attempt in range(max_retry):
+        q, a, v = gen_callable(rng)
+        last = (q, a, v)
+        if answer_is_negative(v):
+            continue
+        if lcm_check and lcm_answer_is_one(v):
+            continue
+        if gcd_check and gcd_answer_is_one(v):
+            continue
+        _record_generation(key, attempt, False)
+        return q, a, v
+    # ここに来るのは構成的に作れていないジェネレータだけ。黙って返さず記録を残す
+    _record_generation(key, max_retry, True)
+    logger.warning("generate_safe: %s/%s/L%d で %d 回再試行しても有効な問題が作れなかった: %r",
+                   *key, max_retry, last)
+    return last
+
+def generate_safe(gen_callable, *, rng: random.Random, grade: str, field: str, level: int,
+                  max_retry: int = 100) -> GenResult:
+    return _generate_checked(gen_callable, rng, (grade, field, level),
+                             is_lcm_context(grade, field, level), is_gcd_context(grade, field, level), max_retry)
+
+# ------------------------------------------------------------------------------
+# 出題ジェネレータ群
+# ------------------------------------------------------------------------------
+def gen_sum_diff(rng: random.Random, digits: int, terms: int) -> GenResult:
+    # 途中の値が負にならないように組み立てる（generate_safe での捨て直しが起きない）
+    lo = 10 ** (digits - 1)
+    val = rand_int_with_digits(rng, digits)
+    expr = str(val)
+    for _ in range(terms - 1):
+        op = rng.choice(["+", "-"])
+        n = rand_int_with_digits(rng, digits)
+        if op == "-" and n > val:
+            # 引けない項は、引ける範囲で引き直すか、たし算に切り替える
+            if val >= lo:
+                n = rng.randint(lo, val)
+            else:
+                op = "+"
+        val = val + n if op == "+" else val - n
+        expr += f" {op} {n}"
+    return f"{expr} =", str(val), val
+
+def _mul_problem(a: int, b: int) -> GenResult:
+    return f"{a} × {b} =", str(a * b), a * b
+
+def gen_mul(rng: random.Random, a_digits: int, b_digits: int) -> GenResult:
+    a = rand_int_with_digits(rng, a_digits)
+    b = rand_int_with_digits(rng, b_digits)
+    return _mul_problem(a, b)
+
+def _div_problem(a: int, b: int) -> GenResult:
+    q, r = divmod(a, b)
+    return f"{a} ÷ {b} =", f"{q} あまり {r}", Remainder(q, r)
+
+def gen_div_with_remainder(rng: random.Random, div_lo: int, div_hi: int) -> GenResult:
+    a = rng.randint(div_lo, div_hi)
+    b = rand_nonzero(rng, 2, max(2, min(9, a)))
+    q, r = divmod(a, b)
+    if r == 0:
+        r = rng.randint(1, b - 1)
+        a = q * b + r
+    return _div_problem(a, b)
+
+def gen_large_sumdiff(rng: random.Random, digits: int) -> GenResult:
+    a = rand_int_with_digits(rng, digits)
+    b = rand_int_with_digits(rng, digits)
+    op = rng.choice(["+", "-"])
+    if op == "-" and b > a:
+        a, b = b, a
+    val = a + b if op == "+" else a - b
+    return f"{a} {op} {b} =", str(val), val
+
+def gen_decimal_addsub(rng: random.Random, places: int) -> GenResult:
+    a = rand_decimal(rng, 1, 100, places)
+    b = rand_decimal(rng, 1, 100, places)
+    op = rng.choice(["+", "-"])
+    if op == "-" and b.value > a.value:
+        a, b = b, a
+    e = BinOp(op, a, b)
+    return f"{render(e)} =", *to_answer(evaluate(e))
+
+def gen_decimal_muldiv(rng: random.Random, places: int) -> GenResult:
+    op = rng.choice(["×", "÷"])
+    if op == "×":
+        e = BinOp(op, rand_decimal(rng, 0.5, 50, places), rand_decimal(rng, 0.5, 50, places))
+    else:
+        # わる数を小数 places 桁で選び、わられる数が小数 places 桁以内になる商を選ぶ（割り切れる問題になる）。
+        # 商の単位 10**-places の数は、10**places // gcd(わる数の単位数, 10**places) の倍数に限る
+        b = rand_decimal(rng, 0.5, 10, places)
+        scale = 10 ** places
+        step = scale // math.gcd(b.value.numerator * (scale // b.value.denominator), scale)
+        q = fractions.Fraction(rng.randint(-(-round(0.5 * scale) // step), 20 * scale // step) * step, scale)
+        a = b.value * q
+        e = BinOp(op, Num(a, to_answer(a)[0]), b)
+    return f"{render(e)} =", *to_answer(evaluate(e))
+
+def gen_gcd_range(rng: random.Random, lo: int, hi: int, count: Optional[int] = 2,
+                  factors: FactorRange = None) -> GenResult:
+    # 答えの g (>=2) を約数索引から先に選び、商が互いに素な g の倍数を count 個並べる（divisors.py）
+    # count=None なら 2 個か 3 個をランダムに選ぶ。factors は g の素因数の個数の (下限, 上限)
+    if count is None:
+        count = rng.choice([2, 3])
+    nums, g = sample_gcd(rng, lo, hi, count, factors=factors)
+    return f"次の数の最大公約数を求めよ: {', '.join(map(str, nums))}", str(g), g
+
+def gen_lcm_range(rng: random.Random, lo: int, hi: int, count: Optional[int] = 2,
+                  factors: FactorRange = None, max_lcm: Optional[int] = None) -> GenResult:
+    # [lo, hi] の組を最小公倍数ごとに分けた索引から選ぶ。factors は組の最大公約数の素因数の個数、
+    # max_lcm は答えの上限（None なら範囲内のどの組でもよい）
+    if count is None:
+        count = rng.choice([2, 3])
+    nums, v = sample_lcm(rng, lo, hi, count, factors=factors, max_lcm=max_lcm)
+    return f"次の数の最小公倍数を求めよ: {', '.join(map(str, nums))}", str(v), v
+
+def gen_fraction_addsub(rng: random.Random, den_digits: int, terms: int) -> GenResult:
+    frs = []
+    for _ in range(terms):
+        # 分母 1 は真分数が作れない（randint(1, 0) になる）ので 2 以上から引く
+        den = rng.randint(max(2, 10 ** (den_digits - 1)), 10 ** den_digits - 1)
+        num = rng.randint(1, den - 1)
+        frs.append(fractions.Fraction(num, den))
+    ops = [rng.choice(["+", "-"]) for _ in range(terms - 1)]
+    v = frs[0]
+    expr = format_fraction(frs[0])
+    for i, op in enumerate(ops, 1):
+        # 途中で負になる引き算はたし算に切り替える
+        if op == "+" or frs[i] > v:
+            v += frs[i]
+            expr += f" + {format_fraction(frs[i])}"
+        else:
+            v -= frs[i]
+            expr += f" - {format_fraction(frs[i])}"
+    v = simplify_fraction(v)
+    return f"{expr} =", format_fraction(v), v
+
+def gen_fraction_mixed(rng: random.Random) -> GenResult:
+    if rng.choice([True, False]):
+        e = BinOp("×", rand_decimal(rng, 0.1, 9.9, 1), rand_proper_fraction(rng))
+        return f"{render(e)} =", *to_answer(evaluate(e))
+    else:
+        den1 = rng.randint(2, 12); num1 = rng.randint(1, den1 - 1)
+        den2 = rng.randint(2, 12); num2 = rng.randint(1, den2 - 1)
+        fr1 = fractions.Fraction(num1, den1)
+        fr2 = fractions.Fraction(num2, den2)
+        v = simplify_fraction(fr1 * fr2)
+        return f"{format_fraction(fr1)} × {format_fraction(fr2)} =", format_fraction(v), v
+
+def _ratio_problem(a: int, b: int, k: Optional[int]) -> GenResult:
+    # k が None なら「最も簡単な比に直す」問題
+    if k is None:
+        g = math.gcd(a, b)
+        return f"{a}:{b} を最も簡単な比に直せ。", f"{a//g}:{b//g}", Ratio(a // g, b // g)
+    return f"{a}:{b} を {k}倍した比を求めよ。", f"{a*k}:{b*k}", Ratio(a * k, b * k)
+
+def gen_ratio_basic(rng: random.Random, hard: bool=False) -> GenResult:
+    a = rng.randint(2, 30)
+    b = rng.randint(2, 30)
+    return _ratio_problem(a, b, None if hard else rng.randint(2, 9))
+
+def gen_percent_basic(rng: random.Random, mode: str) -> GenResult:
+    if mode == "of/up/down":
+        mode = rng.choice(["of", "up", "down"])
+    if mode in ("of", "up", "down"):
+        base = rng.randint(50, 500)
+        p = rng.choice([5, 10, 12, 20, 25, 30, 40, 50])
+        if mode == "of":
+            q, v = f"{base} の {p}% は？", fractions.Fraction(base * p, 100)
+        elif mode == "up":
+            q, v = f"{base} を {p}% 増やすと？", fractions.Fraction(base * (100 + p), 100)
+        else:
+            q, v = f"{base} を {p}% 減らすと？", fractions.Fraction(base * (100 - p), 100)
+    elif mode == "reverse":
+        # 元の数 x と y = x × p/100 がどちらも整数になるよう、x を 100/gcd(p, 100) の倍数から選ぶ
+        p = rng.choice([120, 150, 80, 75, 200])
+        g = math.gcd(p, 100)
+        y_step = p // g
+        k = rng.randint(-(-100 // y_step), 600 // y_step)
+        y, v = k * y_step, fractions.Fraction(k * (100 // g))
+        q = f"ある数の {p}% が {y}。元の数はいくつ？"
+    else:  # chain
+        base = rng.randint(100, 800)
+        p1 = rng.choice([10, 20, 25]); p2 = rng.choice([10, 20, 25])
+        v = fractions.Fraction(base * (100 + p1) * (100 - p2), 100 * 100)
+        q = f"{base} を {p1}%増やし、その後 {p2}%減らすと？"
+    return q, *to_answer(v)
+
+def gen_frac_mixed_ops(rng: random.Random, terms: int) -> GenResult:
+    frs = []
+    for _ in range(terms):
+        den = rng.randint(2, 12)
+        num = rng.randint(1, den - 1)
+        frs.append(fractions.Fraction(num, den))
+    ops_all = ["+", "-", "×", "÷"]
+    ops = [rng.choice(ops_all) for _ in range(terms - 1)]
+    v = frs[0]
+    expr = format_fraction(frs[0])
+    for i, op in enumerate(ops, 1):
+        if op == "+":
+            v = v + frs[i]
+            expr += f" + {format_fraction(frs[i])}"
+        elif op == "-" and frs[i] <= v:
+            v = v - frs[i]
+            expr += f" - {format_fraction(frs[i])}"
+        elif op == "-":
+            # 途中で負になる引き算はたし算に切り替える
+            v = v + frs[i]
+            expr += f" + {format_fraction(frs[i])}"
+        elif op == "×":
+            v = v * frs[i]
+            expr += f" × {format_fraction(frs[i])}"
+        else:
+            v = v / frs[i]
+            expr += f" ÷ {format_fraction(frs[i])}"
+    v = simplify_fraction(v)
+    return f"{expr} =", format_fraction(v), v
+
+def gen_frac_decimal_combo(rng: random.Random) -> GenResult:
+    if rng.choice([True, False]):
+        a = rand_decimal(rng, 0.1, 9.9, 1)
+        f = rand_proper_fraction(rng)
+        op = rng.choice(["+", "-", "×", "÷"])
+        if op == "-" and a.value < f.value:
+            op = "+"
+        e = BinOp(op, a, f)
+    else:
+        f = rand_proper_fraction(rng)
+        a = rand_decimal(rng, 0.1, 9.9, 2)
+        op = rng.choice(["+", "-"])
+        # 負にならないよう、引き算は大きい方から引く形にする
+        e = BinOp("-", a, f) if op == "-" and f.value < a.value else BinOp(op, f, a)
+    return f"{render(e)} =", *to_answer(evaluate(e))
+
+_INVERSE_OPS = {"+": "-", "-": "+", "×": "÷", "÷": "×"}
+
+def _inverse_problem(op: str, a: int, b: int) -> GenResult:
+    # □ op a = b を逆の演算 b inv a で解く
+    x = evaluate(BinOp(_INVERSE_OPS[op], integer(b), integer(a)))
+    return f"□ {op} {a} = {b} の □ を求めよ。", *to_answer(x)
+
+def gen_inverse_basic(rng: random.Random) -> GenResult:
+    a = rng.randint(2, 20)
+    b = rng.randint(2, 20)
+    op = rng.choice(["+", "-", "×", "÷"])
+    if op == "+" and a > b:
+        a, b = b, a
+    return _inverse_problem(op, a, b)
+
+def gen_prop_basic(rng: random.Random, hard: bool=False) -> GenResult:
+    mode = rng.choice(["比例", "反比例"])
+    if mode == "比例":
+        k = rng.randint(1, 9)
+        x = rng.randint(2, 20)
+        y = k * x
+        if hard:
+            return f"y = kx。x={x} のとき y={y}。k を求めよ。", f"{k}", k
+        else:
+            return f"y = {k}x。x={x} のとき y は？", f"{y}", y
+    else:
+        k = rng.randint(10, 200)
+        x = rng.randint(2, 20)
+        y = k / x
+        if hard:
+            return f"xy = k。x={x} のとき y={round(y,2)}。k を求めよ。", f"{round(k,2)}", k
+        else:
+            s = f"{round(y,2)}"
+            return f"xy = {k}。x={x} のとき y は？", s, Decimal(s)
+
+def gen_decimal_mix(rng: random.Random) -> GenResult:
+    # 小数の和差と積商の2問セット
+    q1, a1, v1 = gen_decimal_addsub(rng, 1)
+    q2, a2, v2 = gen_decimal_muldiv(rng, 1)
+    q = q1.replace("=", "") + " と " + q2
+    a = f"{a1} / {a2}"
+    return q, a, AnswerPair(v1, v2)
+
+def gen_fraction_story(rng: random.Random) -> GenResult:
+    q0, a0, v0 = gen_fraction_addsub(rng, 1, 2)
+    q = f"りんごの重さは {q0.replace(' =','')} とします。合計の重さは？"
+    return q, a0, v0
+
+# ------------------------------------------------------------------------------
+# 問題空間（1 枚のプリント内で同じ問題を出さないため）
+# 異なる問題の数が数えられるジェネレータは、問題に 0〜size-1 の番号を付け、
+# シードで決まる順列から重複なしで選ぶ。数えられないものは出題済みの問題文を覚えておき、
+# 重なったときだけ引き直す。
+# ------------------------------------------------------------------------------
+class ProblemSpace(NamedTuple):
+    size: int                             # 異なる問題の数
+    unrank: Callable[[int], GenResult]    # 番号 -> 問題
+
+class ProblemSpaceExhausted(ValueError):
+    """そのプリセットで作れる異なる問題の数を超えて出題しようとした。"""
+
+def _pair_index(k: int) -> Tuple[int, int]:
+    # (0,0), (1,0), (1,1), (2,0), ... と並べた i >= j の組の k 番目
+    i = (math.isqrt(8 * k + 1) - 1) // 2
+    return i, k - i * (i + 1) // 2
+
+def _sum_diff_space(digits: int, terms: int) -> Optional[ProblemSpace]:
+    # 2 項だけ数える。a + b はすべての組、a - b は b <= a の組
+    if terms != 2:
+        return None
+    lo = 10 ** (digits - 1)
+    w = 9 * lo
+    plus = w * w
+
+    def unrank(k: int) -> GenResult:
+        if k < plus:
+            a, b = divmod(k, w)
+            a, b, op = lo + a, lo + b, "+"
+        else:
+            i, j = _pair_index(k - plus)
+            a, b, op = lo + i, lo + j, "-"
+        val = a + b if op == "+" else a - b
+        return f"{a} {op} {b} =", str(val), val
+    return ProblemSpace(plus + w * (w + 1) // 2, unrank)
+
+def _mul_space(a_digits: int, b_digits: int) -> ProblemSpace:
+    a_lo, b_lo = 10 ** (a_digits - 1), 10 ** (b_digits - 1)
+    nb = 9 * b_lo
+
+    def unrank(k: int) -> GenResult:
+        a, b = divmod(k, nb)
+        return _mul_problem(a_lo + a, b_lo + b)
+    return ProblemSpace(9 * a_lo * nb, unrank)
+
+def _div_space(div_lo: int, div_hi: int) -> ProblemSpace:
+    # わる数 b は 2〜9、わられる数 a は [max(lo, b), hi] のうち b で割り切れないもの
+    divisors, starts, total = [], [], 0
+    for b in range(2, 10):
+        a0 = max(div_lo, b)
+        if a0 > div_hi:
+            continue
+        count = (div_hi - a0 + 1) - (div_hi // b - (a0 - 1) // b)
+        divisors.append((b, a0))
+        starts.append(total)
+        total += count
+
+    def unrank(k: int) -> GenResult:
+        idx = bisect.bisect_right(starts, k) - 1
+        b, a0 = divisors[idx]
+        # b で割り切れない正の整数の t 番目（0 始まり）は t + t // (b - 1) + 1
+        t = (a0 - 1) - (a0 - 1) // b + (k - starts[idx])
+        return _div_problem(t + t // (b - 1) + 1, b)
+    return ProblemSpace(total, unrank)
+
+def _ratio_space(hard: bool) -> ProblemSpace:
+    # a, b は 2〜30、倍にする問題は k も 2〜9
+    if hard:
+        return ProblemSpace(29 * 29, lambda k: _ratio_problem(2 + k // 29, 2 + k % 29, None))
+
+    def unrank(k: int) -> GenResult:
+        ab, m = divmod(k, 8)
+        return _ratio_problem(2 + ab // 29, 2 + ab % 29, 2 + m)
+    return ProblemSpace(29 * 29 * 8, unrank)
+
+def _inverse_space() -> ProblemSpace:
+    # a, b は 2〜20。□ + a = b は a <= b の組だけ（□ が負にならない）
+    plus = 19 * 20 // 2
+
+    def unrank(k: int) -> GenResult:
+        if k < plus:
+            i, j = _pair_index(k)
+            return _inverse_problem("+", 2 + j, 2 + i)
+        m, ab = divmod(k - plus, 19 * 19)
+        return _inverse_problem(("-", "×", "÷")[m], 2 + ab // 19, 2 + ab % 19)
+    return ProblemSpace(plus + 3 * 19 * 19, unrank)
+
+# ジェネレータ名 -> 問題空間（引数はジェネレータと同じ。None なら数えない）
+_SPACE_BUILDERS: Dict[str, Callable[..., Optional[ProblemSpace]]] = {
+    "gen_sum_diff": _sum_diff_space,
+    "gen_mul": _mul_space,
+    "gen_div_with_remainder": _div_space,
+    "gen_ratio_basic": _ratio_space,
+    "gen_inverse_basic": _inverse_space,
+}
+
+def iter_sample_order(size: int, seed: int) -> Iterator[int]:
+    """0〜size-1 を並べ替えた順列を先頭から 1 つずつ返す（疎な Fisher–Yates）。
+
+    入れ替えた位置だけを辞書に持ち、通り過ぎた位置は捨てるので、保持するのは取り出した個数以下の整数である。
+    """
+    rng = random.Random(f"{seed}/space")
+    moved: Dict[int, int] = {}
+    for i in range(size):
+        j = i + rng.randrange(size - i)
+        vi = moved.pop(i, i)
+        if j == i:
+            yield vi
+        else:
+            yield moved.get(j, j)
+            moved[j] = vi
+
+def sample_order(size: int, seed: int, count: int) -> List[int]:
+    """0〜size-1 を並べ替えた順列の先頭 count 個（count が違っても先頭は同じ並び）。"""
+    return list(itertools.islice(iter_sample_order(size, seed), count))
+
+# ------------------------------------------------------------------------------
+# カリキュラム → 実際のジェネレータにマッピング（プリセット登録表）
+# ------------------------------------------------------------------------------
+# (学年, 分野) -> 難度1〜5の (ジェネレータ, 引数)
+_PRESET_SPECS: Dict[Tuple[str, str], List[Tuple[Callable[..., GenResult], tuple]]] = {
+    ("小3", "整数のたし算・ひき算"): [
+        (gen_sum_diff, (2, 2)), (gen_sum_diff, (2, 3)), (gen_sum_diff, (3, 3)), (gen_sum_diff, (4, 4)), (gen_sum_diff, (5, 5)),
+    ],
+    ("小3", "かけ算の筆算"): [
+        (gen_mul, (2, 1)), (gen_mul, (3, 1)), (gen_mul, (2, 2)), (gen_mul, (3, 2)), (gen_mul, (3, 3)),
+    ],
+    ("小3", "わり算（あまりあり）"): [
+        (gen_div_with_remainder, (2, 50)), (gen_div_with_remainder, (10, 200)), (gen_div_with_remainder, (50, 1000)),
+        (gen_div_with_remainder, (200, 5000)), (gen_div_with_remainder, (1000, 20000)),
+    ],
+    ("小4", "大きな数と筆算"): [
+        (gen_large_sumdiff, (4,)), (gen_large_sumdiff, (5,)), (gen_large_sumdiff, (6,)), (gen_mul, (3, 3)), (gen_mul, (4, 4)),
+    ],
+    ("小4", "小数の四則"): [
+        (gen_decimal_addsub, (1,)), (gen_decimal_addsub, (2,)), (gen_decimal_muldiv, (1,)), (gen_decimal_muldiv, (2,)),
+        (gen_decimal_mix, ()),
+    ],
+    ("小4", "約数・倍数（計算）"): [
+        (gen_gcd_range, (30, 100, 2)), (gen_gcd_range, (50, 200, 2)), (gen_gcd_range, (10, 999, 2, (2, None))),
+        (gen_lcm_range, (10, 50, 3)), (gen_gcd_range, (10, 200, 3)),
+    ],
+    ("小4", "分数のたし算・ひき算"): [
+        (gen_fraction_addsub, (1, 2)), (gen_fraction_addsub, (2, 2)), (gen_fraction_addsub, (1, 3)),
+        (gen_fraction_addsub, (2, 3)), (gen_fraction_story, ()),
+    ],
+    ("小5", "分数の四則混合"): [(gen_frac_mixed_ops, (2,))] + [(gen_frac_mixed_ops, (3,))] * 4,
+    ("小5", "小数×分数・分数×分数"): [(gen_fraction_mixed, ())] * 5,
+    ("小5", "割合の基本計算"): [
+        (gen_percent_basic, ("of/up/down",)), (gen_percent_basic, ("of/up/down",)), (gen_percent_basic, ("reverse",)),
+        (gen_percent_basic, ("chain",)), (gen_percent_basic, ("chain",)),
+    ],
+    ("小5", "比の基本計算"): [(gen_ratio_basic, (False,))] * 3 + [(gen_ratio_basic, (True,))] * 2,
+    ("小6", "分数・小数の複合計算"): [(gen_frac_decimal_combo, ())] * 5,
+    ("小6", "逆算（□を求める）"): [(gen_inverse_basic, ())] * 5,
+    ("小6", "最大公約数・最小公倍数"): [(gen_gcd_range, (10, 200, None))] * 3 + [(gen_lcm_range, (10, 60, None))] * 2,
+    ("小6", "比例・反比例の基本計算"): [(gen_prop_basic, (False,))] * 3 + [(gen_prop_basic, (True,))] * 2,
+}
+
+class PresetPlan(NamedTuple):
+    grade: str
+    field: str
+    level: int
+    label: str                                  # PRESET_TABLE の表示名
+    kind: str                                   # ジェネレータ名（"gen_sum_diff" など）
+    args: tuple                                 # ジェネレータに渡す引数
+    gen: Callable[[random.Random], GenResult]   # 引数を束ねたジェネレータ
+    lcm_check: bool                             # LCM=1 を除外するか
+    gcd_check: bool                             # GCD=1 を除外するか
+    space: Optional[ProblemSpace]               # 問題空間（数えられないジェネレータは None）
+
+def _bind(func: Callable[..., GenResult], args: tuple) -> Callable[[random.Random], GenResult]:
+    # rng を先頭に取るので functools.partial では束ねられない
+    def gen(rng: random.Random) -> GenResult:
+        return func(rng, *args)
+    return gen
+
+def _build_registry() -> Dict[Tuple[str, str, int], PresetPlan]:
+    registry = {}
+    for grade, fields in PRESET_TABLE.items():
+        for field, labels in fields.items():
+            specs = _PRESET_SPECS[(grade, field)]
+            if len(specs) != len(labels):
+                raise ValueError(f"preset spec mismatch: {grade}/{field} has {len(labels)} levels, {len(specs)} specs")
+            for level, (label, (func, args)) in enumerate(zip(labels, specs), 1):
+                space_builder = _SPACE_BUILDERS.get(func.__name__)
+                space = space_builder(*args) if space_builder else None
+                registry[(grade, field, level)] = PresetPlan(
+                    grade=grade, field=field, level=level, label=label,
+                    kind=func.__name__, args=args, gen=_bind(func, args),
+                    lcm_check=is_lcm_context(grade, field, level),
+                    gcd_check=is_gcd_context(grade, field, level),
+                    space=space,
+                )
+    return registry
+
+# 同じ (学年, 分野, 難度, 出題数, シード) に対する出力が変わる変更をしたら上げる
+# （キャッシュや問題バンクのキーに含める）
+GENERATOR_VERSION = 6
+
+# (学年, 分野, 難度) -> 生成プラン。import 時に一度だけ組み立てる
+PRESET_REGISTRY: Dict[Tuple[str, str, int], PresetPlan] = _build_registry()
+
+def resolve_preset(grade: str, field: str, level: int) -> PresetPlan:
+    return PRESET_REGISTRY[(grade, field, level)]
+
+def generate_from_plan(plan: PresetPlan, rng: random.Random, max_retry: int = 100) -> GenResult:
+    return _generate_checked(plan.gen, rng, (plan.grade, plan.field, plan.level),
+                             plan.lcm_check, plan.gcd_check, max_retry)
+
+# 重複した問題を引き直す回数の上限（超えたら作れる問題が尽きたとみなす）
+MAX_REDRAW = 200
+
+def _generate_raw(grade: str, field: str, level: int, seed: int, start: int, stop: int) -> List[GenResult]:
+    # 重複を気にせず、各問題を problem_rng(seed, i) の独立した系列から引く
+    plan = resolve_preset(grade, field, level)
+    return [generate_from_plan(plan, problem_rng(seed, i)) for i in range(start, stop)]
+
+def _problem_key(question: str) -> int:
+    # 既出かどうかの判定に使う 64 ビットの要約（問題文そのものより小さく、プロセスによらない）。0 は空きの印なので奇数にする
+    return int.from_bytes(hashlib.blake2b(question.encode("utf-8"), digest_size=8).digest(), "little") | 1
+
+class _KeySet:
+    """0 以外の 64 ビット整数の集合（開番地法）。1 要素あたり 16 バイト前後で、Python の set の数分の 1 である。"""
+
+    def __init__(self, capacity: int = 1024):
+        self._slots = array.array("Q", bytes(8 * capacity))
+        self._mask = capacity - 1
+        self._len = 0
+
+    def __len__(self) -> int:
+        return self._len
+
+    def _find(self, key: int) -> int:
+        slots, mask = self._slots, self._mask
+        i = key & mask
+        while slots[i] and slots[i] != key:
+            i = (i + 1) & mask
+        return i
+
+    def __contains__(self, key: int) -> bool:
+        return self._slots[self._find(key)] == key
+
+    def add(self, key: int) -> None:
+        i = self._find(key)
+        if self._slots[i]:
+            return
+        self._slots[i] = key
+        self._len += 1
+        if 2 * self._len > len(self._slots):
+            old = self._slots
+            self.__init__(2 * len(old))
+            for k in old:
+                if k:
+                    self._slots[self._find(k)] = k
+                    self._len += 1
+
+def _iter_deduped(plan: PresetPlan, seed: int, results: Iterable[GenResult], *,
+                  partial: bool = False) -> Iterator[GenResult]:
+    seen = _KeySet()
+    for i, res in enumerate(results):
+        attempt = 0
+        key = _problem_key(res[0])
+        while key in seen:
+            attempt += 1
+            if attempt > MAX_REDRAW:
+                if partial:
+                    return
+                raise ProblemSpaceExhausted(
+                    f"{plan.grade}/{plan.field}/level {plan.level}: no new problem for #{i + 1} "
+                    f"after {MAX_REDRAW} draws ({len(seen)} distinct so far)")
+            res = generate_from_plan(plan, random.Random(f"{seed}/{i}/{attempt}"))
+            key = _problem_key(res[0])
+        seen.add(key)
+        yield res
+
+def dedupe_results(plan: PresetPlan, seed: int, results: Iterable[GenResult], *,
+                   partial: bool = False) -> List[GenResult]:
+    """
+    先頭から順に見て、既出の問題文と重なったものを引き直す。問題 i はそれより前の問題だけで決まる。
+    引き直しても新しい問題が出なければ ProblemSpaceExhausted（partial=True ならそこまでを返す）。
+    """
+    return list(_iter_deduped(plan, seed, results, partial=partial))
+
+def _check_space(plan: PresetPlan, stop: int) -> None:
+    if plan.space is not None and stop > plan.space.size:
+        raise ProblemSpaceExhausted(
+            f"{plan.grade}/{plan.field}/level {plan.level} has only {plan.space.size} distinct problems, "
+            f"{stop} requested")
+
+def _unique_results(plan: PresetPlan, seed: int, start: int, stop: int) -> List[GenResult]:
+    if plan.space is not None:
+        _check_space(plan, stop)
+        return [plan.space.unrank(k) for k in sample_order(plan.space.size, seed, stop)[start:]]
+    # 引き直しは前の問題に依存するので、先頭から作って重複を除く
+    raw = _generate_raw(plan.grade, plan.field, plan.level, seed, 0, stop)
+    return dedupe_results(plan, seed, raw)[start:]
+
+def _to_rows(plan: PresetPlan, results: Iterable[GenResult]) -> List[Dict]:
+    return list(_iter_rows(plan, results))
+
+def _iter_rows(plan: PresetPlan, results: Iterable[GenResult]) -> Iterator[Dict]:
+    for q, a, v in results:
+        yield {"問題": q, "答え": a, "プリセット": plan.label, "値": v}
+
+def generate_by_preset(grade: str, field: str, level: int, n: int, seed: int = 0, start: int = 0) -> List[Dict]:
+    """
+    同じシードの問題列の start 番目から n 問を返す。1 つの問題列の中で同じ問題は出ない。
+    問題空間が数えられるプリセットは、シードで決まる順列から重複なしで選ぶ。
+    それ以外は各問題を problem_rng(seed, i) から引き、既出と重なったものだけ引き直す。
+    どちらも問題 i はそれより前の問題だけで決まり、出題数 n にはよらない。
+    異なる問題が足りなければ ProblemSpaceExhausted を投げる。
+    各行の "値" は答えの構造化された値（検証・採点用）。
+    """
+    plan = resolve_preset(grade, field, level)
+    return _to_rows(plan, _unique_results(plan, seed, start, start + n))
+
+def generate_results(grade: str, field: str, level: int, n: int, seed: int = 0, start: int = 0) -> List[GenResult]:
+    """generate_by_preset と同じ問題を (問題, 答えの表示, 答えの値) のまま返す（行の辞書を作らない）。"""
+    return _unique_results(resolve_preset(grade, field, level), seed, start, start + n)
+
+def iter_by_preset(grade: str, field: str, level: int, seed: int = 0, start: int = 0,
+                   n: Optional[int] = None) -> Iterator[Dict]:
+    """
+    generate_by_preset と同じ問題列を 1 問ずつ返す（n=None なら作れる限り続ける）。
+    行をまとめて持たないので、10^5〜10^6 問でも保持するのは重複判定用の問題ごとの小さな整数だけである。
+    """
+    plan = resolve_preset(grade, field, level)
+    stop = None if n is None else start + n
+    if plan.space is not None:
+        if stop is not None:
+            _check_space(plan, stop)
+        order = itertools.islice(iter_sample_order(plan.space.size, seed), start, stop)
+        yield from _iter_rows(plan, (plan.space.unrank(k) for k in order))
+        return
+    indices = itertools.count() if stop is None else range(stop)
+    raw = (generate_from_plan(plan, problem_rng(seed, i)) for i in indices)
+    yield from _iter_rows(plan, itertools.islice(_iter_deduped(plan, seed, raw), start, None))
+
+def generate_distinct(grade: str, field: str, level: int, limit: int, seed: int = 0) -> List[Dict]:
+    """異なる問題を最大 limit 問返す（作れる問題が尽きたらそこまで）。問題バンクの作成用。"""
+    plan = resolve_preset(grade, field, level)
+    if plan.space is not None:
+        return generate_by_preset(grade, field, level, min(limit, plan.space.size), seed)
+    raw = _generate_raw(grade, field, level, seed, 0, limit)
+    return _to_rows(plan, dedupe_results(plan, seed, raw, partial=True))
+
+def generate_parallel(grade: str, field: str, level: int, n: int, seed: int = 0, *,
+                      workers: Optional[int] = None, shard_size: int = 2000) -> List[Dict]:
+    """n 問を shard_size ごとに分けてプロセスプールで生成する。結果は generate_by_preset と同一。"""
+    if n <= shard_size or workers == 1:
+        return generate_by_preset(grade, field, level, n, seed)
+    plan = resolve_preset(grade, field, level)
+    _check_space(plan, n)
+    results: List[GenResult] = []
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        if plan.space is not None:
+            # 順列の区間ごとに分ける（番号から問題を直接作れる）
+            futures = [ex.submit(generate_by_preset, grade, field, level, min(shard_size, n - s), seed, s)
+                       for s in range(0, n, shard_size)]
+            return [row for f in futures for row in f.result()]
+        # 重複を気にしない生成だけを分け、引き直しはまとめてこのプロセスで行う
+        futures = [ex.submit(_generate_raw, grade, field, level, seed, s, min(n, s + shard_size))
+                   for s in range(0, n, shard_size)]
+        for f in futures:
+            results.extend(f.result())
+    return _to_rows(plan, dedupe_results(plan, seed, results))
+
+# ------------------------------------------------------------------------------
+# 採点用：答えの正規化と比較
+# ------------------------------------------------------------------------------
+_DIV_EXPR_RE = re.compile(r"^\s*([-+]?\d+(?:\.\d+)?)\s*/\s*([-+]?\d+(?:\.\d+)?)\s*$")
+_FRAC_RE = re.compile(r"^\s*([-+]?\d+)\s*/\s*(\d+)\s*$")
+_RATIO_RE = re.compile(r"^\s*([-+]?\d+)\s*:\s*([-+]?\d+)\s*$")
+_REMAINDER_RE = re.compile(r"^\s*([-+]?\d+)\s*あまり\s*([-+]?\d+)\s*$")
+
+def _parse_number_like(s: str) -> Optional[float]:
+    try:
+        return float(s)
+    except Exception:
+        return None
+
+def _parse_fraction(s: str) -> Optional[fractions.Fraction]:
+    m = _FRAC_RE.match(s)
+    if not m:
+        return None
+    num = int(m.group(1)); den = int(m.group(2))
+    if den == 0:
+        return None
+    return fractions.Fraction(num, den)
+
+def _parse_ratio(s: str) -> Optional[Tuple[int, int]]:
+    m = _RATIO_RE.match(s)
+    if not m:
+        return None
+    a = int(m.group(1)); b = int(m.group(2))
+    if b == 0:
+        return None
+    g = math.gcd(a, b)
+    a //= g; b //= g
+    # 比は正に限定しているため負はここでは扱わない
+    return (a, b)
+
+def _parse_remainder(s: str) -> Optional[Tuple[int, int]]:
+    m = _REMAINDER_RE.match(s)
+    if not m:
+        return None
+    q = int(m.group(1)); r = int(m.group(2))
+    return (q, r)
+
+def parse_answer(s: str) -> Optional[AnswerValue]:
+    """答えの表示文字列を構造化された値に戻す。値を持たない入力（古い CSV など）用。"""
+    s = str(s).strip()
+    rem = _parse_remainder(s)
+    if rem is not None:
+        return Remainder(*rem)
+    m = _RATIO_RE.match(s)
+    if m and int(m.group(2)) != 0:
+        return Ratio(int(m.group(1)), int(m.group(2)))
+    fr = _parse_fraction(s)
+    if fr is not None:
+        return fr
+    m = _DIV_EXPR_RE.match(s)
+    if m:
+        return AnswerPair(Decimal(m.group(1)), Decimal(m.group(2)))
+    try:
+        return int(s)
+    except ValueError:
+        pass
+    try:
+        d = Decimal(s)
+    except InvalidOperation:
+        return None
+    return d if d.is_finite() else None
+
+# 答えの値の型の番号（問題バンクに 1 行 1 バイトで保存する。並びを変えないこと）。
+# 表示だけでは型が決まらない答えがある（2 問セットの「26 / 6」は分数とも読める）ので、型と一緒に戻す
+ANSWER_KINDS: Tuple[type, ...] = (int, Decimal, fractions.Fraction, Remainder, Ratio, AnswerPair)
+
+def answer_kind(v: AnswerValue) -> int:
+    return ANSWER_KINDS.index(type(v))
+
+def decode_answer(s: str, kind: int) -> Optional[AnswerValue]:
+    """答えの表示を型 ANSWER_KINDS[kind] の値として読む。表示がその型として読めなければ None。"""
+    t = ANSWER_KINDS[kind]
+    if t is AnswerPair:
+        m = _DIV_EXPR_RE.match(s)
+        if not m:
+            return None
+        first, second = parse_answer(m.group(1)), parse_answer(m.group(2))
+        return None if first is None or second is None else AnswerPair(first, second)
+    v = parse_answer(s)
+    if type(v) is t:
+        return v
+    # 整数になった分数（表示は "1"）など、数は表示より広い型で持っていることがある
+    if t is fractions.Fraction and type(v) in (int, Decimal):
+        return fractions.Fraction(v)
+    if t is Decimal and type(v) is int:
+        return Decimal(v)
+    return None
+
+def _compare_remainder(ev: Remainder, us: str, tol: float) -> bool:
+    u_rem = _parse_remainder(us)
+    return (u_rem is not None) and (tuple(ev) == u_rem)
+
+def _compare_ratio(ev: Ratio, us: str, tol: float) -> bool:
+    # 比 a:b （ユーザは同値比OK）
+    u_ratio = _parse_ratio(us)
+    g = math.gcd(ev.left, ev.right)
+    return (u_ratio is not None) and ((ev.left // g, ev.right // g) == u_ratio)
+
+def _compare_fraction(ev: fractions.Fraction, us: str, tol: float) -> bool:
+    # 真分数（既約でなくてもOK）
+    u_frac = _parse_fraction(us)
+    if u_frac is not None:
+        return ev == u_frac
+    # 小数で答えてもOK
+    u_num = _parse_number_like(us)
+    return (u_num is not None) and (abs(float(ev) - u_num) <= tol)
+
+def _compare_number(ev: Union[int, Decimal], us: str, tol: float) -> bool:
+    # ふつうの数値（整数・小数）
+    u_num = _parse_number_like(us)
+    if u_num is None:
+        # ユーザが a/b で入れた場合も許容
+        u_frac = _parse_fraction(us)
+        if u_frac is not None:
+            u_num = float(u_frac)
+    return (u_num is not None) and (abs(float(ev) - u_num) <= tol)
+
+def _compare_pair(ev: AnswerPair, us: str, tol: float) -> bool:
+    # 2問セット（小数の四則レベル5）は「x / y」で両方を答える
+    m = _DIV_EXPR_RE.match(us)
+    if not m:
+        return False
+    return (abs(float(ev.first) - float(m.group(1))) <= tol
+            and abs(float(ev.second) - float(m.group(2))) <= tol)
+
+_COMPARERS = {
+    Remainder: _compare_remainder,
+    Ratio: _compare_ratio,
+    fractions.Fraction: _compare_fraction,
+    int: _compare_number,
+    Decimal: _compare_number,
+    AnswerPair: _compare_pair,
+}
+
+def compare_answers(expected: Union[str, AnswerValue], user: str, tol: float = 1e-6) -> bool:
+    """
+    expected にはジェネレータが返した答えの値を渡す（答えの型で比較方法を選ぶ）。
+    文字列を渡した場合は parse_answer で値に戻してから比較する。
+    """
+    us = str(user).strip()
+    if us == "":
+        return False
+    ev = parse_answer(expected) if isinstance(expected, str) else expected
+    if ev is None:
+        # それ以外は完全一致で比較（ほぼ到達しない）
+        return str(expected).strip() == us
+    return _compare_cached(ev, us, tol)
+
+# 判定は (答えの値, 前後の空白を除いた解答, 許容誤差) だけで決まるので、プロセス全体で覚えておく。
+# typed=True で値の型も区別する（1 と Fraction(1) や、同じ数の組の Ratio と Remainder は別の比較になる）
+COMPARE_CACHE_SIZE = 65536
+
+@functools.lru_cache(maxsize=COMPARE_CACHE_SIZE, typed=True)
+def _compare_cached(ev: AnswerValue, us: str, tol: float) -> bool:
+    return _COMPARERS[type(ev)](ev, us, tol)
+
+def compare_cache_info() -> Dict[str, int]:
+    """compare_answers の判定キャッシュの状態（診断表示用）。"""
+    return _compare_cached.cache_info()._asdict()
+
+# ------------------------------------------------------------------------------
+# 出力用の整形（CSV / PDF 見出し）
+# ------------------------------------------------------------------------------
+ROW_COLUMNS = ["問題", "答え", "プリセット"]
+
+def build_header_meta(grade: str, field: str, level: int, n: int, seed: int) -> Dict[str, str]:
+    return {
+        "学年": grade,
+        "分野": field,
+        "難度": f"レベル{level}（{PRESET_TABLE[grade][field][level-1]}）",
+        "出題数": str(n),
+        "乱数シード": str(seed),
+    }
+
+def rows_to_pdf_problems(rows: List[Dict]) -> List[Dict]:
+    return [{"question": r["問題"], "answer": r["答え"], "meta": r["プリセット"]} for r in rows]
+
+def build_worksheet_pdf(rows: List[Dict], grade: str, field: str, level: int, n: int, seed: int) -> bytes:
+    return build_pdf(
+        title="算数ドリル",
+        header_meta=build_header_meta(grade, field, level, n, seed),
+        problems=rows_to_pdf_problems(rows),
+    )
+
+def rows_to_csv_bytes(rows: Iterable[Dict]) -> bytes:
+    # pandas の df.to_csv(index=False).encode("utf-8-sig") と同じ形式
+    return b"".join(iter_csv_chunks(rows))
+
+def rows_to_jsonl_bytes(rows: Iterable[Dict]) -> bytes:
+    return b"".join(iter_jsonl_chunks(rows))
+
+# ------------------------------------------------------------------------------
+# ストリーミング出力：行の iterable（iter_by_preset など）を少しずつ書き出す
+# ------------------------------------------------------------------------------
+# CSV / JSONL を 1 回に書き出す行数と、PDF 1 冊あたりの問題数
+STREAM_CHUNK = 10_000
+PDF_VOLUME = 500
+
+def _chunks(rows: Iterable[Dict], size: int) -> Iterator[List[Dict]]:
+    it = iter(rows)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+def iter_csv_chunks(rows: Iterable[Dict], chunk_size: int = STREAM_CHUNK) -> Iterator[bytes]:
+    """rows_to_csv_bytes と同じ CSV を chunk_size 行ずつのバイト列で返す（先頭に BOM とヘッダ）。"""
+    buf = io.StringIO()
+    w = csv.writer(buf, lineterminator="\n")
+    w.writerow(ROW_COLUMNS)
+    yield buf.getvalue().encode("utf-8-sig")
+    for chunk in _chunks(rows, chunk_size):
+        buf.seek(0)
+        buf.truncate()
+        w.writerows([r[c] for c in ROW_COLUMNS] for r in chunk)
+        yield buf.getvalue().encode("utf-8")
+
+def iter_jsonl_chunks(rows: Iterable[Dict], chunk_size: int = STREAM_CHUNK) -> Iterator[bytes]:
+    """1 行に 1 問の JSON（問題・答え・プリセット）を chunk_size 行ずつのバイト列で返す。"""
+    for chunk in _chunks(rows, chunk_size):
+        yield "".join(json.dumps({c: r[c] for c in ROW_COLUMNS}, ensure_ascii=False) + "\n"
+                      for r in chunk).encode("utf-8")
+
+def iter_pdf_volumes(rows: Iterable[Dict], grade: str, field: str, level: int, n: Optional[int], seed: int,
+                     volume_size: int = PDF_VOLUME) -> Iterator[bytes]:
+    """volume_size 問ごとに 1 冊（問題ページ＋解答ページ）の PDF を返す。問番号は冊をまたいで続ける。
+
+    fpdf2 は文書全体をメモリに持ってから出力するので、1 つの PDF に全問を入れる代わりに冊に分ける。
+    """
+    meta = build_header_meta(grade, field, level, n if n is not None else 0, seed)
+    if n is None:
+        meta["出題数"] = "-"
+    first = 1
+    for chunk in _chunks(rows, volume_size):
+        last = first + len(chunk) - 1
+        yield build_pdf("算数ドリル", {**meta, "問番号": f"Q{first}〜Q{last}"}, rows_to_pdf_problems(chunk), first)
+        first = last + 1
+
+def rows_to_json_bytes(rows: List[Dict], grade: str, field: str, level: int, n: int, seed: int) -> bytes:
+    doc = {
+        "meta": {"grade": grade, "field": field, "level": level, "n": n, "seed": seed},
+        "problems": [{c: r[c] for c in ROW_COLUMNS} for r in rows],
+    }
+    return (json.dumps(doc, ensure_ascii=False, indent=2) + "\n").encode("utf-8")
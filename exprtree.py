@@ -0,0 +1,114 @@
+# exprtree.py
+# -*- coding: utf-8 -*-
+"""
+問題の式を木で組み立て、Fraction で厳密に計算し、表示用の文字列にする小さな式エンジン。
+
+小数・分数の混じった問題を float や eval() を使わずに作るためのもの。
+葉（Num）は値（Fraction）と表示（"0.3" や "2/5"）の両方を持つので、
+問題文は出題したとおりの表記になり、答えは丸め誤差なしで求まる。
+"""
+
+import fractions
+import random
+from decimal import Decimal
+from typing import NamedTuple, Optional, Tuple, Union
+
+class Num(NamedTuple):
+    value: fractions.Fraction
+    text: str
+
+class BinOp(NamedTuple):
+    op: str   # "+", "-", "×", "÷"
+    left: "Expr"
+    right: "Expr"
+
+Expr = Union[Num, BinOp]
+
+_PRECEDENCE = {"+": 1, "-": 1, "×": 2, "÷": 2}
+
+# ------------------------------------------------------------------------------
+# 葉
+# ------------------------------------------------------------------------------
+def integer(n: int) -> Num:
+    return Num(fractions.Fraction(n), str(n))
+
+def _fixed(units: int, places: int) -> str:
+    # units / 10**places を小数 places 桁の文字列にする（整数演算だけで組み立てる）
+    if places == 0:
+        return str(units)
+    sign = "-" if units < 0 else ""
+    q, r = divmod(abs(units), 10 ** places)
+    return f"{sign}{q}.{r:0{places}d}"
+
+def decimal(units: int, places: int) -> Num:
+    """units / 10**places を小数 places 桁で表示する葉（例: decimal(25, 1) -> 2.5）。"""
+    return Num(fractions.Fraction(units, 10 ** places), _fixed(units, places))
+
+def fraction(num: int, den: int) -> Num:
+    """num/den と表示する葉（約分はしない）。"""
+    return Num(fractions.Fraction(num, den), f"{num}/{den}")
+
+def rand_decimal(rng: random.Random, lo: float, hi: float, places: int) -> Num:
+    """[lo, hi] から小数 places 桁の数を一様に選ぶ（端点を含む）。"""
+    scale = 10 ** places
+    return decimal(rng.randint(round(lo * scale), round(hi * scale)), places)
+
+def rand_proper_fraction(rng: random.Random, den_lo: int = 2, den_hi: int = 12) -> Num:
+    den = rng.randint(den_lo, den_hi)
+    return fraction(rng.randint(1, den - 1), den)
+
+# ------------------------------------------------------------------------------
+# 計算と表示
+# ------------------------------------------------------------------------------
+def evaluate(e: Expr) -> fractions.Fraction:
+    if isinstance(e, Num):
+        return e.value
+    a, b = evaluate(e.left), evaluate(e.right)
+    if e.op == "+":
+        return a + b
+    if e.op == "-":
+        return a - b
+    if e.op == "×":
+        return a * b
+    return a / b
+
+def render(e: Expr) -> str:
+    """中置記法で表示する。優先順位の低い部分式と、- ÷ の右側の同順位の部分式にはかっこを付ける。"""
+    if isinstance(e, Num):
+        return e.text
+    p = _PRECEDENCE[e.op]
+    left, right = render(e.left), render(e.right)
+    if isinstance(e.left, BinOp) and _PRECEDENCE[e.left.op] < p:
+        left = f"({left})"
+    if isinstance(e.right, BinOp) and (_PRECEDENCE[e.right.op] < p
+                                       or (_PRECEDENCE[e.right.op] == p and e.op in ("-", "÷"))):
+        right = f"({right})"
+    return f"{left} {e.op} {right}"
+
+# ------------------------------------------------------------------------------
+# 答えの表記
+# ------------------------------------------------------------------------------
+def _decimal_places(fr: fractions.Fraction) -> Optional[int]:
+    # 有限小数で書けるなら小数点以下の桁数、書けなければ None（既約分母の素因数が 2 と 5 だけか）
+    d = fr.denominator
+    twos = fives = 0
+    while d % 2 == 0:
+        d //= 2; twos += 1
+    while d % 5 == 0:
+        d //= 5; fives += 1
+    return max(twos, fives) if d == 1 else None
+
+def terminates(fr: fractions.Fraction) -> bool:
+    """有限小数で書けるか。"""
+    return _decimal_places(fr) is not None
+
+def to_answer(fr: fractions.Fraction) -> Tuple[str, Union[int, Decimal, fractions.Fraction]]:
+    """答えの (表示, 値)。整数は int、有限小数は Decimal、それ以外は既約分数の Fraction にする。"""
+    if fr.denominator == 1:
+        return str(fr.numerator), fr.numerator
+    places = _decimal_places(fr)
+    if places is not None:
+        # 分母は 10**places を割り切るので、小数 places 桁ちょうどで表せる
+        s = _fixed(fr.numerator * (10 ** places // fr.denominator), places).rstrip("0")
+        return s, Decimal(s)
+    return f"{fr.numerator}/{fr.denominator}", fr
@@ -0,0 +1,301 @@
+# grading.py
+# -*- coding: utf-8 -*-
+"""
+クラス・学校単位の解答をまとめて採点する。
+
+入力は 1 行 1 解答の CSV / Parquet（列は INPUT_COLUMNS。英語名の別名も可）。
+模範解答はシードから作り直す（問番号 k の問題はシードとそれより前の問題だけで決まり、
+出題数によらない）。問題バンクで配信している場合はバンクから引く。採点は答えの型ごとに行をまとめ、数値・分数などは
+NumPy の配列比較で一度に判定する。配列で読めない書き方の解答だけを
+compare_answers で 1 行ずつ判定するので、結果は「✅ 全問採点」と同じになる
+（check_grading.py で全プリセットの表記ゆれ・壊れた解答について突き合わせて確かめる）。
+
+例:
+    python grading.py answers.csv --by-student students.csv --by-preset presets.csv
+    python grading.py answers.parquet --detail graded.csv --workers 4
+"""
+
+import argparse
+import fractions
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from bank import generate_set
+from engine import (
+    PRESET_REGISTRY,
+    _DIV_EXPR_RE,
+    _FRAC_RE,
+    _RATIO_RE,
+    _REMAINDER_RE,
+    AnswerPair,
+    Ratio,
+    Remainder,
+    compare_answers,
+)
+
+# 入力の列（氏名, 学年, 分野, 難度, 乱数シード, 問番号（1 始まり）, 解答）
+INPUT_COLUMNS = ["氏名", "学年", "分野", "難度", "乱数シード", "問番号", "解答"]
+COLUMN_ALIASES = {
+    "student": "氏名", "grade": "学年", "field": "分野", "level": "難度",
+    "seed": "乱数シード", "question": "問番号", "answer": "解答",
+}
+PRESET_KEY = ["学年", "分野", "難度", "乱数シード"]
+
+# 配列で扱う整数の桁数の上限（分数の交差乗算が int64 に収まる長さ。これより長い解答は 1 行ずつ採点する）
+_MAX_DIGITS = 9
+
+class GradeReport(NamedTuple):
+    detail: pd.DataFrame      # 入力 + 模範解答・正誤
+    by_student: pd.DataFrame
+    by_preset: pd.DataFrame
+
+# ------------------------------------------------------------------------------
+# 入力
+# ------------------------------------------------------------------------------
+def read_answer_sheet(path: str) -> pd.DataFrame:
+    if path.endswith(".parquet"):
+        df = pd.read_parquet(path)
+    else:
+        # 解答は文字列のまま読む（"007" や "1/2" を数値に変えない）
+        df = pd.read_csv(path, dtype=str, keep_default_na=False, encoding="utf-8-sig")
+    return normalize_columns(df)
+
+def normalize_columns(df: pd.DataFrame) -> pd.DataFrame:
+    df = df.rename(columns=COLUMN_ALIASES)
+    missing = [c for c in INPUT_COLUMNS if c not in df.columns]
+    if missing:
+        raise ValueError(f"answer sheet is missing columns: {', '.join(missing)}")
+    df = df.copy()
+    for c in ("難度", "乱数シード", "問番号"):
+        df[c] = pd.to_numeric(df[c], errors="raise").astype(np.int64)
+    df["解答"] = df["解答"].fillna("").astype(str).str.strip()
+    if (df["問番号"] < 1).any():
+        raise ValueError("問番号 must be >= 1")
+    unknown = {k for k in df[["学年", "分野", "難度"]].drop_duplicates().itertuples(index=False, name=None)
+               if k not in PRESET_REGISTRY}
+    if unknown:
+        raise ValueError(f"unknown presets: {sorted(unknown)}")
+    return df
+
+# ------------------------------------------------------------------------------
+# 模範解答の作り直し
+# ------------------------------------------------------------------------------
+def _expected_for(key: Tuple[str, str, int, int], count: int) -> List[Tuple[str, object, str]]:
+    grade, field, level, seed = key
+    pset = generate_set(grade, field, int(level), int(count), int(seed))
+    return [(a, v, pset.label) for a, v in zip(pset.answers, pset.values)]
+
+def attach_expected(df: pd.DataFrame, *, workers: Optional[int] = None) -> pd.DataFrame:
+    """(学年, 分野, 難度, シード) ごとに必要な問数だけ作り直し、模範解答・値・プリセット名の列を足す。"""
+    need = df.groupby(PRESET_KEY, sort=False)["問番号"].max()
+    keys = list(need.index)
+    counts = need.tolist()
+    if workers == 1 or len(keys) < 64:
+        sets = [_expected_for(k, c) for k, c in zip(keys, counts)]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            sets = list(ex.map(_expected_for, keys, counts, chunksize=max(1, len(keys) // 64)))
+
+    answers, values, labels = [None] * len(df), [None] * len(df), [None] * len(df)
+    groups = df.groupby(PRESET_KEY, sort=False).indices
+    for key, expected in zip(keys, sets):
+        pos = groups[key]
+        for p, q in zip(pos.tolist(), df["問番号"].to_numpy()[pos].tolist()):
+            answers[p], values[p], labels[p] = expected[q - 1]
+    out = df.copy()
+    out["模範解答"] = answers
+    out["値"] = values
+    out["プリセット"] = labels
+    return out
+
+# ------------------------------------------------------------------------------
+# 答えの型ごとの配列比較
+# 解答の文字列は学校全体でも種類が少ないので、読み取りは重複を除いた文字列に対して 1 回だけ行い、
+# 結果を行へ配る。各比較関数は (正誤, 判定済み) の 2 つの bool 配列を返し、
+# 判定済みでない行（全角数字など配列で読めない書き方）は compare_answers に回す
+# ------------------------------------------------------------------------------
+def _by_unique(us: pd.Series, parse: Callable[[pd.Series], Tuple[np.ndarray, ...]]) -> Tuple[np.ndarray, ...]:
+    codes, uniq = pd.factorize(us)
+    return tuple(col[codes] for col in parse(pd.Series(uniq, dtype=object)))
+
+def _ints(parts: pd.DataFrame) -> Tuple[np.ndarray, ...]:
+    # 正規表現で切り出した整数の列を int64 にする。最後の要素は「すべて ASCII の整数で桁数も範囲内」
+    # （全角数字などは to_numeric が読めないので ok=False になり、1 行ずつの採点に回る）
+    cols, ok = [], np.ones(len(parts), dtype=bool)
+    for c in parts.columns:
+        v = _floats(parts[c])
+        ok &= ~np.isnan(v) & (np.abs(np.nan_to_num(v)) < 10 ** _MAX_DIGITS)
+        cols.append(np.where(ok, np.nan_to_num(v), 0).astype(np.int64))
+    return (*cols, ok)
+
+def _floats(us: pd.Series) -> np.ndarray:
+    return pd.to_numeric(us, errors="coerce").to_numpy(dtype=float, na_value=np.nan, copy=True)
+
+def _extract_ints(regex) -> Callable[[pd.Series], Tuple[np.ndarray, ...]]:
+    # (一致したか, 整数列..., 整数として読めたか)
+    def parse(uniq: pd.Series) -> Tuple[np.ndarray, ...]:
+        parts = uniq.str.extract(regex)
+        return (parts[0].notna().to_numpy(), *_ints(parts))
+    return parse
+
+_parse_frac = _extract_ints(_FRAC_RE)
+_parse_remainder = _extract_ints(_REMAINDER_RE)
+_parse_ratio = _extract_ints(_RATIO_RE)
+
+def _parse_number_or_fraction(uniq: pd.Series) -> Tuple[np.ndarray, np.ndarray]:
+    # 数値として読み、読めなければ a/b として読む（_compare_number と同じ順）
+    u = _floats(uniq)
+    parsed = ~np.isnan(u)
+    # a/b の正規表現は数値として読めなかった文字列にだけ当てる
+    rest = np.flatnonzero(~parsed)
+    matched, num, den, ok = _parse_frac(uniq.iloc[rest])
+    use = matched & ok
+    u[rest] = np.where(use & (den != 0), num / np.where(den == 0, 1, den), np.nan)
+    parsed[rest] = use
+    # 分母 0 は u が NaN のまま判定済み（不正解）になる
+    return u, parsed
+
+def _parse_number_if_not_frac(uniq: pd.Series) -> Tuple[np.ndarray, ...]:
+    return (*_parse_frac(uniq), _floats(uniq))
+
+def _parse_pair(uniq: pd.Series) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    parts = uniq.str.extract(_DIV_EXPR_RE)
+    return parts[0].notna().to_numpy(), _floats(parts[0]), _floats(parts[1])
+
+def _close(ev: np.ndarray, u: np.ndarray, tol: float) -> np.ndarray:
+    return np.abs(ev - np.nan_to_num(u, nan=np.inf)) <= tol
+
+def _grade_number(values: List, us: pd.Series, tol: float) -> Tuple[np.ndarray, np.ndarray]:
+    ev = np.array([float(v) for v in values])
+    u, parsed = _by_unique(us, _parse_number_or_fraction)
+    return parsed & _close(ev, u, tol), parsed
+
+def _grade_fraction(values: List, us: pd.Series, tol: float) -> Tuple[np.ndarray, np.ndarray]:
+    ev_num = np.array([v.numerator for v in values], dtype=np.int64)
+    ev_den = np.array([v.denominator for v in values], dtype=np.int64)
+    matched, num, den, ok, u = _by_unique(us, _parse_number_if_not_frac)
+    # a/b なら分数として厳密に比べる（約分前でもよい）
+    exact = matched & ok
+    frac_ok = exact & (den != 0) & (num * ev_den == ev_num * den)
+    # それ以外は小数で答えたものとして許容誤差で比べる
+    num_parsed = ~matched & ~np.isnan(u)
+    num_ok = num_parsed & _close(ev_num / ev_den, u, tol)
+    return frac_ok | num_ok, exact | num_parsed
+
+def _grade_remainder(values: List, us: pd.Series, tol: float) -> Tuple[np.ndarray, np.ndarray]:
+    ev_q = np.array([v.quotient for v in values], dtype=np.int64)
+    ev_r = np.array([v.remainder for v in values], dtype=np.int64)
+    matched, q, r, ok = _by_unique(us, _parse_remainder)
+    # 「q あまり r」の形でなければ不正解で確定
+    return matched & ok & (q == ev_q) & (r == ev_r), ~matched | ok
+
+def _grade_ratio(values: List, us: pd.Series, tol: float) -> Tuple[np.ndarray, np.ndarray]:
+    ev_l = np.array([v.left for v in values], dtype=np.int64)
+    ev_r = np.array([v.right for v in values], dtype=np.int64)
+    ev_g = np.gcd(ev_l, ev_r)
+    ev_l, ev_r = ev_l // ev_g, ev_r // ev_g
+    matched, a, b, ok = _by_unique(us, _parse_ratio)
+    valid = matched & ok & (b != 0)
+    g = np.where(valid, np.gcd(a, b), 1)
+    return valid & (a // g == ev_l) & (b // g == ev_r), ~matched | ok
+
+def _grade_pair(values: List, us: pd.Series, tol: float) -> Tuple[np.ndarray, np.ndarray]:
+    ev1 = np.array([float(v.first) for v in values])
+    ev2 = np.array([float(v.second) for v in values])
+    matched, x, y = _by_unique(us, _parse_pair)
+    correct = matched & _close(ev1, x, tol) & _close(ev2, y, tol)
+    return correct, ~matched | (~np.isnan(x) & ~np.isnan(y))
+
+_BATCH_COMPARERS: Dict[type, Callable[[List, pd.Series, float], Tuple[np.ndarray, np.ndarray]]] = {
+    int: _grade_number,
+    Decimal: _grade_number,
+    fractions.Fraction: _grade_fraction,
+    Remainder: _grade_remainder,
+    Ratio: _grade_ratio,
+    AnswerPair: _grade_pair,
+}
+
+def grade_values(values: List, answers: pd.Series, tol: float = 1e-6) -> np.ndarray:
+    """values[i] と answers[i] を compare_answers と同じ基準で比べ、正誤の bool 配列を返す。"""
+    answers = answers.fillna("").astype(str).str.strip().reset_index(drop=True)
+    correct = np.zeros(len(values), dtype=bool)
+    kinds = pd.Series([type(v) for v in values])
+    blank = (answers == "").to_numpy()
+    for kind, idx in kinds.groupby(kinds, sort=False).indices.items():
+        idx = idx[~blank[idx]]
+        if len(idx) == 0:
+            continue
+        vals = [values[i] for i in idx]
+        us = answers.iloc[idx].reset_index(drop=True)
+        batch = _BATCH_COMPARERS.get(kind)
+        if batch is None:
+            done = np.zeros(len(idx), dtype=bool)
+            ok = done.copy()
+        else:
+            ok, done = batch(vals, us, tol)
+        # 配列で判定できなかった行だけ 1 行ずつ
+        for j in np.flatnonzero(~done).tolist():
+            ok[j] = compare_answers(vals[j], us.iloc[j], tol)
+        correct[idx] = ok
+    return correct
+
+# ------------------------------------------------------------------------------
+# 集計
+# ------------------------------------------------------------------------------
+def _summary(df: pd.DataFrame, by: List[str]) -> pd.DataFrame:
+    g = df.groupby(by, sort=True)
+    out = g.agg(解答数=("正誤", "size"), 正答数=("正誤", "sum"))
+    out["正答率"] = out["正答数"] / out["解答数"]
+    return out.reset_index()
+
+def score_tables(detail: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    by_student = _summary(detail, ["氏名"])
+    by_preset = _summary(detail, ["学年", "分野", "難度", "プリセット"])
+    by_preset.insert(4, "人数", detail.groupby(["学年", "分野", "難度", "プリセット"], sort=True)["氏名"]
+                     .nunique().to_numpy())
+    return by_student, by_preset
+
+def grade_answer_sheet(df: pd.DataFrame, *, tol: float = 1e-6, workers: Optional[int] = None) -> GradeReport:
+    detail = attach_expected(normalize_columns(df), workers=workers)
+    detail["正誤"] = grade_values(detail["値"].tolist(), detail["解答"], tol)
+    by_student, by_preset = score_tables(detail)
+    return GradeReport(detail.drop(columns=["値"]), by_student, by_preset)
+
+# ------------------------------------------------------------------------------
+# CLI
+# ------------------------------------------------------------------------------
+def _write_table(df: pd.DataFrame, path: str) -> None:
+    if path.endswith(".parquet"):
+        df.to_parquet(path, index=False)
+    else:
+        df.to_csv(path, index=False, encoding="utf-8-sig")
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="解答シート（CSV / Parquet）を一括採点する")
+    ap.add_argument("answers", help="解答ファイル（列: " + ", ".join(INPUT_COLUMNS) + "）")
+    ap.add_argument("--by-student", help="生徒ごとの集計の出力先（.csv / .parquet）")
+    ap.add_argument("--by-preset", help="プリセットごとの集計の出力先（.csv / .parquet）")
+    ap.add_argument("--detail", help="1 行ごとの正誤の出力先（.csv / .parquet）")
+    ap.add_argument("--tol", type=float, default=1e-6, help="小数の許容誤差")
+    ap.add_argument("--workers", type=int, default=None, help="模範解答を作り直すプロセス数（既定: CPU 数）")
+    args = ap.parse_args(argv)
+
+    try:
+        report = grade_answer_sheet(read_answer_sheet(args.answers), tol=args.tol, workers=args.workers)
+    except ValueError as e:
+        ap.error(str(e))
+    for path, table in ((args.detail, report.detail), (args.by_student, report.by_student),
+                        (args.by_preset, report.by_preset)):
+        if path:
+            _write_table(table, path)
+    if not args.by_student:
+        print(report.by_student.to_string(index=False))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
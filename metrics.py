@@ -0,0 +1,174 @@
+# metrics.py
+# -*- coding: utf-8 -*-
+"""
+処理段階ごとの所要時間のヒストグラム（プロセス全体で共有する）。
+
+「生成する」や採点の各段階（問題の生成・表の作成・CSV・PDF・画面の描画など）を
+プリセットと出題数の区分ごとに記録し、p50/p95/p99 を見られるようにする。
+
+- render_prometheus(): Prometheus のテキスト形式（drill_stage_seconds_bucket など）
+- write_metrics_file(): 上を DRILL_METRICS_FILE に書く（node_exporter の textfile collector 向け）
+- summary(): 段階ごとの件数と分位点（アプリのサイドバーの診断表示用）
+
+分位点はバケットの境界から線形補間で見積もる（Prometheus の histogram_quantile と同じ考え方）。
+"""
+
+import bisect
+import contextlib
+import os
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# バケットの上端（秒）。最後に +Inf が付く
+BUCKETS: Tuple[float, ...] = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# 出題数の区分（ラベルの種類を増やしすぎないため）
+N_BUCKETS: Tuple[int, ...] = (10, 20, 50, 100, 200)
+
+METRIC_NAME = "drill_stage_seconds"
+LABEL_NAMES = ("stage", "grade", "field", "level", "n")
+
+Labels = Tuple[str, ...]   # LABEL_NAMES の順の値
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        acc = 0
+        for i, c in enumerate(self.counts):
+            if acc + c >= rank and c > 0:
+                lo = BUCKETS[i - 1] if i > 0 else 0.0
+                if i == len(BUCKETS):
+                    return lo   # +Inf バケットに入ったら最後の有限の境界を返す
+                return lo + (BUCKETS[i] - lo) * (rank - acc) / c
+            acc += c
+        return BUCKETS[-1]
+
+_HISTOGRAMS: Dict[Labels, Histogram] = {}
+_LOCK = threading.Lock()
+
+def n_bucket(n: int) -> str:
+    """出題数を区分のラベル（"1-10", "11-20", …, "201+"）にする。"""
+    lo = 1
+    for hi in N_BUCKETS:
+        if n <= hi:
+            return f"{lo}-{hi}"
+        lo = hi + 1
+    return f"{lo}+"
+
+def _labels(stage: str, grade: str = "", field: str = "", level: Optional[int] = None,
+            n: Optional[int] = None) -> Labels:
+    return (stage, grade, field, "" if level is None else str(level), "" if n is None else n_bucket(int(n)))
+
+# ------------------------------------------------------------------------------
+# 記録
+# ------------------------------------------------------------------------------
+def observe(stage: str, seconds: float, *, grade: str = "", field: str = "",
+            level: Optional[int] = None, n: Optional[int] = None) -> None:
+    key = _labels(stage, grade, field, level, n)
+    with _LOCK:
+        hist = _HISTOGRAMS.get(key)
+        if hist is None:
+            hist = _HISTOGRAMS[key] = Histogram()
+        hist.observe(seconds)
+
+@contextlib.contextmanager
+def timed(stage: str, **labels) -> Iterator[None]:
+    """with timed("csv", grade=..., field=..., level=..., n=...): の中の所要時間を記録する（例外でも記録する）。"""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - t0, **labels)
+
+def reset() -> None:
+    with _LOCK:
+        _HISTOGRAMS.clear()
+
+# ------------------------------------------------------------------------------
+# 取り出し
+# ------------------------------------------------------------------------------
+def _snapshot() -> List[Tuple[Labels, Histogram]]:
+    with _LOCK:
+        out = []
+        for key, h in _HISTOGRAMS.items():
+            c = Histogram()
+            c.counts, c.total, c.count = list(h.counts), h.total, h.count
+            out.append((key, c))
+    out.sort(key=lambda kv: kv[0])
+    return out
+
+def summary() -> List[Dict]:
+    """段階・プリセット・出題数の区分ごとの件数・平均・p50/p95/p99（ミリ秒）。"""
+    rows = []
+    for key, h in _snapshot():
+        row = dict(zip(LABEL_NAMES, key))
+        row["count"] = h.count
+        row["mean_ms"] = round(h.total / h.count * 1000, 2)
+        for q in (0.5, 0.95, 0.99):
+            row[f"p{round(q * 100)}_ms"] = round(h.quantile(q) * 1000, 2)
+        rows.append(row)
+    return rows
+
+def _escape(v: str) -> str:
+    return v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(key: Labels, le: Optional[str] = None) -> str:
+    parts = [f'{name}="{_escape(v)}"' for name, v in zip(LABEL_NAMES, key) if v]
+    if le is not None:
+        parts.append(f'le="{le}"')
+    return "{" + ",".join(parts) + "}"
+
+def render_prometheus() -> str:
+    """Prometheus のテキスト形式（version 0.0.4）で全ヒストグラムを返す。"""
+    lines = [f"# HELP {METRIC_NAME} Latency of each stage of the drill request path.",
+             f"# TYPE {METRIC_NAME} histogram"]
+    for key, h in _snapshot():
+        acc = 0
+        for bound, c in zip([repr(b) for b in BUCKETS] + ["+Inf"], h.counts):
+            acc += c
+            lines.append(f"{METRIC_NAME}_bucket{_format_labels(key, bound)} {acc}")
+        lines.append(f"{METRIC_NAME}_sum{_format_labels(key)} {h.total:.6f}")
+        lines.append(f"{METRIC_NAME}_count{_format_labels(key)} {h.count}")
+    return "\n".join(lines) + "\n"
+
+# ------------------------------------------------------------------------------
+# ファイル出力
+# ------------------------------------------------------------------------------
+METRICS_FILE = os.environ.get("DRILL_METRICS_FILE")
+METRICS_INTERVAL = float(os.environ.get("DRILL_METRICS_INTERVAL", "10"))
+_last_write = 0.0
+
+def write_metrics_file(path: Optional[str] = None) -> None:
+    """path（既定: DRILL_METRICS_FILE）に render_prometheus() を書く。読み手が途中の状態を見ないよう置き換えで書く。"""
+    path = path or METRICS_FILE
+    if not path:
+        return
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(render_prometheus())
+    os.replace(tmp, path)
+
+def maybe_write_metrics_file() -> None:
+    """DRILL_METRICS_FILE が設定されていれば、前回から METRICS_INTERVAL 秒以上たっているときだけ書く。"""
+    global _last_write
+    if not METRICS_FILE:
+        return
+    now = time.monotonic()
+    with _LOCK:
+        if now - _last_write < METRICS_INTERVAL:
+            return
+        _last_write = now
+    write_metrics_file()
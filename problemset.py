@@ -0,0 +1,221 @@
+# problemset.py
+# -*- coding: utf-8 -*-
+"""
+問題集を列ごとに詰めて持つコンテナ（ProblemSet）。
+
+これまで問題集は「問題・答え・プリセット・値」の辞書のリストとして作られ、表示用の DataFrame、
+PDF 用の {"question", "answer", "meta"} の辞書へと作り直されていた。ProblemSet はそれに代わって
+1 つの問題集を 1 度だけ持ち、CSV・JSON・PDF・採点・画面の表はすべてここから読む。
+
+- 問題と答えの表示文字列: UTF-8 の連結バイト列と int64 のオフセット（TextColumn）。
+  Arrow の large_string と同じ並びなので、to_arrow() はバッファを写さずに Arrow の列にする
+- プリセット表示: 問題集に 1 つだけ持つ（Arrow では辞書型の列にする）
+- 答えの値（AnswerValue）: 型つきのまま持つ。問題バンクから作った場合は、初めて使うときに答えの表示と
+  型の番号（engine.ANSWER_KINDS）から読む
+
+pyarrow は to_arrow() / to_parquet() を呼んだときだけ読み込む（Streamlit が依存しているので、アプリでは常にある）。
+"""
+
+import csv
+import fractions
+import io
+import itertools
+import json
+from decimal import Decimal
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from engine import (
+    ROW_COLUMNS,
+    AnswerValue,
+    GenResult,
+    Ratio,
+    Remainder,
+    build_header_meta,
+    build_pdf_columns,
+    decode_answer,
+    parse_answer,
+)
+
+# ------------------------------------------------------------------------------
+# 文字列の列
+# ------------------------------------------------------------------------------
+class TextColumn:
+    """UTF-8 の連結バイト列 data と、i 番目が data[offsets[i]:offsets[i+1]] になる int64 のオフセット。"""
+
+    __slots__ = ("offsets", "data")
+
+    def __init__(self, offsets: np.ndarray, data: bytes):
+        self.offsets = offsets
+        self.data = data
+
+    @classmethod
+    def from_strings(cls, strings: Iterable[str]) -> "TextColumn":
+        encoded = [s.encode("utf-8") for s in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        return cls(offsets, b"".join(encoded))
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        if not -len(self) <= i < len(self):
+            raise IndexError(i)
+        i %= len(self)
+        return str(memoryview(self.data)[self.offsets[i]:self.offsets[i + 1]], "utf-8")
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.tolist())
+
+    def tolist(self) -> List[str]:
+        data, off = memoryview(self.data), self.offsets.tolist()
+        return [str(data[s:e], "utf-8") for s, e in zip(off, off[1:])]
+
+    @property
+    def nbytes(self) -> int:
+        return self.offsets.nbytes + len(self.data)
+
+    def to_arrow(self):
+        """同じバッファを指す pyarrow の large_string 配列（写しを作らない）。"""
+        import pyarrow as pa
+
+        return pa.Array.from_buffers(pa.large_string(), len(self),
+                                     [None, pa.py_buffer(self.offsets), pa.py_buffer(self.data)])
+
+# ------------------------------------------------------------------------------
+# 問題集
+# ------------------------------------------------------------------------------
+class ProblemSet:
+    """1 つの (学年, 分野, 難度, シード) の問題集。start は問題列の中での先頭の位置。返した列は書き換えないこと。"""
+
+    __slots__ = ("grade", "field", "level", "seed", "start", "label", "questions", "answers", "_values", "_kinds")
+
+    def __init__(self, grade: str, field: str, level: int, seed: int, label: str,
+                 questions: TextColumn, answers: TextColumn,
+                 values: Optional[Sequence[AnswerValue]] = None, start: int = 0,
+                 kinds: Optional[np.ndarray] = None):
+        if len(questions) != len(answers) or any(c is not None and len(c) != len(answers) for c in (values, kinds)):
+            raise ValueError("columns must have the same length")
+        self.grade, self.field, self.level, self.seed, self.start = grade, field, level, seed, start
+        self.label = label
+        self.questions = questions
+        self.answers = answers
+        self._values = None if values is None else tuple(values)
+        self._kinds = kinds
+
+    @classmethod
+    def from_results(cls, grade: str, field: str, level: int, seed: int, label: str,
+                     results: Sequence[GenResult], start: int = 0) -> "ProblemSet":
+        """ジェネレータの (問題, 答えの表示, 答えの値) の列から作る。"""
+        return cls(grade, field, level, seed, label,
+                   TextColumn.from_strings(r[0] for r in results), TextColumn.from_strings(r[1] for r in results),
+                   [r[2] for r in results], start)
+
+    @classmethod
+    def from_rows(cls, grade: str, field: str, level: int, seed: int, rows: Sequence[Dict],
+                  start: int = 0) -> "ProblemSet":
+        """generate_by_preset などの行の辞書から作る（プリセット表示は全行で同じであること）。"""
+        labels = {r["プリセット"] for r in rows}
+        if len(labels) > 1:
+            raise ValueError(f"rows mix presets: {sorted(labels)}")
+        label = labels.pop() if labels else ""
+        return cls.from_results(grade, field, level, seed, label,
+                                [(r["問題"], r["答え"], r["値"]) for r in rows], start)
+
+    def __len__(self) -> int:
+        return len(self.answers)
+
+    @property
+    def values(self) -> Tuple[AnswerValue, ...]:
+        """答えの値（採点用）。持っていなければ答えの表示（型の番号があればその型として）から一度だけ読む。"""
+        if self._values is None:
+            if self._kinds is None:
+                self._values = tuple(parse_answer(a) for a in self.answers)
+            else:
+                self._values = tuple(map(decode_answer, self.answers, self._kinds.tolist()))
+        return self._values
+
+    @property
+    def nbytes(self) -> int:
+        # 文字列の列の大きさ（答えの値は含まない）
+        return self.questions.nbytes + self.answers.nbytes + len(self.label.encode("utf-8"))
+
+    def rows(self) -> List[Dict]:
+        """generate_by_preset と同じ形の行の辞書（古い呼び出し側との互換用）。"""
+        return [{"問題": q, "答え": a, "プリセット": self.label, "値": v}
+                for q, a, v in zip(self.questions, self.answers, self.values)]
+
+    # --------------------------------------------------------------------------
+    # 出力（rows_to_csv_bytes / rows_to_json_bytes / build_worksheet_pdf と同じバイト列）
+    # --------------------------------------------------------------------------
+    def _records(self) -> Iterator[Tuple[str, str, str]]:
+        return zip(self.questions, self.answers, itertools.repeat(self.label))
+
+    def to_csv_bytes(self) -> bytes:
+        buf = io.StringIO()
+        w = csv.writer(buf, lineterminator="\n")
+        w.writerow(ROW_COLUMNS)
+        w.writerows(self._records())
+        return buf.getvalue().encode("utf-8-sig")
+
+    def to_json_bytes(self, n: Optional[int] = None) -> bytes:
+        doc = {
+            "meta": {"grade": self.grade, "field": self.field, "level": self.level,
+                     "n": len(self) if n is None else n, "seed": self.seed},
+            "problems": [dict(zip(ROW_COLUMNS, rec)) for rec in self._records()],
+        }
+        return (json.dumps(doc, ensure_ascii=False, indent=2) + "\n").encode("utf-8")
+
+    def to_pdf(self, n: Optional[int] = None) -> bytes:
+        meta = build_header_meta(self.grade, self.field, self.level, len(self) if n is None else n, self.seed)
+        return build_pdf_columns("算数ドリル", meta, self.questions.tolist(), self.answers.tolist(),
+                                 itertools.repeat(self.label), first=self.start + 1)
+
+    # --------------------------------------------------------------------------
+    # Arrow / Parquet
+    # --------------------------------------------------------------------------
+    def to_arrow(self, *, values: bool = True):
+        """pyarrow.Table（問題・答え・プリセット、values=True なら型の揃った答えの値 "値" も）。
+
+        問題・答えの列は TextColumn のバッファをそのまま指す。プリセットは辞書型（添字は int8 の 0）。
+        """
+        import pyarrow as pa
+
+        label = pa.DictionaryArray.from_arrays(pa.array(np.zeros(len(self), dtype=np.int8)), pa.array([self.label]))
+        columns = [self.questions.to_arrow(), self.answers.to_arrow(), label]
+        names = list(ROW_COLUMNS)
+        typed = _value_array(self.values) if values else None
+        if typed is not None:
+            columns.append(typed)
+            names.append("値")
+        meta = {"grade": self.grade, "field": self.field, "level": str(self.level), "seed": str(self.seed),
+                "start": str(self.start)}
+        return pa.Table.from_arrays(columns, names=names, metadata=meta)
+
+    def to_parquet(self, where) -> None:
+        """to_arrow() を Parquet で where（パスまたはバイナリのファイル）に書く。"""
+        import pyarrow.parquet as pq
+
+        pq.write_table(self.to_arrow(), where)
+
+def _value_array(values: Sequence[AnswerValue]):
+    # 答えの値を Arrow の型つきの列にする。整数だけなら int64、小数・分数が混じれば厳密な
+    # {numerator, denominator}、あまり・比はその組の struct。2 問セットや型が混ざる場合は None
+    import pyarrow as pa
+
+    kinds = {type(v) for v in values}
+    if not kinds:
+        return None
+    if kinds == {int}:
+        return pa.array(values, type=pa.int64())
+    if kinds <= {int, Decimal, fractions.Fraction}:
+        exact = [fractions.Fraction(v) for v in values]
+        return pa.StructArray.from_arrays([pa.array([v.numerator for v in exact], pa.int64()),
+                                           pa.array([v.denominator for v in exact], pa.int64())],
+                                          names=["numerator", "denominator"])
+    if len(kinds) == 1 and kinds <= {Remainder, Ratio}:
+        kind = kinds.pop()
+        return pa.StructArray.from_arrays([pa.array(col, pa.int64()) for col in zip(*values)], names=list(kind._fields))
+    return None
@@ -0,0 +1,127 @@
+# profiling.py
+# -*- coding: utf-8 -*-
+"""
+1 回の「生成する」をプロファイラの下で実行し、ダウンロードできる結果を作る。
+
+先生から「この条件で遅い」と報告があったとき、同じ (学年, 分野, 難度, 出題数, シード) を
+本番のプロセスでそのまま測るためのもの。キャッシュは通さず、問題集の生成（generate_set。バンクがあればバンク）・CSV・PDF を毎回計算する。
+
+- mode="pstats": cProfile（決定的）。pstats 形式のバイナリ（snakeviz や pstats で読む）
+- mode="collapsed": 標準ライブラリだけのサンプリング。flamegraph.pl / speedscope 用の collapsed stacks
+
+アプリでは管理者だけが使えるよう、URL の profile= が DRILL_ADMIN_TOKEN と一致したときだけ有効にする。
+"""
+
+import cProfile
+import hmac
+import io
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Callable, NamedTuple, Optional
+
+from bank import generate_set
+
+PROFILE_MODES = ("pstats", "collapsed")
+
+# サンプリングの間隔（秒）と、サンプルを十分に集めるための最短の計測時間（秒）
+SAMPLE_INTERVAL = 0.001
+SAMPLE_MIN_TIME = 1.0
+
+class ProfileResult(NamedTuple):
+    data: bytes
+    file_name: str
+    mime: str
+    summary: str     # 画面に出す上位の関数（人が読む用）
+    seconds: float   # 計測した処理の経過時間（サンプリングで繰り返した場合は合計）
+    runs: int
+
+def admin_token_ok(given: Optional[str]) -> bool:
+    """given が環境変数 DRILL_ADMIN_TOKEN と一致するか。環境変数がなければ常に False。"""
+    expected = os.environ.get("DRILL_ADMIN_TOKEN")
+    if not expected or not given:
+        return False
+    return hmac.compare_digest(given.encode("utf-8"), expected.encode("utf-8"))
+
+def _workload(grade: str, field: str, level: int, n: int, seed: int) -> Callable[[], None]:
+    def run() -> None:
+        pset = generate_set(grade, field, level, n, seed)
+        pset.to_csv_bytes()
+        pset.to_pdf(n)
+    return run
+
+# ------------------------------------------------------------------------------
+# cProfile
+# ------------------------------------------------------------------------------
+def _profile_pstats(work: Callable[[], None], top: int) -> ProfileResult:
+    prof = cProfile.Profile()
+    t0 = time.perf_counter()
+    prof.runcall(work)
+    elapsed = time.perf_counter() - t0
+
+    buf = io.StringIO()
+    stats = pstats.Stats(prof, stream=buf)
+    # Stats.dump_stats と同じ形式（marshal した stats 辞書）をメモリ上で作る
+    data = marshal.dumps(stats.stats)
+    stats.sort_stats("cumulative").print_stats(top)
+    return ProfileResult(data, "profile.pstats", "application/octet-stream", buf.getvalue(), elapsed, 1)
+
+# ------------------------------------------------------------------------------
+# サンプリング（collapsed stacks）
+# ------------------------------------------------------------------------------
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+def _sample_thread(thread_id: int, stop: threading.Event, counts: Counter, interval: float) -> None:
+    while not stop.wait(interval):
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None:
+            stack.append(_frame_label(frame))
+            frame = frame.f_back
+        if stack:
+            counts[";".join(reversed(stack))] += 1
+
+def _profile_collapsed(work: Callable[[], None], top: int, min_time: float, interval: float) -> ProfileResult:
+    counts: Counter = Counter()
+    stop = threading.Event()
+    sampler = threading.Thread(target=_sample_thread, name="drill-profiler",
+                               args=(threading.get_ident(), stop, counts, interval), daemon=True)
+    runs, t0 = 0, time.perf_counter()
+    sampler.start()
+    try:
+        # 1 回が短い条件でも形が見えるよう、min_time 秒たつまで繰り返す
+        while True:
+            work()
+            runs += 1
+            if time.perf_counter() - t0 >= min_time:
+                break
+    finally:
+        stop.set()
+        sampler.join()
+    elapsed = time.perf_counter() - t0
+
+    data = "".join(f"{stack} {c}\n" for stack, c in sorted(counts.items())).encode("utf-8")
+    # 自分自身の時間（スタックの末尾）で上位を出す
+    leaf = Counter()
+    for stack, c in counts.items():
+        leaf[stack.rsplit(";", 1)[-1]] += c
+    total = sum(counts.values()) or 1
+    summary = "\n".join(f"{c / total:6.1%}  {name}" for name, c in leaf.most_common(top))
+    return ProfileResult(data, "profile.collapsed.txt", "text/plain", summary, elapsed, runs)
+
+def profile_request(grade: str, field: str, level: int, n: int, seed: int, *, mode: str = "pstats",
+                    top: int = 30, min_time: float = SAMPLE_MIN_TIME,
+                    interval: float = SAMPLE_INTERVAL) -> ProfileResult:
+    """生成・CSV・PDF を 1 回（collapsed は min_time 秒以上）プロファイラの下で実行する。"""
+    work = _workload(grade, field, level, n, seed)
+    if mode == "pstats":
+        return _profile_pstats(work, top)
+    if mode == "collapsed":
+        return _profile_collapsed(work, top, min_time, interval)
+    raise ValueError(f"unknown profile mode: {mode} (choices: {', '.join(PROFILE_MODES)})")
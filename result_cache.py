@@ -0,0 +1,233 @@
+# result_cache.py
+# -*- coding: utf-8 -*-
+"""
+生成結果（問題集 ProblemSet・CSV・JSON・PDF・クラス一括）をプロセス全体で共有するキャッシュ。
+
+出力は (学年, 分野, 難度, 出題数, シード) で決まるので、GENERATOR_VERSION と合わせてキーにする。
+共有リンクで同じ URL を多くの生徒が開いても、生成や PDF 作成は一度で済む。
+件数上限または合計の大きさ（バイト）の上限を超えたら最も古く使われたものから捨て（LRU）、
+TTL を過ぎたものは取り出すときに捨てる。
+返した値は共有されるので、呼び出し側で書き換えないこと。
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Hashable, Optional, Sequence, Tuple
+
+from bank import generate_set, source_id
+from engine import GENERATOR_VERSION, compare_cache_info, warm_font_cache
+from metrics import timed
+from problemset import ProblemSet
+
+_MISSING = object()
+
+class LRUCache:
+    """件数上限・大きさの上限・TTL つきの LRU キャッシュ（スレッドセーフ）。
+
+    max_bytes を指定したときは、weigh(value) で測った大きさの合計がそれを超えないように捨てる
+    （1 つで max_bytes を超える値は入れない）。
+    """
+
+    def __init__(self, max_entries: int = 256, ttl: Optional[float] = 3600.0, *,
+                 max_bytes: Optional[int] = None, weigh: Callable[[Any], int] = len):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.weigh = weigh
+        self._data: "OrderedDict[Hashable, Tuple[float, Any, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is _MISSING:
+                self.misses += 1
+                return default
+            stored_at, value, size = item
+            if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+                del self._data[key]
+                self.bytes -= size
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        size = self.weigh(value) if self.max_bytes is not None else 0
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.bytes -= old[2]
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self._data[key] = (time.monotonic(), value, size)
+            self.bytes += size
+            while len(self._data) > self.max_entries or (self.max_bytes is not None and self.bytes > self.max_bytes):
+                _, (_, _, evicted) = self._data.popitem(last=False)
+                self.bytes -= evicted
+                self.evictions += 1
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        # 計算はロックの外で行う（同じキーが同時に来たら二重に計算されうるが、結果は同じ）
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._data),
+                "max_entries": self.max_entries,
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+# 問題集・CSV・JSON・PDF は別々のキャッシュにする（CSV しか使わない人に PDF を作らせない）。
+# 大きさの上限は DRILL_CACHE_*_MB（メガバイト）
+_TTL = float(os.environ.get("DRILL_CACHE_TTL", "3600"))
+
+def _max_bytes(name: str, default_mb: int) -> int:
+    return int(float(os.environ.get(f"DRILL_CACHE_{name}_MB", str(default_mb))) * 1024 * 1024)
+
+# 答えの値（Python のオブジェクト）1 つあたりの大きさの見積もり（ProblemSet.nbytes には含まれない）
+_VALUE_BYTES = 100
+
+def _set_bytes(pset: ProblemSet) -> int:
+    return pset.nbytes + _VALUE_BYTES * len(pset)
+
+SET_CACHE = LRUCache(max_entries=int(os.environ.get("DRILL_CACHE_ROWS", "512")), ttl=_TTL,
+                     max_bytes=_max_bytes("ROWS", 64), weigh=_set_bytes)
+CSV_CACHE = LRUCache(max_entries=int(os.environ.get("DRILL_CACHE_CSV", "256")), ttl=_TTL,
+                     max_bytes=_max_bytes("CSV", 64))
+JSON_CACHE = LRUCache(max_entries=int(os.environ.get("DRILL_CACHE_JSON", "256")), ttl=_TTL,
+                      max_bytes=_max_bytes("JSON", 64))
+PDF_CACHE = LRUCache(max_entries=int(os.environ.get("DRILL_CACHE_PDF", "128")), ttl=_TTL,
+                     max_bytes=_max_bytes("PDF", 128))
+# クラス一括の PDF / ZIP は 1 つが数 MB になる。セッションには条件だけを持ち、中身はここに置く
+BUNDLE_CACHE = LRUCache(max_entries=int(os.environ.get("DRILL_CACHE_BUNDLE", "16")), ttl=_TTL,
+                        max_bytes=_max_bytes("BUNDLE", 256))
+
+def _key(grade: str, field: str, level: int, n: int, seed: int) -> tuple:
+    # 問題バンクから配信するときは、バンクの中身もキーに含める
+    return (GENERATOR_VERSION, source_id(grade, field, level), grade, field, int(level), int(n), int(seed))
+
+# キャッシュになかったときの計算時間は、段階 generate / csv_encode / json_encode / pdf_build として記録する
+# CSV・JSON・PDF はキャッシュした同じ ProblemSet から作る
+def _generate(grade: str, field: str, level: int, n: int, seed: int) -> ProblemSet:
+    with timed("generate", grade=grade, field=field, level=level, n=n):
+        return generate_set(grade, field, level, n, seed)
+
+def _encode_csv(grade: str, field: str, level: int, n: int, seed: int) -> bytes:
+    pset = cached_set(grade, field, level, n, seed)
+    with timed("csv_encode", grade=grade, field=field, level=level, n=n):
+        return pset.to_csv_bytes()
+
+def _encode_json(grade: str, field: str, level: int, n: int, seed: int) -> bytes:
+    pset = cached_set(grade, field, level, n, seed)
+    with timed("json_encode", grade=grade, field=field, level=level, n=n):
+        return pset.to_json_bytes(n)
+
+def _build_pdf(grade: str, field: str, level: int, n: int, seed: int) -> bytes:
+    pset = cached_set(grade, field, level, n, seed)
+    with timed("pdf_build", grade=grade, field=field, level=level, n=n):
+        return pset.to_pdf(n)
+
+def cached_set(grade: str, field: str, level: int, n: int, seed: int) -> ProblemSet:
+    return SET_CACHE.get_or_compute(_key(grade, field, level, n, seed),
+                                    lambda: _generate(grade, field, level, n, seed))
+
+def cached_csv(grade: str, field: str, level: int, n: int, seed: int) -> bytes:
+    return CSV_CACHE.get_or_compute(_key(grade, field, level, n, seed),
+                                    lambda: _encode_csv(grade, field, level, n, seed))
+
+def cached_json(grade: str, field: str, level: int, n: int, seed: int) -> bytes:
+    return JSON_CACHE.get_or_compute(_key(grade, field, level, n, seed),
+                                     lambda: _encode_json(grade, field, level, n, seed))
+
+def cached_pdf(grade: str, field: str, level: int, n: int, seed: int) -> bytes:
+    return PDF_CACHE.get_or_compute(_key(grade, field, level, n, seed),
+                                    lambda: _build_pdf(grade, field, level, n, seed))
+
+def _bundle_key(fmt: str, roster: Sequence, grade: str, field: str, level: int, n: int) -> tuple:
+    return (GENERATOR_VERSION, source_id(grade, field, level), grade, field, int(level), int(n), fmt, tuple(roster))
+
+def cached_bundle(fmt: str, roster: Sequence, grade: str, field: str, level: int, n: int) -> bytes:
+    """bundle.build_bundle の結果。roster は bundle.Student の並び（名前とシードがキーになる）。"""
+    from bundle import build_bundle
+
+    return BUNDLE_CACHE.get_or_compute(_bundle_key(fmt, roster, grade, field, level, n),
+                                       lambda: build_bundle(fmt, list(roster), grade, field, level, n))
+
+def peek_bundle(fmt: str, roster: Sequence, grade: str, field: str, level: int, n: int) -> Optional[bytes]:
+    """キャッシュに残っていれば cached_bundle と同じ結果、捨てられていれば None（作り直さない）。"""
+    return BUNDLE_CACHE.get(_bundle_key(fmt, roster, grade, field, level, n))
+
+# PDF はバックグラウンドで作る。同じキーの作成中ジョブは共有する
+_PDF_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.environ.get("DRILL_PDF_WORKERS", "2")),
+                                   thread_name_prefix="drill-pdf")
+_PDF_JOBS: Dict[tuple, Future] = {}
+_PDF_JOBS_LOCK = threading.Lock()
+
+def submit_pdf(grade: str, field: str, level: int, n: int, seed: int) -> Future:
+    """PDF の作成をバックグラウンドで始め、結果（bytes）の Future を返す。キャッシュ済みなら完了済みの Future。"""
+    key = _key(grade, field, level, n, seed)
+    with _PDF_JOBS_LOCK:
+        job = _PDF_JOBS.get(key)
+        if job is not None:
+            return job
+        pdf = PDF_CACHE.get(key, _MISSING)
+        if pdf is not _MISSING:
+            job = Future()
+            job.set_result(pdf)
+            return job
+        job = _PDF_EXECUTOR.submit(cached_pdf, grade, field, level, n, seed)
+        _PDF_JOBS[key] = job
+
+    def _done(_: Future) -> None:
+        with _PDF_JOBS_LOCK:
+            _PDF_JOBS.pop(key, None)
+
+    job.add_done_callback(_done)
+    return job
+
+_FONT_WARMUP: Optional[Future] = None
+
+def warm_font_cache_async() -> Future:
+    """フォントの解析（fpdf の import を含む）を PDF 用のスレッドで始める。プロセスで一度だけ。
+
+    アプリの最初の表示を待たせずに、最初の PDF の作成までに済ませておくためのもの。
+    """
+    global _FONT_WARMUP
+    with _PDF_JOBS_LOCK:
+        if _FONT_WARMUP is None:
+            _FONT_WARMUP = _PDF_EXECUTOR.submit(warm_font_cache)
+        return _FONT_WARMUP
+
+def cache_stats() -> Dict[str, Dict[str, int]]:
+    return {"sets": SET_CACHE.stats(), "csv": CSV_CACHE.stats(), "json": JSON_CACHE.stats(), "pdf": PDF_CACHE.stats(),
+            "bundle": BUNDLE_CACHE.stats(), "compare": compare_cache_info()}
+
+def clear_caches() -> None:
+    for c in (SET_CACHE, CSV_CACHE, JSON_CACHE, PDF_CACHE, BUNDLE_CACHE):
+        c.clear()